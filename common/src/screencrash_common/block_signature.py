@@ -0,0 +1,64 @@
+"""
+Block signatures of files, for sending only the changes to a file.
+
+A component with an old version of a file splits it into blocks, and sends
+a signature of each whole block: a weak hash (Adler-32) and a strong hash
+(the first 8 bytes of MD5). Core finds the blocks in the new version by
+rolling the weak hash over it (see core/src/util/block_delta.py), so the
+weak hash must stay Adler-32.
+
+Core and the Python components both use this module, so they agree on the
+hashes and the block sizes.
+"""
+import hashlib
+import math
+from typing import BinaryIO, List, Tuple
+import zlib
+
+# The largest number of blocks to split a file into, which bounds the size of signatures
+MAX_NOF_BLOCKS = 16384
+
+
+def block_size_for(size: int) -> int:
+    """Choose a block size for a file, around the square root of its size like rsync, in whole KiB."""
+    block_size = max(2048, math.isqrt(size), -(-size // MAX_NOF_BLOCKS))
+    return -(-block_size // 1024) * 1024
+
+
+def signature_block_size(requested: int, size: int) -> int:
+    """Get the block size to sign a file with: the requested one, or larger if the file would get too many blocks."""
+    return max(requested, -(-size // MAX_NOF_BLOCKS))
+
+
+def weak_hash(block) -> int:
+    return zlib.adler32(block)
+
+
+def strong_hash(block) -> bytes:
+    return hashlib.md5(block).digest()[:8]
+
+
+def file_signature(f: BinaryIO, block_size: int) -> Tuple[List[int], List[bytes]]:
+    """
+    Get the signature of each whole block of a file.
+
+    Parameters
+    ----------
+    f
+        The file, read from its current position
+    block_size
+        The size of the blocks
+
+    Returns
+    -------
+    The weak and strong hashes of the blocks
+    """
+    weak = []
+    strong = []
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            break
+        weak.append(weak_hash(block))
+        strong.append(strong_hash(block))
+    return weak, strong
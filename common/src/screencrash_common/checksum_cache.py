@@ -0,0 +1,148 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# (size, mtime in ns, inode) of a file
+FileKey = Tuple[int, int, int]
+
+
+def hash_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """Compute the MD5 checksum of a file, reading it in chunks."""
+    checksum = hashlib.md5()
+    with open(path, mode="rb") as f:
+        while chunk := f.read(chunk_size):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class ChecksumCache:
+    """
+    A persistent cache of file checksums.
+
+    Checksums are stored by path (relative to root), together with the size,
+    mtime and inode of the file. A file is only hashed again if any of those
+    have changed. The cache is saved as JSON lines in root.
+
+    Core and the audio component both use this cache.
+
+    Parameters
+    ----------
+    root
+        The directory to store the cache in. Paths are relative to this.
+    max_workers
+        The maximum number of files to hash in parallel
+    """
+
+    FILE_NAME = ".checksums.jsonl"
+
+    def __init__(self, root: Path, max_workers: Optional[int] = None):
+        self._root = root
+        self._cache_file = root / self.FILE_NAME
+        self._entries: Dict[str, Tuple[FileKey, str]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="checksum")
+        self._changed = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._cache_file, mode="r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        key = (entry["size"], entry["mtime_ns"], entry["inode"])
+                        self._entries[entry["path"]] = (key, entry["md5"])
+                    except (ValueError, KeyError):
+                        pass  # Skip broken lines, they will be rewritten
+        except FileNotFoundError:
+            pass
+
+    def _relative_path(self, path: Path) -> str:
+        return Path(os.path.relpath(path.resolve(), self._root.resolve())).as_posix()
+
+    def checksum(self, path: Path) -> str:
+        """
+        Get the checksum of a file, hashing it only if it has changed.
+
+        This blocks while hashing. Use checksum_async from an event loop.
+
+        Parameters
+        ----------
+        path
+            The file
+
+        Returns
+        -------
+        The MD5 checksum of the file
+        """
+        relative_path = self._relative_path(path)
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        cached = self._entries.get(relative_path)
+        if cached is not None and cached[0] == key:
+            with self._lock:
+                self.hits += 1
+            return cached[1]
+
+        checksum = hash_file(path)
+        with self._lock:
+            self.misses += 1
+            self._entries[relative_path] = (key, checksum)
+            self._changed = True
+        return checksum
+
+    async def checksum_async(self, path: Path) -> str:
+        """Get the checksum of a file without blocking the event loop. See checksum."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.checksum, path)
+
+    def checksums(self, paths: List[Path]) -> Dict[str, str]:
+        """
+        Get the checksums of files, hashing only those that have changed.
+
+        Changed files are hashed in parallel, and the cache is saved afterwards.
+
+        Parameters
+        ----------
+        paths
+            The files, which must be in root
+
+        Returns
+        -------
+        A dict from path (relative to root, as a POSIX path) to MD5 checksum
+        """
+        checksums = self._executor.map(self.checksum, paths)
+        result = {self._relative_path(path): checksum for path, checksum in zip(paths, checksums)}
+        self.save()
+        return result
+
+    def save(self):
+        """Write the cache to disk, if anything has changed."""
+        if not self._changed:
+            return
+        tmp_file = self._cache_file.with_name(self._cache_file.name + ".tmp")
+        try:
+            with open(tmp_file, mode="w", encoding="utf-8") as f:
+                for path, ((size, mtime_ns, inode), checksum) in self._entries.items():
+                    f.write(json.dumps({
+                        "path": path, "size": size, "mtime_ns": mtime_ns, "inode": inode, "md5": checksum
+                    }) + "\n")
+            os.replace(tmp_file, self._cache_file)
+            self._changed = False
+        except OSError as e:
+            print(f"Warning: Could not write checksum cache {self._cache_file}: {e}")
+
+    def close(self):
+        """Save the cache and stop the hashing threads."""
+        self.save()
+        self._executor.shutdown()
+
+    def report(self) -> str:
+        """Get a one-line report of cache hits and misses."""
+        return f"Checksums: {self.hits} cached, {self.misses} computed"
@@ -0,0 +1,135 @@
+"""
+Encoding of websocket messages between Core and components.
+
+Messages are JSON in text frames, or MessagePack in binary frames, so every
+frame can be decoded without knowing what was negotiated. A client lists the
+encodings it can decode in its hello message ("encodings"). Core then sends
+in the first of those it supports, and the client answers in the encoding of
+the frames it gets. Clients that don't list any encodings get JSON.
+
+Bytes in messages (e.g. file data) are sent as they are with MessagePack,
+and as base64 strings with JSON.
+
+Core and the Python components all use this module, so both sides agree.
+"""
+import base64
+import json
+import struct
+from typing import Any, Dict, Iterable, Iterator, List, Union
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+# The encodings we can use, by preference
+SUPPORTED_ENCODINGS = [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+Frame = Union[str, bytes]
+
+
+def choose_encoding(offered: List[str]) -> str:
+    """Choose the first of the offered encodings that we support, or JSON."""
+    for encoding in offered:
+        if encoding in SUPPORTED_ENCODINGS:
+            return encoding
+    return JSON
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("utf-8")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode(message: Any, encoding: str = JSON) -> Frame:
+    """
+    Encode a message.
+
+    Parameters
+    ----------
+    message
+        The message, e.g. a dict
+    encoding
+        JSON or MSGPACK
+
+    Returns
+    -------
+    A string (for a text frame) for JSON, or bytes (for a binary frame) for MessagePack
+    """
+    if encoding == MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, default=_json_default)
+
+
+def _msgpack_bin_header(size: int) -> bytes:
+    if size < 2 ** 8:
+        return struct.pack(">BB", 0xc4, size)
+    if size < 2 ** 16:
+        return struct.pack(">BH", 0xc5, size)
+    return struct.pack(">BI", 0xc6, size)
+
+
+def encode_fragments(message: Dict[str, Any], key: str, chunks: Iterable[bytes], size: int,
+                     encoding: str = JSON) -> Iterator[Frame]:
+    """
+    Encode a message with bytes under a key, as the fragments of one frame.
+
+    This is for sending large data (e.g. files) without holding the whole
+    encoded message in memory. The fragments are encoded as they are needed,
+    and joined they are the same as encoding the whole message.
+
+    Parameters
+    ----------
+    message
+        The rest of the message, which must not have the key
+    key
+        The key of the bytes, which is last in the message
+    chunks
+        The bytes, in pieces. With JSON, every piece but the last must be a
+        multiple of 3 bytes long, so the pieces can be base64 encoded one by one.
+    size
+        The total length of the bytes
+    encoding
+        JSON or MSGPACK
+
+    Returns
+    -------
+    The fragments, which are strings for JSON and bytes for MessagePack
+    """
+    if encoding == MSGPACK:
+        packer = msgpack.Packer(use_bin_type=True)
+        yield (packer.pack_map_header(len(message) + 1)
+               + b"".join(packer.pack(item) for pair in message.items() for item in pair)
+               + packer.pack(key) + _msgpack_bin_header(size))
+        for chunk in chunks:
+            yield bytes(chunk)
+    else:
+        yield json.dumps(message, default=_json_default)[:-1] + (", " if message else "") + json.dumps(key) + ': "'
+        for chunk in chunks:
+            yield base64.b64encode(chunk).decode("utf-8")
+        yield '"}'
+
+
+def decode(frame: Frame) -> Any:
+    """Decode a message, as JSON if it's a string or MessagePack if it's bytes."""
+    if isinstance(frame, str):
+        return json.loads(frame)
+    if msgpack is None:
+        raise RuntimeError("Got a MessagePack message, but msgpack is not installed")
+    return msgpack.unpackb(frame, raw=False)
+
+
+def encoding_of(frame: Frame) -> str:
+    """Get the encoding of a received frame."""
+    return JSON if isinstance(frame, str) else MSGPACK
+
+
+def decode_bytes(value: Union[str, bytes]) -> bytes:
+    """Get bytes sent in a message, which are base64 encoded if the message was JSON."""
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return value
@@ -1,9 +1,10 @@
-import base64
+from concurrent.futures import ThreadPoolExecutor
 import random
 import string
 import os
 from pathlib import Path
 from file_handler import FileHandler
+from screencrash_common.wire_codec import decode_bytes
 from audio_vlc import AudioMixerVLC
 
 class CommandHandler:
@@ -14,6 +15,10 @@ class CommandHandler:
         self._base_path = Path(__file__).parent.parent / "resources"
         self._mixer = AudioMixerVLC(self._handle_mixer_event)
         self._file_handler = FileHandler(self._base_path)
+        # Assets are downloaded from Core in the background, a few at a time
+        self._downloads = ThreadPoolExecutor(int(os.environ.get("SCREENCRASH_PARALLEL_DOWNLOADS", "4")))
+        # The download of each file, by path and checksum, so it's not downloaded twice after a reconnect
+        self._downloading = {}
         self._custom_event_handler = None
         self._sounds = {}
 
@@ -53,7 +58,8 @@ class CommandHandler:
     
     def initial_message(self):
         hashes = self._file_handler.get_hashes()
-        return {"client": "audio", "files": hashes }
+        # Assets can be synced to us in chunks
+        return {"client": "audio", "files": hashes, "chunkedFiles": True, "deltaFiles": True, "httpFiles": True }
 
     def handle_message(self, message):
         try:
@@ -85,7 +91,17 @@ class CommandHandler:
         elif cmd == "toggle_mute":
             result = self._toggle_mute(entity_id)
         elif cmd == "file":
-            result = self._file_handler.write_file(Path(message["path"]), base64.b64decode(message["data"]))
+            result = self._file_handler.write_file(Path(message["path"]), decode_bytes(message["data"]))
+        elif cmd in ["file_signature", "file_start", "file_chunk", "file_copy", "file_end"]:
+            result = self._handle_file_transfer(cmd, message)
+        elif cmd == "file_manifest":
+            self._download_files(message)
+        elif cmd == "report_checksums":
+            result = {
+                "messageType": "file_checksums",
+                "files": self._file_handler.get_hashes(),
+                "partial": self._file_handler.get_partial(),
+            }
         elif cmd in ["hide", "show", "viewport", "layer"] and message.get("type") == "video":
             # These are pure visual commands for video. Ignore.
             pass
@@ -95,6 +111,53 @@ class CommandHandler:
 
         return result
 
+    def _handle_file_transfer(self, cmd, message):
+        path = Path(message["path"])
+        try:
+            if cmd == "file_signature":
+                block_size, weak, strong = self._file_handler.get_signature(path, message["blockSize"])
+                return {"messageType": "file_signature", "path": message["path"],
+                        "blockSize": block_size, "weak": weak, "strong": strong}
+            elif cmd == "file_start":
+                self._file_handler.start_file(path, message["size"], message["checksum"], message["offset"],
+                                              message.get("base", False))
+            elif cmd == "file_chunk":
+                offset = self._file_handler.write_chunk(path, message["offset"], decode_bytes(message["data"]))
+                return {"messageType": "file_ack", "path": message["path"], "offset": offset}
+            elif cmd == "file_copy":
+                offset = self._file_handler.copy_from_base(path, message["offset"], message["sourceOffset"],
+                                                           message["length"])
+                return {"messageType": "file_ack", "path": message["path"], "offset": offset}
+            else:
+                self._file_handler.finish_file(path)
+                return {"messageType": "file_synced", "path": message["path"]}
+        except Exception as e:
+            print(f"Failed to receive file {path}: {e}")
+            return {"messageType": "file_sync_failed", "path": message["path"], "reason": str(e)}
+
+    def _download_files(self, message):
+        base_url = f"http://{os.environ.get('CORE', 'localhost:8001')}{message['assetsPath']}"
+        for file in message["files"]:
+            key = (file["path"], file["checksum"])
+            download = self._downloading.get(key)
+            if download is None or download.done():
+                download = self._downloads.submit(
+                    self._file_handler.download_file, base_url + file["checksum"], Path(file["path"]),
+                    file["size"], file["checksum"],
+                    lambda offset, path=file["path"]: self._emit(
+                        {"messageType": "file_ack", "path": path, "offset": offset}))
+                self._downloading[key] = download
+                # Results are sent on the connection we have when the download ends, so a
+                # download that is already running for an earlier manifest is reported once
+                download.add_done_callback(
+                    lambda done, path=file["path"]: self._emit(self._download_result(path, done)))
+
+    def _download_result(self, path, download):
+        if download.exception() is not None:
+            print(f"Failed to download file {path}: {download.exception()}")
+            return {"messageType": "file_sync_failed", "path": path, "reason": str(download.exception())}
+        return {"messageType": "file_synced", "path": path}
+
     def _announce_component_info(self):
         self._emit({
             "messageType": "component_info",
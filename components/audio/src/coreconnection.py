@@ -2,6 +2,7 @@ import websocket
 import json
 import os
 from time import sleep
+from screencrash_common.wire_codec import JSON, SUPPORTED_ENCODINGS, decode, encode, encoding_of
 
 class CoreConnection:
 
@@ -11,6 +12,8 @@ class CoreConnection:
         self._reconnect = reconnect
         self._reconnect_time = reconnect_time
         self._ws = None
+        # The encoding to send in, which is the one Core sends in
+        self._encoding = JSON
 
     def run(self):
         while self._reconnect:
@@ -32,10 +35,15 @@ class CoreConnection:
 
     def send(self, data):
         if self._ws is not None:
-            self._ws.send(json.dumps(data))
+            self._send(self._ws, data)
         else:
             print("Failed to send data on websocket. Seems to be down")
 
+    def _send(self, ws, data):
+        frame = encode(data, self._encoding)
+        opcode = websocket.ABNF.OPCODE_BINARY if isinstance(frame, bytes) else websocket.ABNF.OPCODE_TEXT
+        ws.send(frame, opcode)
+
     def stop(self):
         self._reconnect = False
         if self._ws:
@@ -50,16 +58,19 @@ class CoreConnection:
 
     def _on_message(self, ws, message):
         if self._handle_message_callback:
-            data = json.loads(message)
+            self._encoding = encoding_of(message)
+            data = decode(message)
             response = self._handle_message_callback(data)
             if not response is None:
-                ws.send(json.dumps(response))
+                self._send(ws, response)
         else:
             print("Got message: {} (no message handler)".format(message))
 
     def _on_open(self, ws):
         print("Connected to core")
-        ws.send(json.dumps(self._get_announce_message()))
+        self._encoding = JSON
+        # Core answers in one of the encodings we list
+        ws.send(json.dumps({**self._get_announce_message(), "encodings": SUPPORTED_ENCODINGS}))
 
     def _on_error(self, ws, error):
         # Print errors, but not if user presses Ctrl+C
@@ -1,33 +1,196 @@
-import hashlib
+import os
 from pathlib import Path
+import re
+import shutil
+import threading
+import urllib.request
+from screencrash_common.block_signature import file_signature, signature_block_size
+from screencrash_common.checksum_cache import ChecksumCache, hash_file
+
+# Bytes to copy from the old version of a file at once
+COPY_SIZE = 1024 * 1024
+# Bytes to download from Core per request. Core sends at most 4 MiB per response.
+DOWNLOAD_SIZE = 4 * 1024 * 1024
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-")
+
+class FileTransfer:
+    """A file being received in chunks, into a temporary file."""
+
+    def __init__(self, part_path: Path, size: int, checksum: str, offset: int, base_path: Path = None):
+        self.part_path = part_path
+        self.size = size
+        self.checksum = checksum
+        self.file = open(part_path, "r+b" if part_path.exists() else "wb")
+        # Continue after the data we already have
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        # The old version of the file, to copy unchanged blocks from
+        self.base = open(base_path, "rb") if base_path is not None else None
+
+    def close(self):
+        self.file.close()
+        if self.base is not None:
+            self.base.close()
 
 class FileHandler:
 
+    # Files being received are kept here until they are complete, named by
+    # their checksum, so an interrupted sync can continue after a reconnect
+    PARTIAL_DIR = ".partial"
+    IGNORED_FILES = [".gitignore", ChecksumCache.FILE_NAME, ChecksumCache.FILE_NAME + ".tmp", PARTIAL_DIR]
+
     def __init__(self, resource_path: Path):
         self._resource_path = resource_path
+        self._checksum_cache = ChecksumCache(resource_path)
+        self._transfers = {}
+        # Files with the same checksum share a partial file, so only download one at a time
+        self._download_locks = {}
+        self._download_locks_lock = threading.Lock()
 
     def write_file(self, path: Path, data: bytes):
-        full_path = self._resource_path / path
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(full_path, "wb") as f:
+        tmp_path = self._resource_path / self.PARTIAL_DIR / (path.name + ".tmp")
+        tmp_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "wb") as f:
             f.write(data)
+        self._move_into_place(tmp_path, path)
+        print("Wrote file " + str(path))
+
+    def start_file(self, path: Path, size: int, checksum: str, offset: int, base: bool = False):
+        """
+        Start receiving a file in chunks, from an offset if we have the start
+        of it already. If base is set, parts of the file are copied from the
+        version we have.
+        """
+        if path in self._transfers:
+            self._transfers.pop(path).close()
+        part_path = self._resource_path / self.PARTIAL_DIR / (checksum + ".part")
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        have = part_path.stat().st_size if part_path.exists() else 0
+        if offset > have:
+            raise RuntimeError(f"Got {path} from {offset} bytes, but only have {have}")
+        base_path = self._resource_path / path if base else None
+        self._transfers[path] = FileTransfer(part_path, size, checksum, offset, base_path)
+        print(f"Receiving file {path} ({size} bytes, from {offset})")
+
+    def write_chunk(self, path: Path, offset: int, data: bytes) -> int:
+        """Write a chunk of a file. Returns how much of the file we have."""
+        transfer = self._transfers[path]
+        if offset != transfer.file.tell():
+            raise RuntimeError(f"Got {path} at {offset} bytes, but expected {transfer.file.tell()}")
+        transfer.file.write(data)
+        transfer.file.flush()
+        return transfer.file.tell()
+
+    def copy_from_base(self, path: Path, offset: int, source_offset: int, length: int) -> int:
+        """Copy data from the old version of a file. Returns how much of the file we have."""
+        transfer = self._transfers[path]
+        if offset != transfer.file.tell():
+            raise RuntimeError(f"Got {path} at {offset} bytes, but expected {transfer.file.tell()}")
+        transfer.base.seek(source_offset)
+        while length > 0:
+            data = transfer.base.read(min(length, COPY_SIZE))
+            if not data:
+                raise RuntimeError(f"The old version of {path} ended before {source_offset + length} bytes")
+            transfer.file.write(data)
+            length -= len(data)
+        transfer.file.flush()
+        return transfer.file.tell()
+
+    def get_signature(self, path: Path, block_size: int):
+        """
+        Get the signature of each whole block of a file: its Adler-32 and the
+        first 8 bytes of its MD5. The block size is increased for large files.
+
+        Returns
+        -------
+        The block size, and the weak and strong hashes of the blocks
+        """
+        full_path = self._resource_path / path
+        block_size = signature_block_size(block_size, full_path.stat().st_size)
+        with open(full_path, "rb") as f:
+            weak, strong = file_signature(f, block_size)
+        return block_size, weak, strong
+
+    def download_file(self, url: str, path: Path, size: int, checksum: str, on_progress=None):
+        """
+        Download a file from Core in ranges, continuing after the data we
+        already have of it, and move it into place once the checksum is
+        verified. on_progress is called with how much of the file we have
+        after each range.
+        """
+        with self._download_locks_lock:
+            lock = self._download_locks.setdefault(checksum, threading.Lock())
+        with lock:
+            self._download_file(url, path, size, checksum, on_progress)
+
+    def _download_file(self, url: str, path: Path, size: int, checksum: str, on_progress):
+        part_path = self._resource_path / self.PARTIAL_DIR / (checksum + ".part")
+        part_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(part_path, "ab") as f:
+            have = f.tell()
+            if have > size:
+                f.truncate(0)
+                have = 0
+            while have < size:
+                end = min(have + DOWNLOAD_SIZE, size) - 1
+                # If-Range makes Core send the file from the start if it's not the one we have the start of
+                request = urllib.request.Request(url, headers={"Range": f"bytes={have}-{end}",
+                                                               "If-Range": f'"{checksum}"'})
+                with urllib.request.urlopen(request) as response:
+                    start = 0
+                    if response.status == 206:
+                        start = int(CONTENT_RANGE_PATTERN.match(response.headers["Content-Range"]).group(1))
+                    f.truncate(start)
+                    shutil.copyfileobj(response, f, COPY_SIZE)
+                f.flush()
+                have = f.tell()
+                if on_progress is not None:
+                    on_progress(have)
+        actual_checksum = hash_file(part_path)
+        if actual_checksum != checksum:
+            part_path.unlink()
+            raise RuntimeError(f"Checksum of {path} is {actual_checksum}, expected {checksum}")
+        self._move_into_place(part_path, path)
+        print("Wrote file " + str(path))
+
+    def finish_file(self, path: Path):
+        """Verify the checksum of a file received in chunks, and move it into place."""
+        transfer = self._transfers.pop(path)
+        transfer.close()
+        checksum = hash_file(transfer.part_path)
+        if checksum != transfer.checksum:
+            transfer.part_path.unlink()
+            raise RuntimeError(f"Checksum of {path} is {checksum}, expected {transfer.checksum}")
+        self._move_into_place(transfer.part_path, path)
         print("Wrote file " + str(path))
-    
-    def get_hashes(self, path=None):
-        if path is None:
-            path = self._resource_path
-        if path.is_dir():
-            hashes = {}
+
+    def _move_into_place(self, tmp_path: Path, path: Path):
+        # Replacing is atomic, so the file is never half written
+        full_path = self._resource_path / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, full_path)
+
+    def get_partial(self):
+        """Get how much we have of files that were not completely received, by checksum."""
+        partial_dir = self._resource_path / self.PARTIAL_DIR
+        if not partial_dir.is_dir():
+            return {}
+        return {part.stem: part.stat().st_size for part in partial_dir.glob("*.part")}
+
+    def get_hashes(self):
+        # Paths are represented as POSIX paths (forward slashes) on Windows too,
+        # since Core and the component need to agree
+        hashes = self._checksum_cache.checksums(self._get_files(self._resource_path))
+        print(self._checksum_cache.report())
+        return hashes
+
+    def _get_files(self, path):
+        if path.name in self.IGNORED_FILES:
+            return []
+        elif path.is_dir():
+            files = []
             for sub_path in path.iterdir():
-                hashes.update(self.get_hashes(sub_path))
+                files.extend(self._get_files(sub_path))
+            return files
         else:
-            if path.name == ".gitignore":
-                return {}
-            with open(path, "rb") as f:
-                data = f.read()
-            checksum = hashlib.md5(data).hexdigest()
-            # Represent as a POSIX path (forward slashes) on Windows too, since
-            # Core and the component need to agree
-            relative_path = path.relative_to(self._resource_path).as_posix()
-            hashes = { relative_path: checksum }
-        return hashes
\ No newline at end of file
+            return [path]
@@ -3,6 +3,7 @@ import websockets.exceptions
 import json
 from typing import Any
 from entity_manager import EntityManager
+from screencrash_common.wire_codec import JSON, SUPPORTED_ENCODINGS, decode, encode, encoding_of
 import traceback
 import asyncio
 
@@ -27,27 +28,39 @@ def get_component_info(entity_manager: EntityManager):
 async def core_connection(core_address: str, entity_manager: EntityManager):
 
     current_websocket = None
+    # The encoding to send in, which is the one Core sends in
+    encoding = JSON
 
     def send_message(message: dict[str, Any]) -> None:
         if current_websocket is None:
             print(f"No core connection for message: {message}")
         else:
-            asyncio.create_task(current_websocket.send(json.dumps(message)))
+            asyncio.create_task(current_websocket.send(encode(message, encoding)))
 
     entity_manager.add_core_message_listener(send_message)
 
     async for websocket in connect("ws://" + core_address):
         try:
             current_websocket = websocket
+            encoding = JSON
+            # Core answers in one of the encodings we list
             await websocket.send(
-                json.dumps({"type": "announce", "client": "media", "channel": 1})
+                json.dumps(
+                    {
+                        "type": "announce",
+                        "client": "media",
+                        "channel": 1,
+                        "encodings": SUPPORTED_ENCODINGS,
+                    }
+                )
             )
             async for message in websocket:
                 try:
                     print("Got message: " + str(message))
-                    result = handle_message(json.loads(message), entity_manager)
+                    encoding = encoding_of(message)
+                    result = handle_message(decode(message), entity_manager)
                     if result is not None:
-                        await websocket.send(json.dumps(result))
+                        await websocket.send(encode(result, encoding))
                 except Exception:
                     traceback.print_exc()
 
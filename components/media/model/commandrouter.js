@@ -17,6 +17,8 @@ module.exports = class CommandRouter extends EventTarget {
         this.dom = dom;
         this.fileHandler = fileHandler;
         this.handlers = {};
+        // File chunks are written one at a time, in the order they arrive
+        this.fileOperations = Promise.resolve();
         this.regularUpdateInterval = setInterval(this._regularUpdate.bind(this), 500);
     }
 
@@ -36,7 +38,9 @@ module.exports = class CommandRouter extends EventTarget {
         return {
             type: 'announce',
             client: 'media',
-            channel: 1
+            channel: 1,
+            // Assets can be synced to us in chunks
+            chunkedFiles: true
         };
     }
 
@@ -45,7 +49,11 @@ module.exports = class CommandRouter extends EventTarget {
     }
 
     async reportChecksums() {
-        this.sendFunction({ messageType: 'file_checksums', files: await this.fileHandler.getHashes() });
+        this.sendFunction({
+            messageType: 'file_checksums',
+            files: await this.fileHandler.getHashes(),
+            partial: await this.fileHandler.getPartial()
+        });
     }
 
     logMessage(data) {
@@ -105,6 +113,11 @@ module.exports = class CommandRouter extends EventTarget {
                 case 'file':
                     this.fileHandler.writeFile(msg);
                     break;
+                case 'file_start':
+                case 'file_chunk':
+                case 'file_end':
+                    this.handleFileTransfer(msg);
+                    break;
                 case 'report_checksums':
                     this.reportChecksums();
                     break;
@@ -117,6 +130,25 @@ module.exports = class CommandRouter extends EventTarget {
         }
     }
 
+    handleFileTransfer(msg) {
+        this.fileOperations = this.fileOperations.then(async () => {
+            try {
+                if (msg.command === 'file_start') {
+                    await this.fileHandler.startFile(msg);
+                } else if (msg.command === 'file_chunk') {
+                    const offset = await this.fileHandler.writeChunk(msg);
+                    this.sendFunction({ messageType: 'file_ack', path: msg.path, offset: offset });
+                } else {
+                    await this.fileHandler.finishFile(msg);
+                    this.sendFunction({ messageType: 'file_synced', path: msg.path });
+                }
+            } catch (e) {
+                this.reportError(`Failed to receive file ${msg.path}: ${e}`);
+                this.sendFunction({ messageType: 'file_sync_failed', path: msg.path, reason: `${e}` });
+            }
+        });
+    }
+
     createHandler(msg) {
         const entityId = msg.entityId;
 
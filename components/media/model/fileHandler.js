@@ -8,22 +8,41 @@ const writeFile = util.promisify(fs.writeFile);
 const mkdir = util.promisify(fs.mkdir);
 const readdir = util.promisify(fs.readdir);
 const stat = util.promisify(fs.stat);
+const open = util.promisify(fs.open);
+const write = util.promisify(fs.write);
+const close = util.promisify(fs.close);
+const ftruncate = util.promisify(fs.ftruncate);
+const rename = util.promisify(fs.rename);
+
+// Files received in chunks are written here until they are complete, named
+// after their checksum, so a sync can continue after a reconnect
+const PARTIAL_DIR = '.partial';
 
 module.exports = class FileHandler {
 
     constructor(resourcesPath) {
         this.resourcesPath = resourcesPath;
+        // The files being received in chunks, by path
+        this.transfers = {};
     }
 
     getResourcesPath() {
         return this.resourcesPath;
     }
 
-    async writeFile(message) {
-        const { path: filePath, data } = message;
+    _fullPath(filePath) {
         // Core will send POSIX paths, but we may be on Windows
         const platformCorrectPath = filePath.split(path.posix.sep).join(path.sep);
-        const fullPath = path.join(this.resourcesPath, platformCorrectPath);
+        return path.join(this.resourcesPath, platformCorrectPath);
+    }
+
+    _partPath(checksum) {
+        return path.join(this.resourcesPath, PARTIAL_DIR, `${checksum}.part`);
+    }
+
+    async writeFile(message) {
+        const { path: filePath, data } = message;
+        const fullPath = this._fullPath(filePath);
         const dir = path.dirname(fullPath);
         await mkdir(dir, { recursive: true });
         const buffer = Buffer.from(data, 'base64');
@@ -31,10 +50,90 @@ module.exports = class FileHandler {
         console.log(`Wrote file ${filePath}`);
     }
 
+    async startFile(message) {
+        const { path: filePath, size, checksum, offset } = message;
+        if (filePath in this.transfers) {
+            await close(this.transfers[filePath].fd);
+            delete this.transfers[filePath];
+        }
+        const partPath = this._partPath(checksum);
+        await mkdir(path.dirname(partPath), { recursive: true });
+        const have = fs.existsSync(partPath) ? (await stat(partPath)).size : 0;
+        if (offset > have) {
+            throw new Error(`Got ${filePath} from ${offset} bytes, but only have ${have}`);
+        }
+        const fd = await open(partPath, have > 0 ? 'r+' : 'w');
+        await ftruncate(fd, offset);
+        this.transfers[filePath] = { fd, partPath, checksum, position: offset };
+        console.log(`Receiving file ${filePath} (${size} bytes, from ${offset})`);
+    }
+
+    async writeChunk(message) {
+        const { path: filePath, offset, data } = message;
+        const transfer = this.transfers[filePath];
+        if (transfer === undefined) {
+            throw new Error(`Got a chunk of ${filePath}, which is not being received`);
+        }
+        if (offset !== transfer.position) {
+            throw new Error(`Got ${filePath} at ${offset} bytes, but expected ${transfer.position}`);
+        }
+        const buffer = Buffer.from(data, 'base64');
+        await write(transfer.fd, buffer, 0, buffer.length, transfer.position);
+        transfer.position += buffer.length;
+        return transfer.position;
+    }
+
+    async finishFile(message) {
+        const filePath = message.path;
+        const transfer = this.transfers[filePath];
+        if (transfer === undefined) {
+            throw new Error(`Got the end of ${filePath}, which is not being received`);
+        }
+        delete this.transfers[filePath];
+        await close(transfer.fd);
+        const checksum = await this._hashFile(transfer.partPath);
+        if (checksum !== transfer.checksum) {
+            fs.unlinkSync(transfer.partPath);
+            throw new Error(`Checksum of ${filePath} is ${checksum}, expected ${transfer.checksum}`);
+        }
+        const fullPath = this._fullPath(filePath);
+        await mkdir(path.dirname(fullPath), { recursive: true });
+        // Renaming replaces the file at once, so it's never half written
+        await rename(transfer.partPath, fullPath);
+        console.log(`Wrote file ${filePath}`);
+    }
+
+    _hashFile(filePath) {
+        return new Promise((resolve, reject) => {
+            const hash = crypto.createHash('md5');
+            fs.createReadStream(filePath)
+                .on('data', (chunk) => hash.update(chunk))
+                .on('end', () => resolve(hash.digest('hex')))
+                .on('error', reject);
+        });
+    }
+
+    async getPartial() {
+        const partialDir = path.join(this.resourcesPath, PARTIAL_DIR);
+        if (!fs.existsSync(partialDir)) {
+            return {};
+        }
+        const partial = {};
+        for (const name of await readdir(partialDir)) {
+            if (name.endsWith('.part')) {
+                partial[path.basename(name, '.part')] = (await stat(path.join(partialDir, name))).size;
+            }
+        }
+        return partial;
+    }
+
     async getHashes(filePath) {
         if (filePath === undefined) {
             filePath = this.resourcesPath;
         }
+        if (path.basename(filePath) === PARTIAL_DIR) {
+            return {};
+        }
         const stats = await stat(filePath);
         if (stats.isDirectory()) {
             const subPaths = (await readdir(filePath)).map((subPath) => path.join(filePath, subPath));
@@ -0,0 +1,162 @@
+"""
+Benchmark the opus loader on generated opuses of different sizes.
+
+For each size, an opus is generated (see generate_opus.py), and each phase
+of the loader is timed. The phases are then run again while tracing memory,
+to report the peak memory of each phase.
+
+Run from the core directory: pdm run benchmarks/bench_loader.py --sizes 100,1000,10000
+"""
+import argparse
+import asyncio
+import gc
+from pathlib import Path
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+import opus  # noqa: E402
+from generate_opus import generate_opus  # noqa: E402
+from screencrash_common.checksum_cache import ChecksumCache  # noqa: E402
+
+PHASES = ["yaml", "pick_actions", "scan_script", "load_actions", "load_asset", "load_nodes", "validate"]
+
+
+def run_phases(opus_path: Path, checksums: bool, measure: Callable) -> None:
+    """
+    Run the loader phases in the same order as compile_opus, but one at a time.
+
+    Parameters
+    ----------
+    opus_path
+        The opus to load
+    checksums
+        Whether to compute asset checksums (without cache)
+    measure
+        Called as measure(phase, function), and should return the function's result
+    """
+    opus_dict = measure("yaml", lambda: opus.read_yaml(opus_path))
+    nodes_dict = opus_dict["nodes"]
+
+    def pick_actions():
+        opus.fill_line_numbers(nodes_dict)
+        return opus.pick_inlined_node_actions(nodes_dict)
+    inlined_actions_dict = measure("pick_actions", pick_actions)
+    line_locations = measure(
+        "scan_script", lambda: opus.scan_script(opus_path.parent / opus_dict["assets"]["script"]["path"]))
+
+    def load_actions():
+        ui_config, inlined_actions_dict_ui = asyncio.run(opus.load_ui_config(opus_dict.get("ui")))
+        return (ui_config, *opus.load_actions(
+            {**opus_dict["action_templates"], **inlined_actions_dict, **inlined_actions_dict_ui}))
+    ui_config, action_templates, inlined_assets_dict = measure("load_actions", load_actions)
+
+    def load_assets():
+        references = opus.index_asset_references(action_templates)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # An empty cache, so everything is hashed
+            checksum_cache = ChecksumCache(Path(cache_dir)) if checksums else None
+
+            async def load_all():
+                return dict(await asyncio.gather(*[
+                    opus.load_asset(key, asset["path"], references.get(key, opus.AssetReferences()).targets,
+                                    opus_path, checksum_cache)
+                    for key, asset in [*opus_dict["assets"].items(), *inlined_assets_dict.items()]
+                ]))
+            assets = asyncio.run(load_all())
+            if checksum_cache:
+                checksum_cache.close()
+        return assets, references
+    assets, references = measure("load_asset", load_assets)
+
+    def load_nodes():
+        nodes = opus.load_nodes(nodes_dict, line_locations)
+        opus.add_node_references(references, nodes, action_templates)
+        return nodes
+    nodes = measure("load_nodes", load_nodes)
+
+    loaded_opus = opus.Opus(nodes, action_templates, assets, ui_config, opus_dict["startNode"], b"", references)
+    measure("validate", lambda: opus.validate_references(loaded_opus, exit_on_failure=False))
+
+
+def time_phases(opus_path: Path, checksums: bool) -> Dict[str, float]:
+    """Get the time of each phase in seconds."""
+    times = {}
+
+    def measure(phase, function):
+        start = time.perf_counter()
+        result = function()
+        times[phase] = time.perf_counter() - start
+        return result
+
+    run_phases(opus_path, checksums, measure)
+    return times
+
+
+def trace_phases(opus_path: Path, checksums: bool) -> Dict[str, int]:
+    """Get the peak memory allocated (on top of what was allocated before) in each phase, in bytes."""
+    peaks = {}
+
+    def measure(phase, function):
+        gc.collect()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks[phase] = peak - before
+        return result
+
+    tracemalloc.start()
+    try:
+        run_phases(opus_path, checksums, measure)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def time_load_opus(opus_path: Path, checksums: bool) -> float:
+    """Get the time of a full load_opus (without snapshot) in seconds."""
+    start = time.perf_counter()
+    asyncio.run(opus.load_opus(opus_path, checksums, exit_on_validation_failure=False, use_snapshot=False))
+    return time.perf_counter() - start
+
+
+def print_table(rows: List[Tuple[int, Dict[str, float], Dict[str, int], float]]):
+    header = f"{'nodes':>7} {'phase':<13} {'time (s)':>9} {'peak (MB)':>10}"
+    print(header)
+    print("-" * len(header))
+    for size, times, peaks, total in rows:
+        for phase in PHASES:
+            print(f"{size:>7} {phase:<13} {times[phase]:>9.3f} {peaks[phase] / 1e6:>10.1f}")
+        print(f"{size:>7} {'load_opus':<13} {total:>9.3f} {'':>10}")
+
+
+def main(sizes: List[int], checksums: bool, keep: bool):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            output_dir = Path(tmp_dir) / f"opus_{size}"
+            print(f"Generating opus with {size} nodes...", file=sys.stderr)
+            opus_path = generate_opus(output_dir, size, create_assets=checksums)
+            times = time_phases(opus_path, checksums)
+            peaks = trace_phases(opus_path, checksums)
+            total = time_load_opus(opus_path, checksums)
+            rows.append((size, times, peaks, total))
+            if keep:
+                print(f"Kept {opus_path}", file=sys.stderr)
+        if keep:
+            input("Press enter to remove the generated opuses...")
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000,50000",
+                        help="Comma separated numbers of nodes (default: %(default)s)")
+    parser.add_argument("--checksums", action="store_true", help="Also create and hash asset files")
+    parser.add_argument("--keep", action="store_true", help="Wait before removing the generated opuses")
+    args = parser.parse_args()
+    main([int(size) for size in args.sizes.split(",")], args.checksums, args.keep)
@@ -0,0 +1,94 @@
+"""
+Benchmark instantiation of parametrized action templates.
+
+Compares the compiled templates used by load_actions with evaluating every
+JSON path on a deep copy of the template for each instance (which is what
+load_actions used to do).
+
+Run from the core directory: pdm run benchmarks/bench_parametrized_actions.py
+"""
+import argparse
+from copy import deepcopy
+from pathlib import Path
+import sys
+import time
+
+import jsonpath_ng
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from parametrized_action import ParametrizedActionTemplate  # noqa: E402
+
+TEMPLATE = {
+    "parameters": {
+        "name": [{"path": "$[0].params.entityId"}, {"path": "$[1].params.entityId"}],
+        "file": [{"path": "$[0].assets[0].path"}],
+        "volume": [{"path": "$[1].params.volume"}],
+    },
+    "actions": [
+        {
+            "target": "audio",
+            "cmd": "create",
+            "assets": [{"path": "Sounds/$file.wav"}],
+            "params": {"entityId": "$name_audio", "autostart": True, "looping": 0},
+        },
+        {
+            "target": "audio",
+            "cmd": "set_volume",
+            "params": {"entityId": "$name_audio", "volume": 0},
+        },
+        {
+            "target": "image",
+            "cmd": "create",
+            "assets": [{"path": "Images/background.png"}],
+            "params": {"entityId": "background", "visible": True, "fadeIn": {"from": 0, "to": 1, "time": 2}},
+        },
+    ],
+}
+
+
+def instantiate_with_deepcopy(template, parameters):
+    """The previous implementation in load_actions."""
+    subactions_list = deepcopy(template.get("actions"))
+    for parameter, change_list in template.get("parameters", {}).items():
+        parameter_var = f"${parameter}"
+        for change_order in change_list:
+            expr = jsonpath_ng.parse(change_order["path"])
+            orig_value = expr.find(subactions_list)
+            if len(orig_value) > 0:
+                if type(orig_value[0].value) == str and parameter_var in orig_value[0].value:
+                    new_value = orig_value[0].value.replace(parameter_var, str(parameters[parameter]))
+                else:
+                    new_value = parameters[parameter]
+            else:
+                raise RuntimeError(f"Invalid JSON path for parameter: {change_order['path']}")
+            expr.update(subactions_list, new_value)
+    return subactions_list
+
+
+def main(instances: int):
+    all_parameters = [
+        {"name": f"sound{i}", "file": f"{i:04d} Sound", "volume": i % 100}
+        for i in range(instances)
+    ]
+
+    start = time.perf_counter()
+    expected = [instantiate_with_deepcopy(TEMPLATE, parameters) for parameters in all_parameters]
+    deepcopy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    template = ParametrizedActionTemplate("sound", TEMPLATE)
+    actual = [template.instantiate(parameters) for parameters in all_parameters]
+    compiled_time = time.perf_counter() - start
+
+    assert actual == expected, "Compiled template gives different actions"
+    print(f"{instances} instances of a template with {len(TEMPLATE['actions'])} actions:")
+    print(f"  deepcopy + jsonpath: {deepcopy_time * 1000:8.1f} ms")
+    print(f"  compiled template:   {compiled_time * 1000:8.1f} ms")
+    print(f"  speedup:             {deepcopy_time / compiled_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--instances", type=int, default=1000, help="Number of instances")
+    args = parser.parse_args()
+    main(args.instances)
@@ -0,0 +1,71 @@
+"""
+Benchmark the encodings of messages between Core and components.
+
+Encodes and decodes typical messages with JSON and with MessagePack (see
+screencrash_common/wire_codec.py), and reports the time per message and the frame size.
+The file message carries asset data, which JSON has to base64 encode.
+
+Run from the core directory: pdm run benchmarks/bench_wire_codec.py
+"""
+import argparse
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+from screencrash_common.wire_codec import JSON, MSGPACK, decode, decode_bytes, encode  # noqa: E402
+
+MESSAGES = {
+    "command": {
+        "command": "create",
+        "entityId": "sound42",
+        "channel": 1,
+        "asset": "resources/sounds/0042 Sound.mp3",
+        "volume": 80,
+        "autostart": True,
+    },
+    "component_info": {
+        "messageType": "component_info",
+        "componentId": "audio",
+        "componentName": "audio",
+        "status": "online",
+    },
+}
+
+
+def time_per_call(function: Callable[[], Any], iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations: int, file_size: int):
+    messages = {
+        **MESSAGES,
+        "file": {"command": "file", "path": "resources/sounds/0042 Sound.mp3", "data": os.urandom(file_size)},
+    }
+    for name, message in messages.items():
+        # Files are only sent a few times, so fewer iterations are enough
+        n = max(iterations // 1000, 10) if name == "file" else iterations
+        print(f"{name}:")
+        for encoding in [JSON, MSGPACK]:
+            frame = encode(message, encoding)
+            encode_time = time_per_call(lambda: encode(message, encoding), n)
+            if name == "file":
+                # Include getting the file data back, as the component does
+                decode_time = time_per_call(lambda: decode_bytes(decode(frame)["data"]), n)
+            else:
+                decode_time = time_per_call(lambda: decode(frame), n)
+            print(f"  {encoding:8} encode {encode_time * 1e6:10.1f} us, decode {decode_time * 1e6:10.1f} us, "
+                  f"{len(frame):9} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=100000, help="Iterations for small messages")
+    parser.add_argument("--file-size", type=int, default=4 * 1024 * 1024, help="Size of the file data in bytes")
+    args = parser.parse_args()
+    main(args.iterations, args.file_size)
@@ -0,0 +1,151 @@
+"""
+Generate a synthetic opus, with a script PDF and asset files, of a given size.
+
+Every node gets a line in the script and an action with an inlined asset.
+Some nodes branch, some use parametrized actions, and there are UI shortcuts.
+
+Run from the core directory: pdm run benchmarks/generate_opus.py <output dir> --nodes 1000
+"""
+import argparse
+from pathlib import Path
+from typing import Any, Dict
+
+import fitz
+import yaml
+
+LINES_PER_PAGE = 50
+# Where the line numbers end on even and odd pages
+LINE_NUMBER_ENDS = (60, 80)
+
+
+def generate_script(path: Path, nof_lines: int):
+    """Write a script PDF with numbered lines, like our real scripts."""
+    doc = fitz.open()
+    for first_line in range(1, nof_lines + 1, LINES_PER_PAGE):
+        page = doc.new_page()
+        line_number_end = LINE_NUMBER_ENDS[page.number % 2]
+        for i, line in enumerate(range(first_line, min(first_line + LINES_PER_PAGE, nof_lines + 1))):
+            y = 50 + i * 14
+            text = str(line)
+            width = fitz.get_text_length(text, fontsize=10)
+            page.insert_text((line_number_end - width, y), text, fontsize=10)
+            page.insert_text((100, y), f"ROLE {line % 7}: Something is said on this line.", fontsize=10)
+    doc.save(path)
+
+
+def generate_opus(output_dir: Path, nof_nodes: int, choice_every: int = 50, parametrized_every: int = 5,
+                  nof_shortcuts: int = 20, create_assets: bool = True) -> Path:
+    """
+    Generate an opus and everything it refers to.
+
+    Parameters
+    ----------
+    output_dir
+        Where to put the opus, script and assets
+    nof_nodes
+        Number of nodes
+    choice_every
+        Every n:th node branches into two choices
+    parametrized_every
+        Every n:th node runs an instance of a parametrized action
+    nof_shortcuts
+        Number of UI shortcuts
+    create_assets
+        Whether to create the asset files (small dummy files)
+
+    Returns
+    -------
+    The path to the opus file
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    generate_script(output_dir / "script.pdf", nof_nodes)
+
+    asset_paths = []
+    action_templates: Dict[str, Any] = {
+        "play_sound": {
+            "parameters": {
+                "name": [{"path": "$[0].params.entityId"}, {"path": "$[1].params.entityId"}],
+                "file": [{"path": "$[0].assets[0].path"}],
+            },
+            "actions": [
+                {"target": "audio", "cmd": "create", "assets": [{"path": "sounds/$file.wav"}],
+                 "params": {"entityId": "$name", "autostart": True}},
+                {"target": "audio", "cmd": "set_volume", "delay": 1, "params": {"entityId": "$name", "volume": 50}},
+            ],
+        },
+        "blackout": [
+            {"target": "image", "cmd": "destroy", "params": {"entityId": "background"}},
+            {"target": "internal", "cmd": "print", "params": {"text": "Blackout"}},
+        ],
+    }
+
+    nodes: Dict[str, Any] = {}
+    for line in range(1, nof_nodes + 1):
+        key = str(line)
+        image_path = f"images/{line:06d}.png"
+        asset_paths.append(image_path)
+        node: Dict[str, Any] = {
+            "prompt": f"Cue on line {line}",
+            "actions": [{"target": "image", "cmd": "create", "assets": [{"path": image_path}],
+                         "params": {"entityId": f"image_{line}", "visible": True}}],
+        }
+        if line % parametrized_every == 0:
+            action_id = f"sound_{line}"
+            action_templates[action_id] = {
+                "action": "play_sound",
+                "parameters": {"name": f"sound_{line}", "file": f"{line:06d}"},
+            }
+            asset_paths.append(f"sounds/{line:06d}.wav")
+            node["actions"].append(action_id)
+
+        next_key = str(line + 1) if line < nof_nodes else "1"
+        if line % choice_every == 0 and line + 2 <= nof_nodes:
+            node["next"] = [
+                {"node": next_key, "description": "Go on",
+                 "actions": [{"target": "internal", "cmd": "print", "params": {"text": f"Chose {next_key}"}}]},
+                {"node": str(line + 2), "description": "Skip a line"},
+            ]
+        else:
+            node["next"] = next_key
+        nodes[key] = node
+
+    shortcuts = []
+    for i in range(nof_shortcuts):
+        actions = ["blackout"] if i == 0 else [
+            {"target": "audio", "cmd": "stop", "params": {"entityId": f"sound_{i}"}}]
+        shortcuts.append({"title": f"Shortcut {i}", "hotkey": {"key": f"F{i + 1}", "modifiers": ["ctrl"]},
+                          "actions": actions})
+
+    opus = {
+        "startNode": "1",
+        "nodes": nodes,
+        "action_templates": action_templates,
+        "assets": {"script": {"path": "script.pdf"}},
+        "ui": {"shortcuts": shortcuts},
+    }
+    opus_path = output_dir / "opus.yaml"
+    with open(opus_path, mode="w", encoding="utf-8") as f:
+        yaml.dump(opus, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), allow_unicode=True, sort_keys=False)
+
+    if create_assets:
+        for asset_path in asset_paths:
+            path = output_dir / asset_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(asset_path.encode("utf-8") * 64)
+
+    return opus_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output_dir", type=Path, help="Where to put the opus")
+    parser.add_argument("-n", "--nodes", type=int, default=1000, help="Number of nodes")
+    parser.add_argument("--choice-every", type=int, default=50, help="Every n:th node branches")
+    parser.add_argument("--parametrized-every", type=int, default=5,
+                        help="Every n:th node uses a parametrized action")
+    parser.add_argument("--shortcuts", type=int, default=20, help="Number of UI shortcuts")
+    parser.add_argument("--no-assets", action="store_true", help="Don't create asset files")
+    args = parser.parse_args()
+    opus_path = generate_opus(args.output_dir, args.nodes, args.choice_every, args.parametrized_every,
+                              args.shortcuts, not args.no_assets)
+    print(f"Wrote {opus_path}")
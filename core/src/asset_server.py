@@ -0,0 +1,90 @@
+import asyncio
+from http import HTTPStatus
+import os
+from typing import Dict, Optional
+
+from websockets.datastructures import Headers
+
+from opus import Asset, Opus
+from peers.asset_sync import ASSETS_PATH, SyncScheduler
+from util.http_file import HTTPResponse, file_response
+
+
+class AssetServer:
+    """
+    Serves assets over HTTP by checksum, under /assets/<checksum>.
+
+    Components that can download files get a manifest of the assets they
+    don't have (see AssetSync) and fetch them from here. Since the URL of an
+    asset contains its checksum, the checksum is its ETag, and interrupted
+    downloads continue with range requests. The file is memory mapped for
+    each request, so several components can download the same asset without
+    Core reading it into memory. Each response is held in memory until it's
+    sent, so responses are at most MAX_RESPONSE_SIZE. Longer ranges get the
+    start of what they asked for, and larger assets can only be requested in
+    ranges.
+
+    The responses are limited by the concurrent transfers, rate limit and
+    pauses of the scheduler, which are waited for before the data is read.
+
+    Parameters
+    ----------
+    opus
+        The opus, with the assets to serve
+    scheduler
+        Coordinates the syncing of assets to all components
+    """
+
+    # The most data to send in one response
+    MAX_RESPONSE_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, opus: Opus, scheduler: SyncScheduler):
+        self._scheduler = scheduler
+        self._assets: Dict[str, Asset] = {}
+        self.opus_changed(opus)
+
+    def opus_changed(self, opus: Opus):
+        """Serve the assets of a new version of the opus."""
+        self._assets = {asset.checksum: asset for asset in opus.assets.values()
+                        if asset.file is not None and asset.checksum is not None}
+
+    async def process_http_request(self, path: str, request_headers: Headers) -> Optional[HTTPResponse]:
+        """
+        Serve HTTP requests for assets.
+
+        This is used as part of the process_request hook of the websocket server.
+
+        Parameters
+        ----------
+        path
+            The requested path
+        request_headers
+            The headers of the request
+
+        Returns
+        -------
+        The response, or None if the request is not for an asset
+        """
+        if not path.startswith(ASSETS_PATH):
+            return None
+        asset = self._assets.get(path[len(ASSETS_PATH):])
+        if asset is None:
+            return HTTPStatus.NOT_FOUND, Headers(), b""
+        status, headers, byte_range = file_response(request_headers, os.stat(asset.file).st_size, asset.checksum,
+                                                    "application/octet-stream", self.MAX_RESPONSE_SIZE)
+        if status == HTTPStatus.BAD_REQUEST:
+            message = f"Request at most {self.MAX_RESPONSE_SIZE} bytes at a time, with a Range header"
+            return status, headers, message.encode()
+        if byte_range is None:
+            return status, headers, b""
+        start, end = byte_range
+        async with self._scheduler.transfer():
+            await self._scheduler.before_send(None, end + 1 - start)
+            # Reading the file may wait for the disk, so don't block other connections
+            body = await asyncio.to_thread(self._read, asset, start, end)
+        return status, headers, body
+
+    @staticmethod
+    def _read(asset: Asset, start: int, end: int) -> bytes:
+        with asset.open_data() as data:
+            return bytes(data[start:end + 1])
@@ -1,12 +1,16 @@
 import asyncio
-import json
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import os
 from pathlib import Path
 import websockets
+from websockets.datastructures import Headers
 from websockets.server import WebSocketServerProtocol
+from screencrash_common.wire_codec import decode
 
-from opus import ActionTemplate, load_opus, get_action_desc
+from asset_server import AssetServer
+from opus import ActionTemplate, load_opus, get_action_desc, validate_references
+from opus_reload import diff_opus, watch_files
+from peers.asset_sync import SyncScheduler, SyncSettings
 from peers.component import ComponentPeer
 from peers.inventory import InventoryPeer
 from performance import Performance
@@ -15,6 +19,9 @@ from peers.media import MediaPeer
 from peers.ui import UI
 from peers.ledController import LedControllerPeer
 from peers.myggcheck import MyggCheckPeer
+from util.http_file import HTTPResponse
+from util.log_store import LogStore
+from util.outbound_queue import OutboundLimits, latency_report, mark_input
 
 
 class Core:
@@ -37,26 +44,60 @@ class Core:
         exit_on_validation_failure = (
             os.environ.get("SCREENCRASH_EXIT_ON_VALIDATION_FAILURE", "true") == "true"
         )
+        self._use_opus_snapshot = os.environ.get("SCREENCRASH_OPUS_SNAPSHOT", "true") == "true"
+        reload_opus = os.environ.get("SCREENCRASH_RELOAD_OPUS", "true") == "true"
+        ui_flush_interval = float(os.environ.get("SCREENCRASH_UI_FLUSH_INTERVAL_MS", "50")) / 1000
+        max_nof_logs = int(os.environ.get("SCREENCRASH_MAX_NOF_LOGS", LogStore.DEFAULT_CAPACITY))
+        log_file = os.environ.get("SCREENCRASH_LOG_FILE")
+        outbound_limits = OutboundLimits(
+            high_water_mark=int(os.environ.get("SCREENCRASH_OUTBOUND_HIGH_WATER_MARK", "256")),
+            evict_after=float(os.environ.get("SCREENCRASH_OUTBOUND_EVICT_AFTER", "10")),
+        )
+        sync_settings = SyncSettings(
+            chunk_size=int(os.environ.get("SCREENCRASH_SYNC_CHUNK_SIZE_KB", "1024")) * 1024,
+            window=int(os.environ.get("SCREENCRASH_SYNC_WINDOW", "4")),
+            delta=os.environ.get("SCREENCRASH_SYNC_DELTA", "true") == "true",
+            max_rate=_kbps_from_env("SCREENCRASH_SYNC_MAX_RATE_KBPS"),
+            component_max_rate=_kbps_from_env("SCREENCRASH_SYNC_COMPONENT_MAX_RATE_KBPS"),
+            max_concurrent=int(os.environ.get("SCREENCRASH_SYNC_MAX_CONCURRENT", "4")),
+            pause_after_advance=float(os.environ.get("SCREENCRASH_SYNC_PAUSE_AFTER_ADVANCE", "20")),
+        )
+        self._opus_path = Path(opus_file)
+        self._sync_assets = sync_assets
         print("Loading opus...")
         self._opus = await load_opus(
-            Path(opus_file),
+            self._opus_path,
             read_asset_data=sync_assets,
             exit_on_validation_failure=exit_on_validation_failure,
+            use_snapshot=self._use_opus_snapshot,
         )
         self._performance = Performance(self._opus)
-        self._ui = UI(self._opus, self._performance.history)
+        self._sync_scheduler = SyncScheduler(sync_settings, self._upcoming_assets)
+        self._asset_server = AssetServer(self._opus, self._sync_scheduler)
+        self._ui = UI(
+            self._opus,
+            self._performance.history,
+            ui_flush_interval,
+            LogStore(max_nof_logs, Path(log_file) if log_file else None),
+            outbound_limits,
+        )
         self._components: Dict[str, ComponentPeer] = {
             "internal": InternalPeer(sync_assets),
-            "media": MediaPeer(sync_assets),
-            "inventory": InventoryPeer(sync_assets),
-            "ledController": LedControllerPeer(),
-            "myggcheck": MyggCheckPeer(),
+            "media": MediaPeer(sync_assets, outbound_limits, self._sync_scheduler),
+            "inventory": InventoryPeer(sync_assets, outbound_limits, self._sync_scheduler),
+            "ledController": LedControllerPeer(outbound_limits),
+            "myggcheck": MyggCheckPeer(outbound_limits),
         }
         self._setup_events()
         self._distribute_assets()
+        if reload_opus:
+            asyncio.create_task(watch_files(self._get_opus_files, self._reload_opus, 1))
+        asyncio.create_task(self._report_input_latencies(60))
 
         print("Started!")
-        async with websockets.serve(self.socket_listener, "0.0.0.0", self._port):
+        # The UI fetches the script, and components fetch assets, over HTTP on the same port
+        async with websockets.serve(self.socket_listener, "0.0.0.0", self._port,
+                                    process_request=self._process_http_request):
             await asyncio.Future()  # run forever
 
     def _setup_events(self):
@@ -74,6 +115,10 @@ class Core:
         self._performance.add_event_listener(
             "history-changed", self._ui.changed_history
         )
+        self._performance.add_event_listener(
+            "history-changed",
+            lambda *_: self._sync_scheduler.performance_advanced(),
+        )
         self._performance.add_event_listener("run-action", self._run_action_by_id)
 
         for component in self._components.values():
@@ -90,11 +135,75 @@ class Core:
             component.add_event_listener("disconnected", self._ui.component_removed)
 
     def _distribute_assets(self):
-        for asset in self._opus.assets.values():
+        for asset_id, references in self._opus.asset_references.items():
+            asset = self._opus.assets.get(asset_id)
+            if asset is None:
+                continue  # Reported by the opus validation
             for component in self._components.values():
-                if any([component.handles_target(target) for target in asset.targets]):
+                if any(component.handles_target(target) for target in references.targets):
                     component.add_asset(asset)
 
+    def _upcoming_assets(self) -> Dict[str, int]:
+        """Find how many nodes ahead of the current node each asset is needed, by path."""
+        distances: Dict[str, int] = {self._performance.history[-1]: 0}
+        to_visit = [self._performance.history[-1]]
+        # Breadth first, so each node gets its shortest distance
+        for node_id in to_visit:
+            node = self._opus.nodes.get(node_id)
+            if node is None:
+                continue
+            if isinstance(node.next, str):
+                next_nodes = [node.next]
+            else:
+                next_nodes = [choice.node for choice in node.next or []]
+            for next_node in next_nodes:
+                if next_node not in distances:
+                    distances[next_node] = distances[node_id] + 1
+                    to_visit.append(next_node)
+        asset_distances: Dict[str, int] = {}
+        for asset_id, references in self._opus.asset_references.items():
+            asset = self._opus.assets.get(asset_id)
+            node_distances = [distances[node_id] for node_id in references.nodes if node_id in distances]
+            if asset is not None and node_distances:
+                asset_distances[asset.path] = min(node_distances)
+        return asset_distances
+
+    def _get_opus_files(self) -> List[Path]:
+        return [self._opus_path, self._opus_path.parent / self._opus.assets["script"].path]
+
+    async def _reload_opus(self):
+        print("Opus changed, reloading...")
+        try:
+            opus = await load_opus(
+                self._opus_path,
+                read_asset_data=self._sync_assets,
+                exit_on_validation_failure=False,
+                use_snapshot=self._use_opus_snapshot,
+                validate=False,
+            )
+        except Exception as e:
+            print(f"Failed to reload opus, keeping the running one: {e}")
+            return
+        if not validate_references(opus, exit_on_failure=False):
+            print("Reloaded opus is malformed, keeping the running one")
+            return
+
+        diff = diff_opus(self._opus, opus)
+        if diff.is_empty():
+            print("Reloaded opus is unchanged")
+            return
+        # Nothing here awaits, so no one sees a mix of the old and new opus
+        self._opus = opus
+        self._performance.opus_changed(opus)
+        self._ui.opus_changed(opus, diff)
+        self._asset_server.opus_changed(opus)
+        self._sync_scheduler.opus_changed()
+        if diff.changed_assets or diff.removed_assets:
+            for component in self._components.values():
+                component.clear_assets()
+            self._distribute_assets()
+        print(f"Reloaded opus: {diff.summary()}")
+
     def _run_action_by_id(self, action_id):
         try:
             action = self._opus.action_templates[action_id]
@@ -114,6 +223,8 @@ class Core:
             print(f"Will do '{get_action_desc(action)}' in {action.delay}s")
             await asyncio.sleep(action.delay)
             print(f"Doing '{get_action_desc(action)}'")
+            # Measure the latency of delayed actions from when they are due
+            mark_input()
         handled = False
         assets = [self._opus.assets[key] for key in action.assets]
         for peer in self._components.values():
@@ -131,6 +242,36 @@ class Core:
         for subaction in action.subactions:
             asyncio.create_task(self._run_action(subaction))
 
+    async def _report_input_latencies(self, interval: float):
+        """
+        Print the latencies from UI input until messages are written, and the
+        queues to the components, when they have changed.
+        """
+        last_report = latency_report()
+        # The depth and dropped messages of each queue. Lag and waits change
+        # with every message, so they don't count as a change.
+        last_queue_states: List[Tuple[str, int, Dict[str, int]]] = []
+        while True:
+            await asyncio.sleep(interval)
+            report = latency_report()
+            if report != last_report:
+                print(f"Input latencies: {report}")
+                last_report = report
+            queues = [queue for peer in self._components.values() for queue in peer.queues()]
+            queue_states = [(queue.name, queue.depth, dict(queue.dropped)) for queue in queues]
+            if queue_states != last_queue_states:
+                print("Component queues:")
+                for queue in queues:
+                    print(f"  {queue.report()}")
+                last_queue_states = queue_states
+
+    async def _process_http_request(self, path: str, request_headers: Headers) -> Optional[HTTPResponse]:
+        """Serve HTTP requests, or return None if the request is for a websocket."""
+        response = await self._asset_server.process_http_request(path, request_headers)
+        if response is None:
+            response = await self._ui.process_http_request(path, request_headers)
+        return response
+
     def _reset_component(self, component_id: str):
         for peer in self._components.values():
             if peer.has_component(component_id):
@@ -152,10 +293,10 @@ class Core:
         """
         # Wait for a hello
         message = await websocket.recv()
-        message_dict = json.loads(message)
+        message_dict = decode(message)
         client_type = message_dict["client"]
         if client_type == "ui":
-            await self._ui.handle_socket(websocket)
+            await self._ui.handle_socket(websocket, message_dict)
         elif client_type in self._components:
             print(f"Accepted client of type {client_type}")
             await self._components[client_type].handle_socket(websocket, message_dict)
@@ -163,6 +304,12 @@ class Core:
             print(f"An unsupported client type tried to connect: {client_type}")
 
 
+def _kbps_from_env(name: str) -> Optional[float]:
+    """Read a rate in KiB/s from an environment variable, as bytes per second. Unset means no limit."""
+    value = os.environ.get(name)
+    return float(value) * 1024 if value else None
+
+
 if __name__ == "__main__":
     core = Core(8001)
     try:
@@ -1,25 +1,58 @@
 from __future__ import annotations
 import asyncio
-from dataclasses import dataclass, field
-import hashlib
-from typing import Any, Dict, List, Optional, Tuple, Union
-from copy import deepcopy
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 from pathlib import Path
+import mmap
+import os
 import re
 import sys
 import aiofiles
 import fitz
 import yaml
-import jsonpath_ng
+from screencrash_common.checksum_cache import ChecksumCache
+
+from opus_snapshot import load_snapshot, save_snapshot
+from parametrized_action import ParametrizedActionTemplate, copy_json
+from util.stage_timer import StageTimer
 
 
 @dataclass
 class Asset:
-    """An asset contains a resource"""
+    """
+    An asset contains a resource.
+
+    The contents are not kept in memory. If the asset is read (for syncing),
+    file is set and the contents can be accessed with open_data.
+    """
     path: str
-    data: Optional[bytes]
     checksum: Optional[str]
     targets: List[str]
+    file: Optional[Path] = None
+
+    @contextmanager
+    def open_data(self) -> Iterator[Union[memoryview, bytes]]:
+        """
+        Memory map the asset file while it is being used.
+
+        The pages are read from disk as they are accessed, and the OS can drop
+        them again once the mapping is closed, so the resident memory of Core
+        doesn't grow with the number or size of assets.
+        """
+        if self.file is None:
+            raise RuntimeError(f"Asset {self.path} has no data")
+        with open(self.file, mode="rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""  # Empty files can't be memory mapped
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
 
 
 @dataclass
@@ -54,6 +87,14 @@ class Node:
     lineNumber: Optional[int] = None
 
 
+@dataclass
+class AssetReferences:
+    """Where an asset is used in the opus"""
+    targets: Set[str] = field(default_factory=set)
+    actions: Set[str] = field(default_factory=set)
+    nodes: Set[str] = field(default_factory=set)
+
+
 @dataclass
 class UIShortcut:
     title: str
@@ -74,73 +115,307 @@ class Opus:
     ui_config: UIConfig
     start_node: str
     script: bytes
+    asset_references: Dict[str, AssetReferences] = field(default_factory=dict)
+
+
+@dataclass
+class ScriptNumber:
+    """A number starting a line in the left margin of the script PDF, where line numbers are printed"""
+    number: int
+    page: int
+    x1: float
+    pdfLocationOnPage: float
+
+
+class ScriptIndex:
+    """
+    An index of the numbers that start lines in the left margin of the script PDF.
 
+    The words of every page are extracted once, so finding line numbers
+    doesn't require searching the document again.
+
+    Parameters
+    ----------
+    doc
+        The script PDF
+    """
 
-async def load_opus(opus_path: Path, read_asset_data: bool, exit_on_validation_failure: bool):
-    """Load an opus from a file."""
+    # Line numbers may be joined to the text after them in the same word (e.g. "12HAMLET")
+    NUMBER_PATTERN = re.compile(r"[0-9]+")
+    # The part of the page width where line numbers can be
+    MARGIN_WIDTH = 0.25
+
+    def __init__(self, doc: fitz.Document):
+        self.numbers: List[ScriptNumber] = []
+        for page in doc:
+            height = page.rect.y1
+            margin_end = page.rect.x0 + page.rect.width * self.MARGIN_WIDTH
+            text_page = page.get_textpage()
+            # The characters in the margin, found if a number is joined to other text
+            margin_chars: Optional[List[Tuple[float, float, float, float]]] = None
+            for x0, y0, x1, y1, text, _block, _line, word_number in page.get_text("words", textpage=text_page):
+                if word_number != 0 or x0 >= margin_end:
+                    continue
+                match = self.NUMBER_PATTERN.match(text)
+                if match is None:
+                    continue
+                if match.end() < len(text):
+                    # The word is wider than the number, so find where the number's last character ends
+                    if margin_chars is None:
+                        margin_chars = self._margin_chars(page, text_page, margin_end)
+                    word_chars = sorted((char for char in margin_chars
+                                         if x0 <= (char[0] + char[2]) / 2 <= x1
+                                         and y0 <= (char[1] + char[3]) / 2 <= y1))
+                    if len(word_chars) < match.end():
+                        continue
+                    x1 = word_chars[match.end() - 1][2]
+                if x1 < margin_end:
+                    self.numbers.append(ScriptNumber(int(match.group()), page.number, x1, (y0 + y1) / 2 / height))
+
+    @staticmethod
+    def _margin_chars(page: fitz.Page, text_page: fitz.TextPage,
+                      margin_end: float) -> List[Tuple[float, float, float, float]]:
+        """Get the bounding boxes of the characters that start in the left margin of a page."""
+        chars = []
+        for block in page.get_text("rawdict", textpage=text_page)["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    chars.extend(tuple(char["bbox"]) for char in span["chars"] if char["bbox"][0] < margin_end)
+        return chars
+
+    def line_locations(
+        self, line_number_ends: Tuple[Tuple[float, float], Tuple[float, float]]
+    ) -> Dict[int, Tuple[int, float]]:
+        """
+        Find where each line number is in the script.
+
+        Parameters
+        ----------
+        line_number_ends
+            Ranges of x coordinates where line numbers end, see find_line_number_ends
+
+        Returns
+        -------
+        A dict from line number to (page, location on page). If a line number
+        occurs several times, the first occurrence is used.
+        """
+        locations = {}
+        for word in self.numbers:
+            if word.number not in locations and any(
+                start < word.x1 < end for start, end in line_number_ends
+            ):
+                locations[word.number] = (word.page, word.pdfLocationOnPage)
+        return locations
+
+
+async def load_opus(opus_path: Path, read_asset_data: bool, exit_on_validation_failure: bool,
+                    use_snapshot: bool = True, validate: bool = True):
+    """
+    Load an opus from a file.
+
+    If use_snapshot is set, a compiled snapshot of the opus is used when it is
+    up to date, and written when it isn't. See compile_opus.
+
+    If validate is not set, the caller should call validate_references.
+    """
+    parent = opus_path.parent
+    opus = load_snapshot(opus_path, read_asset_data) if use_snapshot else None
+    if opus is None:
+        opus = await compile_opus(opus_path, read_asset_data)
+        if use_snapshot:
+            save_snapshot(opus_path, strip_opus_data(opus), local_asset_paths(opus), read_asset_data)
+    else:
+        print("Using compiled opus snapshot")
+
+    async with aiofiles.open(parent / opus.assets["script"].path, mode="rb") as f:
+        opus.script = await f.read()
+
+    if validate:
+        validate_references(opus, exit_on_validation_failure)
+    return opus
+
+
+async def compile_opus(opus_path: Path, read_asset_data: bool) -> Opus:
+    """
+    Parse an opus file and resolve everything in it.
+
+    This finds node locations in the script, expands parametrized and inlined
+    actions and finds asset targets (and checksums, if read_asset_data is set).
+    The script itself is not read.
+
+    The blocking work runs in threads, and scanning the script runs at the
+    same time as the assets are read, so the slowest stage bounds the total time.
+    """
+    timer = StageTimer("Compiling opus")
     parent = opus_path.parent
-    async with aiofiles.open(opus_path, mode="r", encoding="utf-8") as f:
-        opus_string = await f.read()
-        opus_dict = yaml.safe_load(opus_string)
-        nodes, inlined_actions_dict = await load_nodes(opus_dict["nodes"], parent / opus_dict["assets"]["script"]["path"])
+    opus_dict = await timer.run("yaml", asyncio.to_thread(read_yaml, opus_path))
+    nodes_dict = opus_dict["nodes"]
+    script_path = parent / opus_dict["assets"]["script"]["path"]
+
+    fill_line_numbers(nodes_dict)
+    if any("pdfPage" not in node or "pdfLocationOnPage" not in node for node in nodes_dict.values()):
+        script_scan = asyncio.create_task(timer.run("script", asyncio.to_thread(scan_script, script_path)))
+    else:
+        script_scan = None
+
+    try:
+        inlined_actions_dict = pick_inlined_node_actions(nodes_dict)
         ui_config, inlined_actions_dict_ui = await load_ui_config(opus_dict.get("ui"))
         action_templates, inlined_assets_dict = load_actions(
             {**opus_dict["action_templates"], **inlined_actions_dict, **inlined_actions_dict_ui})
-        assets = dict(await asyncio.gather(
-            *[load_asset(key, asset["path"], action_templates, opus_path, read_asset_data)
-              for key, asset in [*opus_dict["assets"].items(), *inlined_assets_dict.items()]]
-        ))
+        asset_references = index_asset_references(action_templates)
+        checksum_cache = ChecksumCache(parent) if read_asset_data else None
+        try:
+            assets = dict(await timer.run("assets", asyncio.gather(
+                *[load_asset(key, asset["path"], asset_references.get(key, AssetReferences()).targets,
+                             opus_path, checksum_cache)
+                  for key, asset in [*opus_dict["assets"].items(), *inlined_assets_dict.items()]]
+            )))
+        finally:
+            if checksum_cache:
+                checksum_cache.close()
+                print(checksum_cache.report())
         if assets.get("script") is None:
             raise RuntimeError(
                 "Warning: Asset 'script' not found. This is required.")
         start_node = opus_dict["startNode"]
+        nodes = load_nodes(nodes_dict, await script_scan if script_scan else {})
+        add_node_references(asset_references, nodes, action_templates)
+    finally:
+        if script_scan and not script_scan.done():
+            script_scan.cancel()
 
-    async with aiofiles.open(parent / assets["script"].path, mode="rb") as f:
-        script = await f.read()
+    print(timer.report())
+    return Opus(nodes, action_templates, assets, ui_config, start_node, b"", asset_references)
 
-    opus = Opus(nodes, action_templates, assets, ui_config, start_node, script)
-    validate_references(opus, exit_on_validation_failure)
-    return opus
 
+def read_yaml(path: Path) -> Any:
+    """Read and parse a YAML file, using the C parser if it is available."""
+    with open(path, mode="r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def scan_script(script_path: Path) -> Dict[int, Tuple[int, float]]:
+    """
+    Find the locations of all line numbers in the script PDF.
+
+    Parameters
+    ----------
+    script_path
+        Path to the script PDF
 
-async def load_asset(key: str, path: str, action_templates: Dict[str, ActionTemplate], opus_path: Path, read_asset_data: bool):
+    Returns
+    -------
+    A dict from line number to (page, location on page), see ScriptIndex.line_locations
+    """
+    with fitz.open(script_path) as doc:
+        index = ScriptIndex(doc)
+    return index.line_locations(find_line_number_ends(index))
+
+
+def is_local_path(path: str) -> bool:
+    """Check whether an asset path refers to a local file (as opposed to a URL)."""
+    return not path.startswith("http://") and not path.startswith("https://")
+
+
+def local_asset_paths(opus: Opus) -> List[str]:
+    """Get the paths of all assets in the opus that are local files."""
+    return [asset.path for asset in opus.assets.values() if is_local_path(asset.path)]
+
+
+def strip_opus_data(opus: Opus) -> Opus:
+    """Get a copy of the opus without the script."""
+    return replace(opus, script=b"")
+
+
+async def load_asset(key: str, path: str, targets: Set[str], opus_path: Path,
+                     checksum_cache: Optional[ChecksumCache]):
     """
     Load an asset from a file.
 
     Parameters
     ----------
     key
-        The ID of the asset. Used for checking where it is used.
+        The ID of the asset
     path
         The path to the file, relative to the opus path
-    action_templates
-        All action templates in the opus. Used for checking where the asset is used.
+    targets
+        The targets of all actions using the asset, see index_asset_references
     opus_path
         The path to the opus file
-    read_asset_data
-        Whether to read the asset data from the file
+    checksum_cache
+        Cache for computing the asset checksum. If None, the asset is not
+        prepared for syncing.
 
     Returns
     -------
     A list of tuples (key, asset)
     """
-    def fill_targets_from_action(action, result):
-        if key in action.assets:
-            result.add(action.target)
+    file = None
+    checksum = None
+    if checksum_cache and is_local_path(path):
+        file = opus_path.parent.resolve() / path
+        checksum = await checksum_cache.checksum_async(file)
+    return (key, Asset(path=path, checksum=checksum, targets=targets, file=file))
+
+
+def index_asset_references(action_templates: Dict[str, ActionTemplate]) -> Dict[str, AssetReferences]:
+    """
+    Find where all assets are used, in one pass over the actions.
+
+    Parameters
+    ----------
+    action_templates
+        All action templates in the opus
+
+    Returns
+    -------
+    A dict from asset ID to the targets and action templates using it.
+    Subactions are counted as their top-level action template. Node references
+    are added by add_node_references.
+    """
+    references: Dict[str, AssetReferences] = {}
+
+    def add_action(action_id: str, action: ActionTemplate):
+        for asset in action.assets:
+            asset_references = references.setdefault(asset, AssetReferences())
+            asset_references.targets.add(action.target)
+            asset_references.actions.add(action_id)
         for subaction in action.subactions:
-            fill_targets_from_action(subaction, result)
+            add_action(action_id, subaction)
 
-    targets = set()
-    for action in action_templates.values():
-        fill_targets_from_action(action, targets)
+    for action_id, action in action_templates.items():
+        add_action(action_id, action)
+    return references
 
-    data = None
-    checksum = None
-    if read_asset_data and not path.startswith("http://") and not path.startswith("https://"):
-        async with aiofiles.open(opus_path.parent / path, mode="rb") as f:
-            data = await f.read()
-        checksum = hashlib.md5(data).hexdigest()
-    return (key, Asset(path=path, data=data, checksum=checksum, targets=targets))
+
+def add_node_references(references: Dict[str, AssetReferences], nodes: Dict[str, Node],
+                        action_templates: Dict[str, ActionTemplate]):
+    """
+    Add the nodes using each asset to an index from index_asset_references.
+
+    Parameters
+    ----------
+    references
+        The index to add to
+    nodes
+        All nodes in the opus
+    action_templates
+        All action templates in the opus
+    """
+    assets_by_action: Dict[str, Set[str]] = {}
+    for asset, asset_references in references.items():
+        for action_id in asset_references.actions:
+            assets_by_action.setdefault(action_id, set()).add(asset)
+
+    for node_id, node in nodes.items():
+        action_ids = list(node.actions)
+        if isinstance(node.next, list):
+            for choice in node.next:
+                action_ids.extend(choice.actions)
+        for action_id in action_ids:
+            for asset in assets_by_action.get(action_id, ()):
+                references[asset].nodes.add(node_id)
 
 
 def is_parametrized_action(action_dict: dict) -> bool:
@@ -189,7 +464,7 @@ def get_action_desc(action: ActionTemplate) -> str:
 
 
 def create_action_and_inline_assets(action_dict: Dict[str, dict], key: str, assets: Dict[str, str]) -> ActionTemplate:
-    typed_action_dict = deepcopy(action_dict)
+    typed_action_dict = copy_json(action_dict)
     if "assets" in typed_action_dict:
         for i, asset in enumerate(typed_action_dict["assets"]):
             if isinstance(asset, dict):
@@ -213,6 +488,8 @@ def load_actions(actions_dict: Dict[str, dict]) -> Tuple[Dict[str, ActionTemplat
     """
     parametrized_action_templates = dict(filter(lambda action_tuple: is_parametrized_action(action_tuple[1]), actions_dict.items()))
     param_action_template_indexes = {}
+    # Templates are compiled when first used
+    compiled_templates: Dict[str, ParametrizedActionTemplate] = {}
 
     actions = {}
     assets = {}
@@ -238,23 +515,14 @@ def load_actions(actions_dict: Dict[str, dict]) -> Tuple[Dict[str, ActionTemplat
         elif "action" in action_data:
             # Parameterized action
             action_dict = action_data
-            template = parametrized_action_templates.get(action_dict["action"])
+            template = compiled_templates.get(action_dict["action"])
             if not template:
-                raise RuntimeError(f"Could not find parametrized action template {action_dict['action']}")
-            subactions_list = deepcopy(template.get("actions"))
-            for parameter, change_list in template.get("parameters", {}).items():
-                parameter_var = f"${parameter}"
-                for change_order in change_list:
-                    expr = jsonpath_ng.parse(change_order["path"])
-                    orig_value = expr.find(subactions_list)
-                    if len(orig_value) > 0:
-                        if type(orig_value[0].value) == str and parameter_var in orig_value[0].value:
-                            new_value = orig_value[0].value.replace(parameter_var, str(action_dict["parameters"][parameter]))
-                        else:
-                            new_value = action_dict["parameters"][parameter]
-                    else:
-                        raise RuntimeError(f"Invalid JSON path for parameter: {change_order['path']}")
-                    expr.update(subactions_list, new_value)
+                template_dict = parametrized_action_templates.get(action_dict["action"])
+                if not template_dict:
+                    raise RuntimeError(f"Could not find parametrized action template {action_dict['action']}")
+                template = ParametrizedActionTemplate(action_dict["action"], template_dict)
+                compiled_templates[action_dict["action"]] = template
+            subactions_list = template.instantiate(action_dict.get("parameters", {}))
 
             subactions = []
             action_index = param_action_template_indexes.get(action_dict["action"], 1)
@@ -277,28 +545,18 @@ def load_actions(actions_dict: Dict[str, dict]) -> Tuple[Dict[str, ActionTemplat
     return actions, assets
 
 
-async def load_nodes(nodes_dict: Dict[str, dict], script_path: Path) -> Tuple[Dict[str, Node], Dict[str, dict]]:
+def fill_line_numbers(nodes_dict: Dict[str, dict]):
     """
-    Load the nodes, find their locations on the page, and pick out inlined actions.
+    Give line numbers to nodes that don't already have a defined lineNumber.
 
-    If a node does not already have a defined lineNumber, it will be given one.
-    Then we assume the node ID begins with the line number, e.g. "12" or "13a".
-
-    If a node does not already have defined pdfPage and pdfLocationOnPage,
-    we will try to find it in the PDF based on the line number.
+    We assume the node ID begins with the line number, e.g. "12" or "13a".
+    Nodes without such an ID are left without line number.
 
     Parameters
     ----------
     nodes_dict
-        The nodes from the opus file
-    script_path
-        Path to the script PDF
-
-    Returns
-    -------
-    The nodes and the inlined actions
+        The nodes from the opus file. These are modified.
     """
-    # Get line numbers
     for key, node in nodes_dict.items():
         if "lineNumber" not in node:
             try:
@@ -307,103 +565,101 @@ async def load_nodes(nodes_dict: Dict[str, dict], script_path: Path) -> Tuple[Di
             except AttributeError:
                 pass  # lineNumber is not mandatory
 
-    doc = fitz.open(script_path)
-    first_page_line_number_end, second_page_line_number_end = find_line_number_ends(doc)
-    # Get all node keys where we need to discover the location.
-    node_keys = [
-        key for key, value in nodes_dict.items()
-        if "pdfPage" not in value or "pdfLocationOnPage" not in value
-    ]
-    if len(node_keys) > 0:
-        try:
-            with_line_numbers = [(key, nodes_dict[key]["lineNumber"])
-                                 for key in node_keys]
-        except KeyError:
-            raise RuntimeError(
-                "Nodes without specified PDF locations must have IDs beginning with numbers, "
-                "or defined lineNumber. "
-                f"Offenders: {[key for key in node_keys if 'lineNumber' not in nodes_dict[key]]}"
-            )
-        sorted_keys_and_numbers = sorted(
-            with_line_numbers, key=lambda x: int(x[1]))
-        next_pair = sorted_keys_and_numbers.pop(0)
-        # Searching for e.g. "12" will find both "12" and "112". Since the wanted line numbers
-        # are sorted, the first occurrence we find is correct.
-        for page in doc:
-            while True:
-                key, line_number = next_pair
-                found = [
-                    rect for rect in page.search_for(str(line_number))
-                    if (first_page_line_number_end[0] < rect.x1 < first_page_line_number_end[1])
-                    or (second_page_line_number_end[0] < rect.x1 < second_page_line_number_end[1])
-                ]
-                if len(found) == 0:
-                    # We won't find anything more on this page, since the wanted line numbers are sorted
-                    break
-                nodes_dict[key]["pdfPage"] = page.number
-                y = (found[0].y0 + found[0].y1) / 2
-                nodes_dict[key]["pdfLocationOnPage"] = y / page.rect.y1
-                if len(sorted_keys_and_numbers) == 0:
-                    next_pair = None
-                    break
-                next_pair = sorted_keys_and_numbers.pop(0)
-            if next_pair is None:
-                break
-
-    # Convert nodes from dicts to Node objects, and pick out all inlined actions.
-    # We make up action IDs.
-    nodes = {}
+
+def pick_inlined_node_actions(nodes_dict: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Pick out all inlined actions from the nodes, replacing them with made up action IDs.
+
+    Parameters
+    ----------
+    nodes_dict
+        The nodes from the opus file. These are modified.
+
+    Returns
+    -------
+    The inlined actions
+    """
     actions_dict = {}
     for key, node in nodes_dict.items():
-        typed_node = node.copy()
-        if isinstance(typed_node.get("next"), list):
-            for i, choice in enumerate(typed_node["next"]):
+        if isinstance(node.get("next"), list):
+            for i, choice in enumerate(node["next"]):
                 if "actions" in choice:
                     for j, action in enumerate(choice["actions"]):
                         if isinstance(action, dict):
                             action_id = f"{key}_choice_{i}_action_{j}"
                             actions_dict[action_id] = action
                             choice["actions"][j] = action_id
-                typed_node["next"][i] = NodeChoice(**choice)
-        if "actions" in typed_node:
-            for i, action in enumerate(typed_node["actions"]):
+        if "actions" in node:
+            for i, action in enumerate(node["actions"]):
                 if isinstance(action, dict):
                     action_id = f"{key}_action_{i}"
                     actions_dict[action_id] = action
-                    typed_node["actions"][i] = action_id
+                    node["actions"][i] = action_id
+    return actions_dict
+
+
+def load_nodes(nodes_dict: Dict[str, dict], line_locations: Dict[int, Tuple[int, float]]) -> Dict[str, Node]:
+    """
+    Load the nodes and give them their locations on the page.
+
+    If a node does not already have defined pdfPage and pdfLocationOnPage,
+    it is located in the PDF based on its line number (see fill_line_numbers).
+    Inlined actions should already be picked out (see pick_inlined_node_actions).
+
+    Parameters
+    ----------
+    nodes_dict
+        The nodes from the opus file
+    line_locations
+        Locations of line numbers in the script, see scan_script
 
+    Returns
+    -------
+    The nodes
+    """
+    # Get all node keys where we need to discover the location.
+    node_keys = {
+        key for key, value in nodes_dict.items()
+        if "pdfPage" not in value or "pdfLocationOnPage" not in value
+    }
+    offenders = [key for key in node_keys if "lineNumber" not in nodes_dict[key]]
+    if offenders:
+        raise RuntimeError(
+            "Nodes without specified PDF locations must have IDs beginning with numbers, "
+            "or defined lineNumber. "
+            f"Offenders: {offenders}"
+        )
+
+    nodes = {}
+    for key, node in nodes_dict.items():
+        typed_node = node.copy()
+        if key in node_keys:
+            location = line_locations.get(int(node["lineNumber"]))
+            if location is not None:
+                typed_node["pdfPage"], typed_node["pdfLocationOnPage"] = location
+        if isinstance(typed_node.get("next"), list):
+            typed_node["next"] = [NodeChoice(**choice) for choice in typed_node["next"]]
         nodes[key] = Node(**typed_node)
 
-    return nodes, actions_dict
-
-def find_line_number_ends(doc: fitz.Document) -> Tuple[Tuple[float, float], Tuple[float, float]]:
-    # Find the x coordinates where the line numbers end by finding enough
-    # numbers on the pages. Skip one-digit numbers since they appear in
-    # larger numbers too often. We select the most common end coordinates,
-    # so there can be some anomalies.
-    line_numbers_to_find = list(range(10, 100))
-    all_found_number_rects = []
-    line_number = line_numbers_to_find.pop(0)
-    for page in doc:
-        while True:
-            found_instances = page.search_for(str(line_number))
-            all_found_number_rects.extend(found_instances)
-            if len(found_instances) > 0 and len(line_numbers_to_find) > 0:
-                line_number = line_numbers_to_find.pop(0)
-            else:
-                break
-        if len(line_numbers_to_find) == 0:
-            break
-    end_coords = [rect.x1 for rect in all_found_number_rects]
-    most_common = max(set(end_coords), key=end_coords.count)
-    all_except_most_common = [x for x in end_coords if x != most_common]
-    second_most_common = max(set(all_except_most_common), key=all_except_most_common.count)
+    return nodes
+
+def find_line_number_ends(index: ScriptIndex) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    # Find the x coordinates where the line numbers end by looking at where
+    # the numbers in the index (which start lines in the left margin) end. Skip one-digit numbers
+    # since they appear in the text too often. We select the most common end
+    # coordinates, so there can be some anomalies.
+    end_coords = Counter(word.x1 for word in index.numbers if word.number >= 10)
+    most_common = [x1 for x1, _ in end_coords.most_common(2)]
+    if len(most_common) == 0:
+        raise RuntimeError("Could not find any line numbers in the script")
+    if len(most_common) == 1:
+        most_common.append(most_common[0])
 
     # Return ranges for the end-coordinates of numbers on odd and even pages.
     # The order does not matter.
     return (
-        (most_common - 0.5, most_common + 0.5),
-        (second_most_common - 0.5, second_most_common + 0.5)
+        (most_common[0] - 0.5, most_common[0] + 0.5),
+        (most_common[1] - 0.5, most_common[1] + 0.5)
     )
 
 def get_shortcut_key(hotkey: dict) -> str:
@@ -441,11 +697,11 @@ async def load_ui_config(ui_config: Optional[Dict[str, Any]]) -> Tuple[UIConfig,
     return (UIConfig(shortcuts), actions_dict)
 
 
-def validate_references(opus: Opus, exit_on_failure: bool):
+def validate_references(opus: Opus, exit_on_failure: bool) -> bool:
     """
     Validate that we only refer to existing nodes, assets and actions.
 
-    Exits the program if validation fails.
+    Exits the program if validation fails and exit_on_failure is set.
 
     Parameters
     ----------
@@ -453,7 +709,12 @@ def validate_references(opus: Opus, exit_on_failure: bool):
         The opus
     exit_on_failure
         Whether to exit the program if validation fails
+
+    Returns
+    -------
+    Whether the opus is valid
     """
+    valid = True
     # Nodes
     referred_nodes = set([opus.start_node])
     for node in opus.nodes.values():
@@ -466,6 +727,7 @@ def validate_references(opus: Opus, exit_on_failure: bool):
     if referred_nodes != actual_nodes:
         nonexistent_nodes = referred_nodes - actual_nodes
         unreferred_nodes = actual_nodes - referred_nodes
+        valid = False
         print("Malformed opus!")
         if nonexistent_nodes:
             print("References to nonexistent nodes:")
@@ -479,12 +741,12 @@ def validate_references(opus: Opus, exit_on_failure: bool):
 
     # Assets
     referred_assets = set(["script"])
-    for action in opus.action_templates.values():
-        referred_assets.update(set(action.assets))
+    referred_assets.update(opus.asset_references.keys())
     actual_assets = set(opus.assets.keys())
     if referred_assets != actual_assets:
         nonexistent_assets = referred_assets - actual_assets
         unreferred_assets = actual_assets - referred_assets
+        valid = False
         print("Malformed opus!")
         if nonexistent_assets:
             print("References to nonexistent assets:")
@@ -524,6 +786,7 @@ def validate_references(opus: Opus, exit_on_failure: bool):
     if referred_actions != actual_actions:
         nonexistent_actions = referred_actions - actual_actions
         unreferred_actions = actual_actions - referred_actions
+        valid = False
         print("Malformed opus!")
         if nonexistent_actions:
             print("References to nonexistent actions:")
@@ -545,9 +808,12 @@ def validate_references(opus: Opus, exit_on_failure: bool):
         if shortcut.hotkey in DISALLOWED_HOTKEYS:
             used_disallowed_hotkeys.append(f"  {shortcut.title} ({shortcut.hotkey})")
     if used_disallowed_hotkeys:
+        valid = False
         print("Malformed opus!")
         print("Illegal hotkeys used:")
         print("\n".join(used_disallowed_hotkeys))
         if exit_on_failure:
             print("Aborting!")
             sys.exit(1)
+
+    return valid
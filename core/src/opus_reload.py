@@ -0,0 +1,120 @@
+import asyncio
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Set
+
+from opus import Opus
+from opus_snapshot import file_stamp
+
+
+@dataclass
+class OpusDiff:
+    """What differs between two versions of an opus"""
+    changed_nodes: Set[str] = field(default_factory=set)
+    removed_nodes: Set[str] = field(default_factory=set)
+    changed_actions: Set[str] = field(default_factory=set)
+    removed_actions: Set[str] = field(default_factory=set)
+    changed_assets: Set[str] = field(default_factory=set)
+    removed_assets: Set[str] = field(default_factory=set)
+    ui_config_changed: bool = False
+    start_node_changed: bool = False
+    script_changed: bool = False
+
+    def is_empty(self) -> bool:
+        return not (
+            self.changed_nodes or self.removed_nodes
+            or self.changed_actions or self.removed_actions
+            or self.changed_assets or self.removed_assets
+            or self.ui_config_changed or self.start_node_changed or self.script_changed
+        )
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.changed_nodes)} nodes changed, {len(self.removed_nodes)} removed; "
+            f"{len(self.changed_actions)} actions changed, {len(self.removed_actions)} removed; "
+            f"{len(self.changed_assets)} assets changed, {len(self.removed_assets)} removed"
+            + ("; UI config changed" if self.ui_config_changed else "")
+            + ("; start node changed" if self.start_node_changed else "")
+            + ("; script changed" if self.script_changed else "")
+        )
+
+
+def _diff_dicts(old: Dict, new: Dict):
+    changed = {key for key, value in new.items() if old.get(key) != value}
+    removed = set(old.keys()) - set(new.keys())
+    return changed, removed
+
+
+def diff_opus(old: Opus, new: Opus) -> OpusDiff:
+    """
+    Find what differs between two versions of an opus.
+
+    A node counts as changed if any action it uses has changed, since
+    nodes are sent to the UI together with their actions.
+
+    Parameters
+    ----------
+    old
+        The running opus
+    new
+        The reloaded opus
+
+    Returns
+    -------
+    The differences
+    """
+    diff = OpusDiff()
+    diff.changed_nodes, diff.removed_nodes = _diff_dicts(old.nodes, new.nodes)
+    diff.changed_actions, diff.removed_actions = _diff_dicts(old.action_templates, new.action_templates)
+    diff.changed_assets, diff.removed_assets = _diff_dicts(old.assets, new.assets)
+    diff.ui_config_changed = old.ui_config != new.ui_config
+    diff.start_node_changed = old.start_node != new.start_node
+    diff.script_changed = old.script != new.script
+
+    affected_actions = diff.changed_actions | diff.removed_actions
+    if affected_actions:
+        for node_id, node in new.nodes.items():
+            action_ids = set(node.actions)
+            if isinstance(node.next, list):
+                for choice in node.next:
+                    action_ids.update(choice.actions)
+            if action_ids & affected_actions:
+                diff.changed_nodes.add(node_id)
+    return diff
+
+
+async def watch_files(get_paths: Callable[[], List[Path]], on_change: Callable[[], Awaitable[None]],
+                      interval: float):
+    """
+    Poll files for changes, forever.
+
+    A change is only reported when the files have been unchanged for one
+    interval, so a file being written isn't read halfway.
+
+    Parameters
+    ----------
+    get_paths
+        Gives the files to watch. Called again after each change.
+    on_change
+        Called when any of the files has changed
+    interval
+        Seconds between checks
+    """
+    stamps = [file_stamp(path) for path in get_paths()]
+    while True:
+        await asyncio.sleep(interval)
+        new_stamps = [file_stamp(path) for path in get_paths()]
+        if new_stamps == stamps:
+            continue
+        # Wait until the files are done being written
+        while True:
+            await asyncio.sleep(interval)
+            settled_stamps = [file_stamp(path) for path in get_paths()]
+            if settled_stamps == new_stamps:
+                break
+            new_stamps = settled_stamps
+        try:
+            await on_change()
+        except Exception as e:
+            print(f"Failed to handle changed files: {e}")
+        stamps = [file_stamp(path) for path in get_paths()]
@@ -0,0 +1,136 @@
+import os
+import pickle
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+# Bump this when the snapshot layout changes in a way the loader source
+# itself doesn't reflect.
+SNAPSHOT_VERSION = 1
+
+# Snapshots also depend on the loader source, so they are invalidated
+# automatically when the loader changes.
+LOADER_SOURCES = [
+    Path(__file__).parent / "opus.py",
+    Path(__file__).parent / "parametrized_action.py",
+    Path(__file__),
+]
+
+FileStamp = Tuple[str, Optional[int], Optional[int]]
+
+
+def snapshot_path(opus_path: Path) -> Path:
+    """The path of the compiled snapshot belonging to an opus file."""
+    return opus_path.with_name(opus_path.name + ".compiled")
+
+
+def file_stamp(path: Path) -> FileStamp:
+    """
+    Get what identifies a version of a file, without reading it.
+
+    Parameters
+    ----------
+    path
+        The file
+
+    Returns
+    -------
+    A tuple (path, size, mtime in ns). Size and mtime are None if the
+    file doesn't exist.
+    """
+    try:
+        stat = path.stat()
+        return (str(path), stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return (str(path), None, None)
+
+
+def dependency_stamps(opus_path: Path, asset_paths: List[str]) -> List[FileStamp]:
+    """
+    Stamp all files a compiled opus depends on.
+
+    Parameters
+    ----------
+    opus_path
+        The path to the opus file
+    asset_paths
+        Paths to all local assets (including the script), relative to the opus
+
+    Returns
+    -------
+    A list of file stamps, see file_stamp
+    """
+    opus_path = opus_path.resolve()
+    paths = [*LOADER_SOURCES, opus_path, *[opus_path.parent / path for path in sorted(set(asset_paths))]]
+    return [file_stamp(path) for path in paths]
+
+
+def save_snapshot(opus_path: Path, opus: Any, asset_paths: List[str], has_checksums: bool):
+    """
+    Write a compiled opus next to the opus file.
+
+    The opus should not contain any asset data or script, since those
+    are read separately when loading.
+
+    Parameters
+    ----------
+    opus_path
+        The path to the opus file
+    opus
+        The fully loaded opus
+    asset_paths
+        Paths to all local assets (including the script), relative to the opus
+    has_checksums
+        Whether the assets in the opus have checksums
+    """
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "opus_path": str(opus_path.resolve()),
+        "has_checksums": has_checksums,
+        "stamps": dependency_stamps(opus_path, asset_paths),
+        "opus": opus,
+    }
+    path = snapshot_path(opus_path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: Could not write opus snapshot {path}: {e}")
+
+
+def load_snapshot(opus_path: Path, needs_checksums: bool) -> Optional[Any]:
+    """
+    Load a compiled opus, if there is one and it is up to date.
+
+    Parameters
+    ----------
+    opus_path
+        The path to the opus file
+    needs_checksums
+        Whether the assets need checksums
+
+    Returns
+    -------
+    The compiled opus, or None if it is missing or outdated
+    """
+    path = snapshot_path(opus_path)
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Ignoring unreadable opus snapshot {path}: {e}")
+        return None
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    if needs_checksums and not snapshot["has_checksums"]:
+        return None
+    if snapshot["opus_path"] != str(opus_path.resolve()):
+        return None
+    for stamp in snapshot["stamps"]:
+        if file_stamp(Path(stamp[0])) != tuple(stamp):
+            return None
+    return snapshot["opus"]
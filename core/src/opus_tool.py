@@ -0,0 +1,28 @@
+import argparse
+import asyncio
+from pathlib import Path
+
+from opus import compile_opus, local_asset_paths, strip_opus_data, validate_references
+from opus_snapshot import save_snapshot, snapshot_path
+
+
+def compile_command(opus_path: Path, read_asset_data: bool):
+    """Compile an opus and write it as a snapshot next to the opus file."""
+    opus = asyncio.run(compile_opus(opus_path, read_asset_data))
+    validate_references(opus, exit_on_failure=True)
+    save_snapshot(opus_path, strip_opus_data(opus), local_asset_paths(opus), read_asset_data)
+    print(f"Wrote {snapshot_path(opus_path)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tools for opus files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compile_parser = subparsers.add_parser(
+        "compile", help="Compile an opus to a snapshot, which Core uses as long as it is up to date")
+    compile_parser.add_argument("opus", type=Path, help="The opus file")
+    compile_parser.add_argument("--no-checksums", action="store_true",
+                                help="Don't compute asset checksums (only needed when syncing assets)")
+    args = parser.parse_args()
+
+    if args.command == "compile":
+        compile_command(args.opus, not args.no_checksums)
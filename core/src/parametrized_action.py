@@ -0,0 +1,148 @@
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import jsonpath_ng
+import jsonpath_ng.jsonpath
+
+# A concrete location in the actions list of a template, e.g. (0, "params", "entityId")
+Location = Tuple[Union[str, int], ...]
+
+
+def copy_json(value: Any) -> Any:
+    """
+    Copy data loaded from YAML or JSON.
+
+    This is a much faster deepcopy, which only copies dicts and lists
+    and shares everything else (which is immutable when loaded from YAML).
+    """
+    if isinstance(value, dict):
+        return {key: copy_json(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [copy_json(item) for item in value]
+    return value
+
+
+@lru_cache(maxsize=None)
+def parse_json_path(path: str) -> jsonpath_ng.JSONPath:
+    """Parse a JSON path. The result is cached, since parsing is slow."""
+    return jsonpath_ng.parse(path)
+
+
+def _get_location(datum: jsonpath_ng.DatumInContext) -> Optional[Location]:
+    """Get the concrete location of a match, or None if it can't be expressed as one."""
+    location = []
+    while datum.context is not None:
+        if isinstance(datum.path, jsonpath_ng.jsonpath.Fields) and len(datum.path.fields) == 1:
+            location.append(datum.path.fields[0])
+        elif isinstance(datum.path, jsonpath_ng.jsonpath.Index):
+            location.append(datum.path.index)
+        elif not isinstance(datum.path, jsonpath_ng.jsonpath.This):
+            return None
+        datum = datum.context
+    if len(location) == 0:
+        return None  # The root itself can't be replaced
+    return tuple(reversed(location))
+
+
+def _is_prefix(a: Location, b: Location) -> bool:
+    return len(a) <= len(b) and b[:len(a)] == a
+
+
+class ParametrizedActionTemplate:
+    """
+    A parametrized action template, compiled once for fast instantiation.
+
+    Every JSON path in the template is resolved to concrete locations in
+    the template's actions when compiling. Instantiating then only copies
+    the actions and fills in the parameters at those locations.
+
+    If the changes can't be resolved in advance (e.g. when one parameter
+    replaces something that another parameter is put into), every instance
+    evaluates the JSON paths instead.
+
+    Parameters
+    ----------
+    name
+        The ID of the template
+    template_dict
+        The template, as found in the opus
+    """
+
+    def __init__(self, name: str, template_dict: Dict[str, Any]):
+        self.name = name
+        self._actions = template_dict.get("actions")
+        self._changes: List[Tuple[str, str]] = [
+            (parameter, change_order["path"])
+            for parameter, change_list in template_dict.get("parameters", {}).items()
+            for change_order in change_list
+        ]
+        self._locations = self._resolve_locations()
+
+    def _resolve_locations(self) -> Optional[List[List[Location]]]:
+        all_locations = []
+        for _, path in self._changes:
+            matches = parse_json_path(path).find(self._actions)
+            if len(matches) == 0:
+                raise RuntimeError(f"Invalid JSON path for parameter: {path}")
+            locations = [_get_location(match) for match in matches]
+            if any(location is None for location in locations):
+                return None
+            all_locations.append(locations)
+
+        # Resolving in advance only works if no change affects where another one goes
+        flat_locations = [location for locations in all_locations for location in locations]
+        for i, a in enumerate(flat_locations):
+            for b in flat_locations[i + 1:]:
+                if a != b and (_is_prefix(a, b) or _is_prefix(b, a)):
+                    return None
+        return all_locations
+
+    def instantiate(self, parameters: Dict[str, Any]) -> List[Any]:
+        """
+        Fill in the parameters in a copy of the template's actions.
+
+        Parameters
+        ----------
+        parameters
+            The parameter values of the instance
+
+        Returns
+        -------
+        The actions of the instance
+        """
+        actions = copy_json(self._actions)
+        if self._locations is None:
+            return self._instantiate_with_json_paths(actions, parameters)
+
+        for (parameter, _), locations in zip(self._changes, self._locations):
+            containers = [self._get_container(actions, location) for location in locations]
+            first_container, first_location = containers[0], locations[0]
+            new_value = self._substitute(parameter, first_container[first_location[-1]], parameters[parameter])
+            for container, location in zip(containers, locations):
+                container[location[-1]] = new_value
+        return actions
+
+    def _instantiate_with_json_paths(self, actions: List[Any], parameters: Dict[str, Any]) -> List[Any]:
+        for parameter, path in self._changes:
+            expr = parse_json_path(path)
+            orig_value = expr.find(actions)
+            if len(orig_value) == 0:
+                raise RuntimeError(f"Invalid JSON path for parameter: {path}")
+            new_value = self._substitute(parameter, orig_value[0].value, parameters[parameter])
+            expr.update(actions, new_value)
+        return actions
+
+    @staticmethod
+    def _get_container(actions: List[Any], location: Location) -> Any:
+        container = actions
+        for key in location[:-1]:
+            container = container[key]
+        return container
+
+    @staticmethod
+    def _substitute(parameter: str, orig_value: Any, parameter_value: Any) -> Any:
+        parameter_var = f"${parameter}"
+        if type(orig_value) == str and parameter_var in orig_value:
+            return orig_value.replace(parameter_var, str(parameter_value))
+        else:
+            return parameter_value
@@ -0,0 +1,496 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import math
+import os
+import time
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+from screencrash_common.block_signature import block_size_for
+from screencrash_common.wire_codec import Frame, decode_bytes, encode, encode_fragments
+
+from opus import Asset
+from util.block_delta import Copy, Data, Operation, compute_delta
+from util.outbound_queue import BULK, OutboundQueue, QueuedFrame
+
+# Assets are served over HTTP under this path, by checksum (see AssetServer)
+ASSETS_PATH = "/assets/"
+
+
+@dataclass
+class SyncSettings:
+    """
+    Settings for syncing assets to components.
+
+    Parameters
+    ----------
+    chunk_size
+        Bytes of file data per message
+    window
+        Chunks that may be sent before the component has acknowledged them
+    delta
+        Whether to send only the changed blocks of files that components
+        have another version of
+    delta_max_new_data
+        Bytes of changed data above which the whole file is sent instead
+    max_rate
+        Bytes per second to send to all components together, or None for no limit
+    component_max_rate
+        Bytes per second to send to each component, or None for no limit
+    max_concurrent
+        Files to send at the same time, to all components together
+    pause_after_advance
+        Seconds to pause syncing after the performance has moved to another node
+    """
+    chunk_size: int = 1024 * 1024
+    window: int = 4
+    delta: bool = True
+    delta_max_new_data: int = 8 * 1024 * 1024
+    max_rate: Optional[float] = None
+    component_max_rate: Optional[float] = None
+    max_concurrent: int = 4
+    pause_after_advance: float = 20.0
+
+
+class RateLimiter:
+    """
+    Limits the rate of sent bytes, with a token bucket that holds one second of data.
+
+    Parameters
+    ----------
+    rate
+        Bytes per second, or None for no limit
+    """
+
+    def __init__(self, rate: Optional[float]):
+        self._rate = rate
+        self._tokens = rate or 0.0
+        self._updated_at = time.monotonic()
+
+    async def acquire(self, nbytes: int):
+        """Wait until nbytes may be sent."""
+        if self._rate is None:
+            return
+        now = time.monotonic()
+        self._tokens = min(self._rate, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+        # Take the bytes now, so concurrent senders queue up behind each other
+        self._tokens -= nbytes
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+
+class SyncScheduler:
+    """
+    Coordinates the syncing of assets to all components.
+
+    Files are sent to several components at the same time, but not more than
+    max_concurrent, and the data is limited to max_rate in total and
+    component_max_rate per component. The assets of the nearest upcoming
+    nodes of the performance are sent first. While the performance is
+    advancing, syncing pauses, so it doesn't compete with the actions of the
+    show.
+
+    The distances to the upcoming assets are only found when a sync picks
+    its next asset, not every time the performance advances.
+
+    Parameters
+    ----------
+    settings
+        How to sync assets
+    upcoming_assets
+        Finds how many nodes ahead of the current node each asset is needed,
+        by path. If None, assets are sent in any order.
+    """
+
+    def __init__(self, settings: Optional[SyncSettings] = None,
+                 upcoming_assets: Optional[Callable[[], Dict[str, int]]] = None):
+        self.settings = settings if settings is not None else SyncSettings()
+        self._upcoming_assets = upcoming_assets
+        self._limiter = RateLimiter(self.settings.max_rate)
+        self._transfers = asyncio.Semaphore(self.settings.max_concurrent)
+        self._paused_until = 0.0
+        # How many nodes ahead each asset is needed, by path, or None if
+        # they need to be found again
+        self._distances: Optional[Dict[str, int]] = None
+
+    def component_limiter(self) -> RateLimiter:
+        """Create the rate limiter of a component."""
+        return RateLimiter(self.settings.component_max_rate)
+
+    def performance_advanced(self):
+        """Pause syncing for a while, since the performance has moved to another node."""
+        self._distances = None
+        self._paused_until = time.monotonic() + self.settings.pause_after_advance
+
+    def opus_changed(self):
+        """Find the distances to the assets again, since the opus has changed."""
+        self._distances = None
+
+    def priority(self, asset: Asset) -> float:
+        """The priority of an asset, lowest first."""
+        if self._distances is None:
+            self._distances = self._upcoming_assets() if self._upcoming_assets is not None else {}
+        return self._distances.get(asset.path, math.inf)
+
+    @asynccontextmanager
+    async def transfer(self) -> AsyncIterator[None]:
+        """Wait for a turn to send a file."""
+        async with self._transfers:
+            yield
+
+    async def before_send(self, limiter: Optional[RateLimiter], nbytes: int):
+        """Wait until nbytes may be sent to a component, with the given limiter if any."""
+        while time.monotonic() < self._paused_until:
+            await asyncio.sleep(self._paused_until - time.monotonic())
+        await self._limiter.acquire(nbytes)
+        if limiter is not None:
+            await limiter.acquire(nbytes)
+
+
+@dataclass
+class FileProgress:
+    """How far a file has been synced to a component"""
+    path: str
+    size: int
+    # Where the sync started, which is after the data the component already had
+    start_offset: int = 0
+    sent: int = 0
+    acked: int = 0
+    started_at: float = 0.0
+    done: bool = False
+    # File data sent, which is less than the size for deltas
+    transferred: int = 0
+
+    def report(self) -> str:
+        percent = self.acked / self.size * 100 if self.size else 100
+        elapsed = time.monotonic() - self.started_at
+        rate = (self.acked - self.start_offset) / elapsed / 1024 / 1024 if elapsed > 0 else 0
+        return (f"{self.path}: {self.acked}/{self.size} bytes ({percent:.0f}%, {rate:.1f} MiB/s), "
+                f"{self.transferred} bytes of data sent")
+
+
+class AssetSync:
+    """
+    Syncs assets to one component.
+
+    Components that announce "chunkedFiles" in their hello get each file as
+    a file_start message, file_chunk messages with the data and its offset,
+    and a file_end message. The component acknowledges each chunk it has
+    written (file_ack), and at most a window of chunks are sent ahead of the
+    acknowledgements, so neither side has to hold much of a file in memory.
+    The component writes to a temporary file and verifies the checksum when
+    the file ends, answering file_synced or file_sync_failed.
+
+    A component that was disconnected during a sync reports how much it got
+    of each file it didn't finish ("partial", by checksum), and the sync
+    continues from there.
+
+    If a component with "deltaFiles" has another version of a file, it is
+    asked for the signatures of the blocks of its version (file_signature),
+    and only the changed data is sent (see block_delta). The rest is copied
+    from its version (file_copy, in place of file_chunk).
+
+    Components that announce "httpFiles" instead get a manifest of the
+    files they don't have (file_manifest), with the path, checksum and size
+    of each, nearest upcoming first. They download the files over HTTP from
+    Core (see AssetServer), acknowledge how much they have of each
+    (file_ack) and answer file_synced or file_sync_failed like above. This
+    keeps large transfers off the websocket, which also carries commands.
+    Files they have another version of are still sent as deltas, if they
+    announce "deltaFiles", and only downloaded if that fails.
+
+    Other components get each file as one file message. It is encoded and
+    written in fragments, so the whole message is never held in memory.
+
+    All messages are sent through the outbound queue of the component, in
+    the bulk lane, so commands are sent before them. The next message is
+    only queued when the previous one has been written, so a sync never
+    fills the queue.
+
+    Parameters
+    ----------
+    queue
+        The outbound queue to the component
+    scheduler
+        Coordinates the syncing to all components
+    chunked
+        Whether the component can receive files in chunks
+    delta
+        Whether the component can build files from its old version and a delta
+    http
+        Whether the component can download files over HTTP
+    """
+
+    def __init__(self, queue: OutboundQueue, scheduler: SyncScheduler, chunked: bool, delta: bool,
+                 http: bool = False):
+        self._queue = queue
+        self._name = queue.name
+        self._encoding = queue.encoding
+        self._scheduler = scheduler
+        self._settings = scheduler.settings
+        self._limiter = scheduler.component_limiter()
+        self._chunked = chunked
+        self._delta = chunked and delta and self._settings.delta
+        self._http = http
+        self.progress: Dict[str, FileProgress] = {}
+        self._acked = asyncio.Event()
+        # The result of each file being synced, by path
+        self._results: Dict[str, asyncio.Future] = {}
+        # Signatures requested from the component, by path
+        self._signatures: Dict[str, asyncio.Future] = {}
+
+    async def sync(self, assets: List[Asset], checksums: Dict[str, str], partial: Dict[str, int]):
+        """
+        Send the assets that the component doesn't have.
+
+        Parameters
+        ----------
+        assets
+            The assets the component should have
+        checksums
+            The checksums of the files the component has, by path
+        partial
+            How many bytes the component has of files it didn't finish, by checksum
+        """
+        outdated: List[Asset] = []
+        for asset in assets:
+            if asset.file and checksums.get(asset.path) == asset.checksum:
+                print(f"Asset {asset.path} already up to date")
+            elif asset.file:
+                outdated.append(asset)
+            else:
+                print(f"Skipping sync of asset {asset.path} (no data)")
+        if self._http:
+            # Files the component has another version of only need their changes
+            deltas = [asset for asset in outdated
+                      if self._delta and asset.path in checksums and asset.checksum not in partial]
+            downloads = [asset for asset in outdated if asset not in deltas]
+            await asyncio.gather(self._send_manifest(downloads, partial), self._send_deltas(deltas, partial))
+            print("Synced everything")
+            return
+        while outdated:
+            # The performance may move on while syncing, so choose the next asset each time
+            asset = min(outdated, key=self._scheduler.priority)
+            outdated.remove(asset)
+            async with self._scheduler.transfer():
+                await self._sync_asset(asset, checksums, partial)
+        print("Synced everything")
+
+    async def _sync_asset(self, asset: Asset, checksums: Dict[str, str], partial: Dict[str, int]):
+        print(f"Syncing asset {asset.path}")
+        offset = partial.get(asset.checksum, 0)
+        if self._delta and offset == 0 and asset.path in checksums:
+            if await self._send_delta(asset):
+                return
+            print(f"Sending all of {asset.path} instead")
+        if self._chunked:
+            await self._send_chunked(asset, offset)
+        else:
+            try:
+                await self._send_whole(asset)
+            except (OSError, RuntimeError) as e:
+                print(f"Failed to sync {asset.path} to {self._name}: {e}")
+
+    async def _send_deltas(self, assets: List[Asset], partial: Dict[str, int]):
+        """Send the changes to files the component has other versions of, and let it download the rest."""
+        failed: List[Asset] = []
+        while assets:
+            asset = min(assets, key=self._scheduler.priority)
+            assets.remove(asset)
+            print(f"Syncing asset {asset.path}")
+            async with self._scheduler.transfer():
+                if not await self._send_delta(asset):
+                    print(f"Downloading all of {asset.path} instead")
+                    failed.append(asset)
+        await self._send_manifest(failed, partial)
+
+    async def _send_manifest(self, assets: List[Asset], partial: Dict[str, int]):
+        """Let the component download the assets it doesn't have, and wait until it has."""
+        if not assets:
+            return
+        # The order of the manifest is the order the component downloads in
+        assets = sorted(assets, key=self._scheduler.priority)
+        files = []
+        for asset in assets:
+            size = os.stat(asset.file).st_size
+            offset = min(partial.get(asset.checksum, 0), size)
+            self.progress[asset.path] = FileProgress(asset.path, size, offset, offset, offset, time.monotonic())
+            self._results[asset.path] = asyncio.get_running_loop().create_future()
+            files.append({"path": asset.path, "checksum": asset.checksum, "size": size})
+        await self._send({"command": "file_manifest", "assetsPath": ASSETS_PATH, "files": files})
+        for asset in assets:
+            progress = self.progress[asset.path]
+            try:
+                await self._results[asset.path]
+                progress.done = True
+                progress.acked = progress.size
+                progress.transferred = progress.size - progress.start_offset
+                print(f"Synced {progress.report()}")
+            except RuntimeError as e:
+                print(f"Failed to sync {asset.path} to {self._name}: {e}")
+            finally:
+                del self._results[asset.path]
+
+    async def _send_whole(self, asset: Asset):
+        await self._scheduler.before_send(self._limiter, os.stat(asset.file).st_size)
+        await self._send_frame(self._file_fragments(asset))
+
+    def _file_fragments(self, asset: Asset) -> Iterator[Frame]:
+        """
+        Encode the file message of an asset in fragments, while it is being written.
+
+        The data is sent as raw bytes with MessagePack, and base64 with JSON.
+        The file is only mapped, and a chunk of it encoded, at a time.
+        """
+        # Base64 encodes 3 bytes at a time
+        chunk_size = self._settings.chunk_size - self._settings.chunk_size % 3
+        with asset.open_data() as data:
+            chunks = (data[start:start + chunk_size] for start in range(0, len(data), chunk_size))
+            yield from encode_fragments({"command": "file", "path": asset.path}, "data", chunks,
+                                        len(data), self._encoding)
+
+    async def _send_delta(self, asset: Asset) -> bool:
+        """Send the changes to a file that the component has another version of. Returns whether it worked."""
+        with asset.open_data() as data:
+            signature = asyncio.get_running_loop().create_future()
+            self._signatures[asset.path] = signature
+            try:
+                await self._send({"command": "file_signature", "path": asset.path,
+                                  "blockSize": block_size_for(len(data))})
+                message = await signature
+            except RuntimeError as e:
+                print(f"Failed to get the signatures of {asset.path} from {self._name}: {e}")
+                return False
+            finally:
+                del self._signatures[asset.path]
+            # Finding the changes takes a while for large files, so don't block other connections
+            operations = await asyncio.to_thread(
+                compute_delta, data, message["blockSize"], message["weak"],
+                [decode_bytes(block_hash) for block_hash in message["strong"]],
+                self._settings.delta_max_new_data)
+        if operations is None:
+            print(f"Too much of {asset.path} has changed for a delta")
+            return False
+        new_data = sum(operation.end - operation.start for operation in operations if isinstance(operation, Data))
+        print(f"Syncing {new_data} changed bytes of {asset.path}")
+        return await self._send_chunked(asset, 0, operations)
+
+    async def _send_chunked(self, asset: Asset, offset: int,
+                            operations: Optional[List[Operation]] = None) -> bool:
+        """
+        Send a file in chunks. Returns whether the component got it.
+
+        Parameters
+        ----------
+        asset
+            The asset to send
+        offset
+            Where to start, if the component already has the start of the file
+        operations
+            How to build the file from the version the component has, or None
+            to send all of it
+        """
+        with asset.open_data() as data:
+            size = len(data)
+            if offset > size:
+                offset = 0
+            if offset > 0:
+                print(f"Resuming sync of {asset.path} at {offset} bytes")
+            if operations is None:
+                operations = [Data(offset, size)]
+            progress = FileProgress(asset.path, size, offset, offset, offset, time.monotonic())
+            self.progress[asset.path] = progress
+            result = asyncio.get_running_loop().create_future()
+            self._results[asset.path] = result
+            await self._send({"command": "file_start", "path": asset.path, "size": size,
+                              "checksum": asset.checksum, "offset": offset,
+                              "base": any(isinstance(operation, Copy) for operation in operations)})
+            window = self._settings.window * self._settings.chunk_size
+            for operation in operations:
+                if isinstance(operation, Copy):
+                    await self._wait_for_window(progress, result, window)
+                    # Copies are small messages, but still wait while paused
+                    await self._scheduler.before_send(self._limiter, 0)
+                    if result.done():
+                        break
+                    await self._send({"command": "file_copy", "path": asset.path, "offset": progress.sent,
+                                      "sourceOffset": operation.source_offset, "length": operation.length})
+                    progress.sent += operation.length
+                    continue
+                # Stop early if the component fails to write the file
+                while progress.sent < operation.end and not result.done():
+                    await self._wait_for_window(progress, result, window)
+                    if result.done():
+                        break
+                    end = min(progress.sent + self._settings.chunk_size, operation.end)
+                    await self._scheduler.before_send(self._limiter, end - progress.sent)
+                    if result.done():
+                        break
+                    chunk = data[progress.sent:end]
+                    frame = encode({"command": "file_chunk", "path": asset.path, "offset": progress.sent,
+                                    "data": chunk}, self._encoding)
+                    # The chunk refers to the mapped file, which is closed after the loop
+                    chunk.release()
+                    await self._send_frame(frame)
+                    progress.transferred += end - progress.sent
+                    progress.sent = end
+        if not result.done():
+            await self._send({"command": "file_end", "path": asset.path})
+        try:
+            await result
+            progress.done = True
+            print(f"Synced {progress.report()}")
+            return True
+        except RuntimeError as e:
+            print(f"Failed to sync {asset.path} to {self._name}: {e}")
+            return False
+        finally:
+            del self._results[asset.path]
+
+    async def _wait_for_window(self, progress: FileProgress, result: asyncio.Future, window: int):
+        """Wait until the component has acknowledged enough of what has been sent."""
+        while progress.sent - progress.acked >= window and not result.done():
+            self._acked.clear()
+            await self._acked.wait()
+
+    async def _send(self, message):
+        await self._send_frame(encode(message, self._encoding))
+
+    async def _send_frame(self, frame: QueuedFrame):
+        """Queue a frame after everything else to the component, and wait until it has been written."""
+        written = asyncio.get_running_loop().create_future()
+        self._queue.send(frame, BULK, written)
+        await written
+
+    def handle_ack(self, path: str, offset: int):
+        """Handle that the component has written a file up to an offset."""
+        progress = self.progress.get(path)
+        if progress is not None:
+            progress.acked = max(progress.acked, offset)
+            self._acked.set()
+
+    def handle_signature(self, path: str, message: Dict):
+        """Handle the signatures of the blocks of the component's version of a file."""
+        signature = self._signatures.get(path)
+        if signature is not None and not signature.done():
+            signature.set_result(message)
+
+    def handle_result(self, path: str, error: Optional[str]):
+        """Handle that the component has verified a file (file_synced), or not (file_sync_failed)."""
+        signature = self._signatures.get(path)
+        if signature is not None and not signature.done() and error is not None:
+            # The component couldn't compute the signatures
+            signature.set_exception(RuntimeError(error))
+        result = self._results.get(path)
+        if result is None or result.done():
+            return
+        if error is None:
+            result.set_result(None)
+        else:
+            result.set_exception(RuntimeError(error))
+        # Wake up the sender, if it's waiting for acknowledgements
+        self._acked.set()
+
+    def report(self) -> str:
+        return "\n".join(progress.report() for progress in self.progress.values() if not progress.done)
@@ -1,13 +1,13 @@
 import asyncio
-import base64
 from dataclasses import dataclass
-import json
 import time
-import threading
 import traceback
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 from opus import Asset
 from util.event_emitter import EventEmitter
+from peers.asset_sync import AssetSync, SyncScheduler
+from util.outbound_queue import COMMAND, OutboundLimits, OutboundQueue
+from screencrash_common.wire_codec import Frame, choose_encoding, decode, encode
 from peers.component_info import ComponentData, ComponentInfo
 
 import websockets
@@ -24,26 +24,47 @@ class ComponentPeer(EventEmitter):
         Target types this peer listens too (e.g. audio, video, image etc.)
     sync_assets
         Whether to sync assets
+    outbound_limits
+        Limits for the queue of messages to each component
+    sync_scheduler
+        Coordinates the syncing of assets to all components
     """
 
-    def __init__(self, target_types: List[str], sync_assets: bool):
+    def __init__(self, target_types: List[str], sync_assets: bool,
+                 outbound_limits: Optional[OutboundLimits] = None, sync_scheduler: Optional[SyncScheduler] = None):
         super().__init__()
         self._target_types = target_types
         self._sync_assets = sync_assets
-        self._websockets: List[WebSocketServerProtocol] = []
+        self._sync_scheduler = sync_scheduler if sync_scheduler is not None else SyncScheduler()
+        self._outbound_limits = outbound_limits if outbound_limits is not None else OutboundLimits()
+        # The queue of messages to each connected component
+        self._queues: Dict[WebSocketServerProtocol, OutboundQueue] = {}
         self._assets: List[Asset] = []
         self._infos: Dict[str, ComponentData] = {}
 
     def add_asset(self, asset: Asset) -> None:
         self._assets.append(asset)
 
+    def clear_assets(self) -> None:
+        self._assets = []
+
     async def handle_socket(self, websocket: WebSocketServerProtocol, initial_message: Any) -> None:
         """This handles one websocket connection."""
-        self._websockets.append(websocket)
+        # The hello lists the encodings the component can decode, if any
+        encoding = choose_encoding(initial_message.get("encodings", []))
+        name = f"{type(self).__name__} {websocket.remote_address}"
+        queue = OutboundQueue(websocket, name, self._outbound_limits, encoding)
+        self._queues[websocket] = queue
+        # Assets are synced in the background, so messages from the
+        # component (e.g. acknowledgements of file chunks) are handled meanwhile
+        asset_sync = AssetSync(queue, self._sync_scheduler,
+                               initial_message.get("chunkedFiles", False), initial_message.get("deltaFiles", False),
+                               initial_message.get("httpFiles", False))
+        sync_task: Optional[asyncio.Task] = None
         # Request component info
-        await websocket.send(json.dumps({"command": "req_component_info"}))
+        queue.send(encode({"command": "req_component_info"}, encoding), COMMAND)
         if self._sync_assets:
-            await websocket.send(json.dumps({"command": "report_checksums"}))
+            queue.send(encode({"command": "report_checksums"}, encoding), COMMAND)
         else:
             print("Not syncing assets")
         # Handle messages from the client
@@ -51,7 +72,7 @@ class ComponentPeer(EventEmitter):
         try:
             async for message in websocket:
                 try:
-                    message_dict = json.loads(message)
+                    message_dict = decode(message)
                     message_type = message_dict["messageType"]
                     if message_type == "heartbeat":
                         pass  # Ignore heartbeats for now
@@ -63,17 +84,18 @@ class ComponentPeer(EventEmitter):
                             component_id, message_dict["level"], message_dict["msg"])
                     elif message_type == "file_checksums":
                         # Sync assets
-                        for asset in self._assets:
-                            if asset.data and message_dict["files"].get(asset.path) == asset.checksum:
-                                print(f"Asset {asset.path} already up to date")
-                            elif asset.data:
-                                print(f"Syncing asset {asset.path}")
-                                await websocket.send(json.dumps({"command": "file", "path": asset.path,
-                                                                "data": base64.b64encode(asset.data).decode("utf-8")}))
-                            else:
-                                print(
-                                    f"Skipping sync of asset {asset.path} (no data)")
-                        print("Synced everything")
+                        if sync_task is not None:
+                            sync_task.cancel()
+                        sync_task = asyncio.create_task(asset_sync.sync(
+                            list(self._assets), message_dict["files"], message_dict.get("partial", {})))
+                    elif message_type == "file_ack":
+                        asset_sync.handle_ack(message_dict["path"], message_dict["offset"])
+                    elif message_type == "file_signature":
+                        asset_sync.handle_signature(message_dict["path"], message_dict)
+                    elif message_type == "file_synced":
+                        asset_sync.handle_result(message_dict["path"], None)
+                    elif message_type == "file_sync_failed":
+                        asset_sync.handle_result(message_dict["path"], message_dict["reason"])
                     else:
                         self.handle_component_message(
                             component_id, message_type, message_dict)
@@ -84,26 +106,59 @@ class ComponentPeer(EventEmitter):
             print(f"Websocket to component closed abruptly: {cce}")
 
         # Websocket is closed
+        if sync_task is not None:
+            sync_task.cancel()
         if component_id:
             del self._infos[component_id]
             self.handle_component_disconnect(component_id)
-        self._websockets.remove(websocket)
+        queue.close()
+        del self._queues[websocket]
 
     def nof_instances(self) -> int:
-        return len(self._websockets)
+        return len(self._queues)
 
     def get_connected_clients(self) -> List[ComponentInfo]:
         return list(map(lambda comp: comp.info, self._infos.values()))
 
     def send_command(self, data) -> None:
-        websockets.broadcast(self._websockets, json.dumps(data))
-
-    def send_command_to(self, component_id, data):
-        if self.has_component(component_id):
-            def impl():
-                websocket = self._infos[component_id].socket
-                asyncio.run(websocket.send(json.dumps(data)))
-            threading.Thread(target=impl).start()
+        # Encoded once per encoding in use
+        frames: Dict[str, Frame] = {}
+        for queue in self._queues.values():
+            if queue.encoding not in frames:
+                frames[queue.encoding] = encode(data, queue.encoding)
+            queue.send(frames[queue.encoding], COMMAND)
+
+    def send_command_to(self, component_id: str, data) -> asyncio.Future:
+        """
+        Send a command to one component.
+
+        The command is queued with the other commands to the component, so
+        they are written in order, by the event loop.
+
+        Returns
+        -------
+        A future that is done when the command has been written. If it can't
+        be sent, the future fails with a RuntimeError, which is also logged.
+        """
+        written = asyncio.get_running_loop().create_future()
+        written.add_done_callback(lambda future: self._report_send_failure(component_id, data, future))
+        if not self.has_component(component_id):
+            written.set_exception(RuntimeError(f"Component {component_id} is not connected"))
+            return written
+        queue = self._queues[self._infos[component_id].socket]
+        queue.send(encode(data, queue.encoding), COMMAND, written)
+        return written
+
+    def _report_send_failure(self, component_id: str, data, written: asyncio.Future):
+        if written.cancelled() or written.exception() is None:
+            return
+        message = f"Failed to send command {data.get('command')} to {component_id}: {written.exception()}"
+        print(message)
+        self.emit("log-message", "error", time.time(), "core", message)
+
+    def queues(self) -> List[OutboundQueue]:
+        """The queue of messages to each component."""
+        return list(self._queues.values())
 
     def has_component(self, component_id: str):
         return component_id in self._infos
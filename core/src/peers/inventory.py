@@ -1,7 +1,9 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 from opus import Asset
 
+from peers.asset_sync import SyncScheduler
 from peers.component import ComponentPeer
+from util.outbound_queue import OutboundLimits
 
 
 class InventoryPeer(ComponentPeer):
@@ -10,10 +12,17 @@ class InventoryPeer(ComponentPeer):
 
     Parameters
     ----------
+    sync_assets
+        Whether to sync assets
+    outbound_limits
+        Limits for the queue of messages to each component
+    sync_scheduler
+        Coordinates the syncing of assets to all components
     """
 
-    def __init__(self, sync_assets: bool):
-        super().__init__(["inventory"], sync_assets)
+    def __init__(self, sync_assets: bool, outbound_limits: Optional[OutboundLimits] = None,
+                 sync_scheduler: Optional[SyncScheduler] = None):
+        super().__init__(["inventory"], sync_assets, outbound_limits, sync_scheduler)
         self._active_achievement_requests = {}
 
     def handle_component_message(self, component_id: str, message_type: str, message: object):
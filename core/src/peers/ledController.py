@@ -1,7 +1,8 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 from opus import Asset
 
 from peers.component import ComponentPeer
+from util.outbound_queue import OutboundLimits
 
 
 class LedControllerPeer(ComponentPeer):
@@ -10,10 +11,12 @@ class LedControllerPeer(ComponentPeer):
 
     Parameters
     ----------
+    outbound_limits
+        Limits for the queue of messages to each component
     """
 
-    def __init__(self):
-        super().__init__(["ledController"], False)
+    def __init__(self, outbound_limits: Optional[OutboundLimits] = None):
+        super().__init__(["ledController"], False, outbound_limits)
 
     def handle_component_message(
         self, component_id: str, message_type: str, message: object
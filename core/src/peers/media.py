@@ -1,7 +1,9 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 from opus import Asset
 
+from peers.asset_sync import SyncScheduler
 from peers.component import ComponentPeer
+from util.outbound_queue import OutboundLimits
 from util.utilities import get_random_string
 
 
@@ -15,10 +17,15 @@ class MediaPeer(ComponentPeer):
     ----------
     sync_assets
         Whether to sync assets
+    outbound_limits
+        Limits for the queue of messages to each component
+    sync_scheduler
+        Coordinates the syncing of assets to all components
     """
 
-    def __init__(self, sync_assets: bool):
-        super().__init__(["image", "video", "web", "audio"], sync_assets)
+    def __init__(self, sync_assets: bool, outbound_limits: Optional[OutboundLimits] = None,
+                 sync_scheduler: Optional[SyncScheduler] = None):
+        super().__init__(["image", "video", "web", "audio"], sync_assets, outbound_limits, sync_scheduler)
         self._available_target_types = {}
 
     def handle_component_message(self, component_id: str, message_type: str, message: object):
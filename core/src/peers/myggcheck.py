@@ -1,7 +1,8 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 from opus import Asset
 
 from peers.component import ComponentPeer
+from util.outbound_queue import OutboundLimits
 
 
 class MyggCheckPeer(ComponentPeer):
@@ -11,10 +12,12 @@ class MyggCheckPeer(ComponentPeer):
 
     Parameters
     ----------
+    outbound_limits
+        Limits for the queue of messages to each component
     """
 
-    def __init__(self):
-        super().__init__(["myggcheck"], False)
+    def __init__(self, outbound_limits: Optional[OutboundLimits] = None):
+        super().__init__(["myggcheck"], False, outbound_limits)
 
     def handle_action(
         self, target_type: str, cmd: str, assets: List[Asset], params: Dict[str, Any]
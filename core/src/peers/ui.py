@@ -1,22 +1,51 @@
-import base64
-from dataclasses import asdict
+import asyncio
+from dataclasses import asdict, dataclass
+from http import HTTPStatus
+import hashlib
 import json
 import time
 import traceback
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 import websockets
+from websockets.datastructures import Headers
 from websockets.server import WebSocketServerProtocol
 
 from opus import Opus, Node, ActionTemplate
+from opus_reload import OpusDiff
 from peers.component_info import ComponentInfo, ComponentState
 from util.event_emitter import EventEmitter
+from util.http_file import HTTPResponse, serve_file_data
+from util.log_store import LogStore
+from util.outbound_queue import HISTORY, LOGS, STATE, OutboundLimits, OutboundQueue, mark_input
+from util.subscriptions import Subscriptions
+
+
+@dataclass
+class UpdateCounters:
+    """Counts how well updates to the UIs are coalesced"""
+    # Effect and component changes and log messages
+    updates: int = 0
+    # Updates that were merged into an earlier one
+    merged: int = 0
+    # Messages broadcast with effect and component changes or logs
+    broadcasts: int = 0
+    # Broadcasts that were forced by a priority update
+    priority_flushes: int = 0
+
+    def report(self) -> str:
+        return (
+            f"{self.updates} updates sent in {self.broadcasts} broadcasts "
+            f"({self.merged} merged, {self.priority_flushes} priority flushes)"
+        )
 
 
 class UI(EventEmitter):
     """
     Handles communication with UIs.
 
-    This has a websocket server that the UI can connect to.
+    This has a websocket server that the UI can connect to. The script is
+    served over HTTP on the same port, under a URL with its hash, so
+    browsers can cache it between connections.
 
     Parameters
     ----------
@@ -24,6 +53,13 @@ class UI(EventEmitter):
         The opus. Some contents are sent in the initial handshake with a client.
     initial_history
         The initial history
+    flush_interval
+        Seconds to collect effect changes, component state and logs before
+        sending them to clients. If 0, every update is sent immediately.
+    log_store
+        Where to keep log messages. By default, the latest LogStore.DEFAULT_CAPACITY are kept.
+    outbound_limits
+        Limits for the queue of messages to each client
     """
 
     EFFECT_TYPES = {
@@ -34,49 +70,298 @@ class UI(EventEmitter):
         "web": 4,
     }
 
-    MAX_NOF_LOGS = 1000
+    # Log messages sent to a client when it connects. It can ask for more.
+    NOF_HANDSHAKE_LOGS = 200
+    MAX_LOGS_PAGE_SIZE = 1000
+
+    # Seconds between printing the update counters, if they have changed
+    COUNTERS_REPORT_INTERVAL = 60
+
+    # The class of each message type sent to clients, which decides whether
+    # it may be dropped for clients that are behind
+    MESSAGE_CLASSES = {
+        "nodes": HISTORY,
+        "nodes-changed": HISTORY,
+        "uiconfig": HISTORY,
+        "script": HISTORY,
+        "history": HISTORY,
+        "history-changed": HISTORY,
+        "state": STATE,
+        "state-changed": STATE,
+        "logs": LOGS,
+        "logs-added": LOGS,
+        # Answers to get-logs are not dropped, since the client waits for them
+        "logs-page": HISTORY,
+    }
 
-    def __init__(self, opus: Opus, initial_history: List[str]):
+    # Messages sent to a client when it connects, in order
+    HANDSHAKE_MESSAGES = ["nodes", "uiconfig", "history", "state", "logs", "script"]
+
+    # The topic of each message type. Clients only get messages of the
+    # topics they subscribe to, which by default are all of them. A topic is
+    # named after its message in the handshake.
+    TOPICS = HANDSHAKE_MESSAGES
+    MESSAGE_TOPICS = {
+        "nodes": "nodes",
+        "nodes-changed": "nodes",
+        "uiconfig": "uiconfig",
+        "script": "script",
+        "history": "history",
+        "history-changed": "history",
+        "state": "state",
+        "state-changed": "state",
+        "logs": "logs",
+        "logs-added": "logs",
+        "logs-page": "logs",
+    }
+
+    def __init__(self, opus: Opus, initial_history: List[str], flush_interval: float = 0.05,
+                 log_store: Optional[LogStore] = None, outbound_limits: Optional[OutboundLimits] = None):
         super().__init__()
         self._opus = opus
         self._history = initial_history
+        # Increased for every change of the history. Clients get the whole
+        # history with its sequence number, then each change, and ask for
+        # the whole history again if they miss one.
+        self._history_seq = 0
         self._components: Dict[str, ComponentState] = {}
         self._effects = {}
-        self._websockets: List[WebSocketServerProtocol] = []
-        self._logs = []
+        # Increased for every batch of changes of effects or components.
+        # Clients get a snapshot of the state at some version, followed by
+        # changes, and ask for a new snapshot if they miss a version.
+        self._state_version = 0
+        # Changes not sent yet, by (effect or component, ID). Only the latest
+        # change of each is kept, with patches merged.
+        self._pending_changes: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._pending_logs: List[Dict[str, Any]] = []
+        self._flush_interval = flush_interval
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.counters = UpdateCounters()
+        self._last_counters_report = time.monotonic()
+        self._reported_counters = UpdateCounters()
+        self._clients: List[OutboundQueue] = []
+        # The clients subscribed to each topic
+        self._subscriptions = Subscriptions(self.TOPICS)
+        self._outbound_limits = outbound_limits if outbound_limits is not None else OutboundLimits()
+        self._logs = log_store if log_store is not None else LogStore()
+        # Serialized messages, by message type. These are reused for every
+        # client until the data changes.
+        self._frames: Dict[str, str] = {}
+        self._script_hash = hashlib.sha256(opus.script).hexdigest()
+        # The opus is static, so prepare it for the first client already
+        for message_type in ["nodes", "uiconfig", "script"]:
+            self._get_frame(message_type)
+
+    def _get_message_data(self, message_type: str) -> Any:
+        if message_type == "nodes":
+            return {key: self._prepare_node_for_send(node) for key, node in self._opus.nodes.items()}
+        elif message_type == "uiconfig":
+            return asdict(self._opus.ui_config)
+        elif message_type == "history":
+            return {"seq": self._history_seq, "history": self._history}
+        elif message_type == "state":
+            return {
+                "version": self._state_version,
+                "effects": list(self._effects.values()),
+                "components": [asdict(component) for component in self._components.values()],
+            }
+        elif message_type == "logs":
+            return self._logs.latest(self.NOF_HANDSHAKE_LOGS)
+        elif message_type == "script":
+            return {"path": self._script_path(), "hash": self._script_hash}
+        raise ValueError(f"Unknown message type {message_type}")
+
+    def _get_frame(self, message_type: str) -> str:
+        """Get a serialized message, from the cache if the data hasn't changed."""
+        frame = self._frames.get(message_type)
+        if frame is None:
+            frame = json.dumps({
+                "messageType": message_type,
+                "data": self._get_message_data(message_type)
+            })
+            self._frames[message_type] = frame
+        return frame
+
+    def _script_path(self) -> str:
+        return f"/script/{self._script_hash}.pdf"
+
+    async def process_http_request(self, path: str, request_headers: Headers) -> Optional[HTTPResponse]:
+        """
+        Serve HTTP requests for the script.
+
+        This is used as the process_request hook of the websocket server.
+
+        Parameters
+        ----------
+        path
+            The requested path
+        request_headers
+            The headers of the request
+
+        Returns
+        -------
+        The response, or None if the request is for a websocket
+        """
+        if not path.startswith("/script/"):
+            return None
+        if path != self._script_path():
+            # An old version of the script, which we don't have anymore
+            return HTTPStatus.NOT_FOUND, Headers(), b""
+        return serve_file_data(request_headers, self._opus.script, self._script_hash, "application/pdf")
+
+    def _broadcast(self, message_type: str, data: Any):
+        """Send a message to all clients subscribed to its topic. It's only serialized if there are any."""
+        subscribers = self._subscriptions.subscribers(self.MESSAGE_TOPICS[message_type])
+        if not subscribers:
+            return
+        frame = json.dumps({"messageType": message_type, "data": data})
+        message_class = self.MESSAGE_CLASSES[message_type]
+        for client in subscribers:
+            client.send(frame, message_class)
+
+    def _send_update(self, message_type: str):
+        """Send a message to all subscribed clients, after its data has changed."""
+        self._frames.pop(message_type, None)
+        subscribers = self._subscriptions.subscribers(self.MESSAGE_TOPICS[message_type])
+        if not subscribers:
+            return
+        frame = self._get_frame(message_type)
+        message_class = self.MESSAGE_CLASSES[message_type]
+        for client in subscribers:
+            client.send(frame, message_class)
+
+    def changed_history(self, history: List[str], operation: Dict[str, Any]):
+        """
+        Update the history and send the change to clients.
 
-    def changed_history(self, history: List[str]):
-        """Update the history and send to clients."""
+        Parameters
+        ----------
+        history
+            The whole history
+        operation
+            What changed: push or goto (with the node), or pop
+        """
         self._history = history
-        websockets.broadcast(self._websockets, json.dumps({
-            "messageType": "history",
-            "data": self._history
-        }))
-
-    def _send_effects_update(self):
-        websockets.broadcast(self._websockets, json.dumps({
-            "messageType": "effects",
-            "data": list(self._effects.values())
-        }))
-
-    def _send_components_update(self):
-        websockets.broadcast(self._websockets, json.dumps({
-            "messageType": "components",
-            "data": [asdict(component) for component in self._components.values()]
-        }))
+        self._history_seq += 1
+        self._frames.pop("history", None)
+        # Send queued state now as well, instead of after the next interval
+        self._flush()
+        self._broadcast("history-changed", {"seq": self._history_seq, **operation})
+
+    def opus_changed(self, opus: Opus, diff: OpusDiff):
+        """Use a new version of the opus, and send what has changed to clients."""
+        self._opus = opus
+        self._frames.pop("nodes", None)
+        if diff.changed_nodes or diff.removed_nodes:
+            self._broadcast("nodes-changed", {
+                "changed": {key: self._prepare_node_for_send(opus.nodes[key]) for key in diff.changed_nodes},
+                "removed": list(diff.removed_nodes),
+            })
+        if diff.ui_config_changed:
+            self._send_update("uiconfig")
+        if diff.script_changed:
+            self._script_hash = hashlib.sha256(opus.script).hexdigest()
+            self._send_update("script")
+
+    def _queue_state_change(self, kind: str, entity_id: str, change_type: str,
+                            fields: Optional[Dict[str, Dict[str, Any]]] = None, priority: bool = False):
+        """
+        Queue a change of an effect or a component, to be sent on the next flush.
+
+        Parameters
+        ----------
+        kind
+            effect or component
+        entity_id
+            The ID of the effect or component
+        change_type
+            added, patched or removed
+        fields
+            For patches, the changed fields of each part (changes for effects,
+            info and state for components)
+        priority
+            Whether to send all queued updates immediately
+        """
+        self.counters.updates += 1
+        key = (kind, entity_id)
+        previous = self._pending_changes.get(key)
+        if previous is not None:
+            self.counters.merged += 1
+        if previous is not None and change_type == "patched" and previous["type"] != "removed":
+            # An added entity is sent as it is when flushing, so it already has the patch
+            if previous["type"] == "patched":
+                for part, part_fields in fields.items():
+                    previous.setdefault(part, {}).update(part_fields)
+        else:
+            self._pending_changes[key] = {"type": change_type, **(fields or {})}
+        self._schedule_flush(priority)
+
+    def _schedule_flush(self, priority: bool):
+        if priority or self._flush_interval <= 0:
+            if priority:
+                self.counters.priority_flushes += 1
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self._flush_interval, self._flush)
+
+    def _flush(self):
+        """Send all queued changes of effects and components, and logs, to all clients."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending_changes:
+            changes = [self._prepare_change_for_send(kind, entity_id, change)
+                       for (kind, entity_id), change in self._pending_changes.items()]
+            self._pending_changes = {}
+            self._state_version += 1
+            self._frames.pop("state", None)
+            self.counters.broadcasts += 1
+            self._broadcast("state-changed", {"version": self._state_version, "changes": changes})
+        if self._pending_logs:
+            self.counters.broadcasts += 1
+            self._broadcast("logs-added", self._pending_logs)
+            self._pending_logs = []
+        self._report_counters()
+
+    def _prepare_change_for_send(self, kind: str, entity_id: str, change: Dict[str, Any]) -> Dict[str, Any]:
+        change_type = change["type"]
+        if kind == "effect":
+            if change_type == "added":
+                return {"type": "effect-added", "effect": self._effects[entity_id]}
+            elif change_type == "patched":
+                return {"type": "effect-patched", "entityId": entity_id, "changes": change["changes"]}
+            return {"type": "effect-removed", "entityId": entity_id}
+        if change_type == "added":
+            return {"type": "component-added", "component": asdict(self._components[entity_id])}
+        elif change_type == "patched":
+            return {"type": "component-patched", "componentId": entity_id,
+                    "info": change.get("info", {}), "state": change.get("state", {})}
+        return {"type": "component-removed", "componentId": entity_id}
+
+    def _report_counters(self):
+        now = time.monotonic()
+        if now - self._last_counters_report < self.COUNTERS_REPORT_INTERVAL:
+            return
+        self._last_counters_report = now
+        if self.counters != self._reported_counters:
+            print(f"UI updates: {self.counters.report()}")
+            for client in self._clients:
+                print(f"  {client.report()}")
+            self._reported_counters = UpdateCounters(**asdict(self.counters))
+
+    @staticmethod
+    def _changed_fields(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in new.items() if key not in old or old[key] != value}
 
     def _send_logs_update(self):
-        websockets.broadcast(self._websockets, json.dumps({
-            "messageType": "logs",
-            "data": self._logs
-        }))
+        self._send_update("logs")
 
     def effect_added(self, event_data):
         entity_id = event_data["entityId"]
         event_data["type"] = self.EFFECT_TYPES.get(event_data["effectType"], 0)
         del event_data["effectType"]
         self._effects[entity_id] = event_data
-        self._send_effects_update()
+        self._queue_state_change("effect", entity_id, "added", priority=True)
     
     def effect_changed(self, event_data):
         entity_id = event_data["entityId"]
@@ -85,51 +370,60 @@ class UI(EventEmitter):
         if not entity_id in self._effects:
             print(f"Tried to update effect {entity_id} but it doesnt exist. Skipping")
             return
-        self._effects[entity_id].update(event_data)
-        self._send_effects_update()
+        effect = self._effects[entity_id]
+        changes = self._changed_fields(effect, event_data)
+        if not changes:
+            return
+        effect.update(changes)
+        self._queue_state_change("effect", entity_id, "patched", {"changes": changes})
     
     def effect_removed(self, event_data):
         entity_id = event_data["entityId"]
         if entity_id in self._effects:
             del self._effects[entity_id]
-            self._send_effects_update()
+            self._queue_state_change("effect", entity_id, "removed", priority=True)
         else:
             print(f"Tried to remove effect but couldnt find it")
 
     def log_message(self, level: str, timestamp: float, origin: str, message: str):
-        self._logs.append({
-            "level": level,
-            "timestamp": timestamp,
-            "origin": origin,
-            "message": message,
-        })
-        while len(self._logs) > self.MAX_NOF_LOGS:
-            self._logs.pop(0)
-        websockets.broadcast(self._websockets, json.dumps({
-            "messageType": "log-added",
-            "data": self._logs[-1]
-        }))
+        log = self._logs.append(level, timestamp, origin, message)
+        self._frames.pop("logs", None)
+        self.counters.updates += 1
+        if self._pending_logs:
+            self.counters.merged += 1
+        self._pending_logs.append(log)
+        self._schedule_flush(priority=level == "error")
 
     def clear_logs(self):
-        self._logs = []
+        self._logs.clear()
+        self._pending_logs = []
         self._send_logs_update()
 
     def component_info_updated(self, component: ComponentInfo) -> None:
-        if component.componentId in self._components:
-            self._components[component.componentId].info = component
+        component_id = component.componentId
+        if component_id in self._components:
+            changes = self._changed_fields(asdict(self._components[component_id].info), asdict(component))
+            self._components[component_id].info = component
+            if changes:
+                self._queue_state_change("component", component_id, "patched", {"info": changes}, priority=True)
         else:
-            self._components[component.componentId] = ComponentState(component, {})
-        self._send_components_update()
+            self._components[component_id] = ComponentState(component, {})
+            self._queue_state_change("component", component_id, "added", priority=True)
 
     def component_state_updated(self, component_id: str, state: Dict[str, Any]):
-        if component_id in self._components:
-            self._components[component_id].state.update(state)
-        self._send_components_update()
+        if component_id not in self._components:
+            return
+        component_state = self._components[component_id].state
+        changes = self._changed_fields(component_state, state)
+        if not changes:
+            return
+        component_state.update(changes)
+        self._queue_state_change("component", component_id, "patched", {"state": changes})
 
     def component_removed(self, component_id: str) -> None:
         if component_id in self._components:
             del self._components[component_id]
-            self._send_components_update()
+            self._queue_state_change("component", component_id, "removed", priority=True)
 
     def _prepare_node_for_send(self, node: Node) -> Dict[str, Any]:
         data = asdict(node)
@@ -139,42 +433,54 @@ class UI(EventEmitter):
                 nextChoice["actions"] = [asdict(self._opus.action_templates.get(action)) for action in nextChoice["actions"]]
         return data
 
-    async def handle_socket(self, websocket: WebSocketServerProtocol):
-        """This handles one websocket connection."""
-        self._websockets.append(websocket)
-        # Handshake
-        await websocket.send(json.dumps({
-            "messageType": "nodes",
-            "data": {key: self._prepare_node_for_send(node) for key, node in self._opus.nodes.items()}
-        }))
-        await websocket.send(json.dumps({
-            "messageType": "uiconfig",
-            "data": asdict(self._opus.ui_config)
-        }))
-        await websocket.send(json.dumps({
-            "messageType": "history",
-            "data": self._history
-        }))
-        await websocket.send(json.dumps({
-            "messageType": "components",
-            "data": [asdict(component) for component in self._components.values()]
-        }))
-        await websocket.send(json.dumps({
-            "messageType": "effects",
-            "data": list(self._effects.values())
-        }))
-        await websocket.send(json.dumps({
-            "messageType": "logs",
-            "data": self._logs
-        }))
-        base64_script = base64.b64encode(
-            self._opus.script).decode("utf-8")
-        await websocket.send(json.dumps({
-            "messageType": "script",
-            "data": f"data:application/pdf;base64,{base64_script}"
-        }))
-        # Handle messages from the client
+    async def handle_socket(self, websocket: WebSocketServerProtocol, initial_message: Dict[str, Any]):
+        """
+        This handles one websocket connection.
+
+        Parameters
+        ----------
+        websocket
+            The websocket
+        initial_message
+            The hello from the client. It may list the topics to subscribe
+            to ("topics"), otherwise the client subscribes to all of them.
+        """
+        topics = initial_message.get("topics", self.TOPICS)
+        unknown_topics = self._subscriptions.unknown(topics)
+        if unknown_topics:
+            print(f"Refusing UI {websocket.remote_address}, with unknown topics {', '.join(unknown_topics)}")
+            return
+        # Queued updates are already in the handshake, so send them to the
+        # other clients before adding this one
+        self._flush()
+        client = OutboundQueue(websocket, f"UI {websocket.remote_address}", self._outbound_limits)
+        self._clients.append(client)
+        try:
+            self._subscribe(client, topics)
+            await self._handle_messages(websocket, client)
+        except websockets.exceptions.ConnectionClosedError as cce:
+            print(f"Websocket to UI closed abruptly: {cce}")
+        finally:
+            # Websocket is closed
+            client.close()
+            self._clients.remove(client)
+            self._subscriptions.remove(client)
+
+    def _subscribe(self, client: OutboundQueue, topics: Iterable[str]):
+        """
+        Subscribe a client to topics, and send it the current data of each new one.
+
+        The data is sent in the order of the handshake. The frames are only
+        serialized if they have changed since they were last sent.
+        """
+        for topic in self._subscriptions.subscribe(client, topics):
+            client.send(self._get_frame(topic), self.MESSAGE_CLASSES[topic])
+
+    async def _handle_messages(self, websocket: WebSocketServerProtocol, client: OutboundQueue):
+        """Handle messages from a client, until it disconnects."""
         async for message in websocket:
+            # Measure the latency until the messages caused by this are written
+            mark_input()
             try:
                 message_dict = json.loads(message)
                 message_type = message_dict["messageType"]
@@ -199,6 +505,30 @@ class UI(EventEmitter):
                     asset_names = message_dict["assets"]
                     params = message_dict["params"]
                     self.emit("component-action", target, cmd, asset_names, params)
+                elif message_type == "subscribe":
+                    # Queued updates would arrive after the snapshot, so send them first
+                    self._flush()
+                    self._subscribe(client, message_dict["topics"])
+                elif message_type == "unsubscribe":
+                    self._subscriptions.unsubscribe(client, message_dict["topics"])
+                elif message_type == "get-history":
+                    # The client has missed a history change
+                    client.send(self._get_frame("history"), HISTORY)
+                elif message_type == "get-state":
+                    # The client has missed a state delta. The answer isn't
+                    # dropped like other state, since the client waits for it.
+                    client.send(self._get_frame("state"), HISTORY)
+                elif message_type == "get-logs":
+                    page = self._logs.page(
+                        since=message_dict.get("since", 0),
+                        before=message_dict.get("before"),
+                        min_level=message_dict.get("minLevel"),
+                        limit=min(message_dict.get("limit", 100), self.MAX_LOGS_PAGE_SIZE),
+                    )
+                    client.send(json.dumps({
+                        "messageType": "logs-page",
+                        "data": page
+                    }), self.MESSAGE_CLASSES["logs-page"])
                 elif message_type == "clear-logs":
                     self.clear_logs()
                 elif message_type == "component-reset":
@@ -214,5 +544,3 @@ class UI(EventEmitter):
                 print(f"Failed to handle UI message. Got error {e}")
                 self.log_message("error", time.time(), "core", f"Failed to handle UI message. Got error {e}")
                 traceback.print_exc()
-        # Websocket is closed
-        self._websockets.remove(websocket)
@@ -12,6 +12,9 @@ class Performance(EventEmitter):
     It is responsible for keeping runtime state of a performance,
     and taking appropriate actions based on the current node.
 
+    When the history changes, history-changed is emitted with the history
+    and the operation: push or goto (with the node), or pop.
+
     Parameters
     ----------
     opus
@@ -23,6 +26,27 @@ class Performance(EventEmitter):
         self._nodes = opus.nodes
         self.history = [opus.start_node]
 
+    def opus_changed(self, opus: Opus):
+        """
+        Continue the performance with a new version of the opus, keeping the history.
+
+        If the current node no longer exists, the performance goes back to
+        the last node in the history that does, or to the start node.
+        """
+        self._nodes = opus.nodes
+        missing_nodes = [node_id for node_id in set(self.history) if node_id not in self._nodes]
+        if missing_nodes:
+            print(f"Warning: Nodes in the history no longer exist: {', '.join(missing_nodes)}")
+        if self.history[-1] in self._nodes:
+            return
+        while len(self.history) > 1 and self.history[-1] not in self._nodes:
+            self.history.pop(-1)
+            self.emit("history-changed", self.history, {"op": "pop"})
+        if self.history[-1] not in self._nodes:
+            self.history.append(opus.start_node)
+            self.emit("history-changed", self.history, {"op": "goto", "node": opus.start_node})
+        print(f"The current node no longer exists, went back to {self.history[-1]}")
+
     def next_node(self, run_actions: bool):
         """Go to the next node."""
         current_node = self._nodes[self.history[-1]]
@@ -33,15 +57,17 @@ class Performance(EventEmitter):
             print("Going to next node")
             next_node_id = current_node.next
             self.history.append(next_node_id)
-            self.emit("history-changed", self.history)
+            self.emit("history-changed", self.history, {"op": "push", "node": next_node_id})
         else:
             print("Cannot go to next node, we're at a choice")
 
     def prev_node(self):
         """Go to the prev node (edit history)"""
-        if len(self.history) > 1:
+        if len(self.history) > 1 and self.history[-2] not in self._nodes:
+            print("Cannot go to prev node, it no longer exists")
+        elif len(self.history) > 1:
             self.history.pop(-1)
-            self.emit("history-changed", self.history)
+            self.emit("history-changed", self.history, {"op": "pop"})
         else:
             print("Cannot go to prev node, history is too short")
 
@@ -51,7 +77,7 @@ class Performance(EventEmitter):
             print("Tried to move to a non-existing node. Skipping...")
             return
         self.history.append(node_id)
-        self.emit("history-changed", self.history)
+        self.emit("history-changed", self.history, {"op": "goto", "node": node_id})
 
     def run_actions(self):
         """Runs the actions on the current node"""
@@ -80,4 +106,4 @@ class Performance(EventEmitter):
 
             next_node_id = current_node.next[choice_index].node
             self.history.append(next_node_id)
-            self.emit("history-changed", self.history)
\ No newline at end of file
+            self.emit("history-changed", self.history, {"op": "push", "node": next_node_id})
\ No newline at end of file
@@ -0,0 +1,369 @@
+"""
+A read-only relay between Core and many UIs that only watch the performance.
+
+The relay connects to Core once, as a UI, and serves any number of viewer
+UIs on its own port. Every message from Core is forwarded as it is to the
+viewers subscribed to its topic, so the cost for Core doesn't grow with the
+number of viewers. The relay keeps the latest data of each topic, so viewers
+get their handshake (and answers to get-history, get-state and get-logs)
+from the relay. It also serves the script over HTTP, fetching it from Core
+once.
+
+Viewers can't control the performance: messages such as next-node are
+refused.
+
+Run from the core directory: pdm run src/relay.py
+"""
+import asyncio
+from http import HTTPStatus
+import json
+import os
+import traceback
+from typing import Any, Dict, Iterable, List, Optional
+import urllib.request
+
+import websockets
+from websockets.client import WebSocketClientProtocol
+from websockets.datastructures import Headers
+from websockets.server import WebSocketServerProtocol
+
+from peers.ui import UI
+from util.http_file import HTTPResponse, serve_file_data
+from util.log_store import LogStore
+from util.outbound_queue import HISTORY, OutboundLimits, OutboundQueue
+from util.subscriptions import Subscriptions
+
+
+class Relay:
+    """
+    Relays messages from Core to viewer UIs.
+
+    Parameters
+    ----------
+    core_address
+        The address of Core, e.g. localhost:8001
+    port
+        The port to serve viewers on
+    outbound_limits
+        Limits for the queue of messages to each viewer
+    """
+
+    # Seconds between attempts to connect to Core
+    RECONNECT_INTERVAL = 3
+    # Messages viewers may send. Everything else is refused.
+    VIEWER_MESSAGES = {"subscribe", "unsubscribe", "get-history", "get-state", "get-logs"}
+
+    def __init__(self, core_address: str, port: int, outbound_limits: OutboundLimits):
+        self._core_address = core_address
+        self._port = port
+        self._outbound_limits = outbound_limits
+        self._upstream: Optional[WebSocketClientProtocol] = None
+        # The latest data of each topic, as in the handshake from Core,
+        # and its serialized message. The message is serialized again when
+        # the data has changed.
+        self._data: Dict[str, Any] = {}
+        self._frames: Dict[str, str] = {}
+        # The history and the state, kept up to date with changes
+        self._history_seq = 0
+        self._history: List[str] = []
+        self._state_version = 0
+        self._effects: Dict[str, Dict[str, Any]] = {}
+        self._components: Dict[str, Dict[str, Any]] = {}
+        self._logs = LogStore()
+        # Snapshots requested from Core after a missed change, by topic.
+        # Changes of the topic are ignored until the snapshot arrives.
+        self._snapshot_requests: Dict[str, asyncio.Task] = {}
+        # The script, once it has been fetched from Core
+        self._script: Optional[bytes] = None
+        self._script_fetch: Optional[asyncio.Task] = None
+        self._viewers: List[OutboundQueue] = []
+        self._subscriptions = Subscriptions(UI.TOPICS)
+
+    async def main(self):
+        """The main loop."""
+        upstream = asyncio.create_task(self._connect_upstream())
+        print(f"Relaying from Core at {self._core_address}")
+        async with websockets.serve(self.socket_listener, "0.0.0.0", self._port,
+                                    process_request=self.process_http_request):
+            await upstream  # run forever
+
+    async def _connect_upstream(self):
+        """Keep a connection to Core, and handle all messages from it."""
+        while True:
+            try:
+                async with websockets.connect(f"ws://{self._core_address}", max_size=None) as websocket:
+                    print("Connected to Core")
+                    self._upstream = websocket
+                    await websocket.send(json.dumps({"client": "ui"}))
+                    async for frame in websocket:
+                        try:
+                            self._handle_upstream_message(frame)
+                        except Exception as e:
+                            print(f"Failed to handle message from Core. Got error {e}")
+                            traceback.print_exc()
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                print(f"No connection to Core: {e}")
+            self._upstream = None
+            # The handshake after reconnecting has all snapshots
+            self._snapshot_requests.clear()
+            # Viewers keep the data they have until Core is back
+            await asyncio.sleep(self.RECONNECT_INTERVAL)
+
+    def _request_snapshot(self, topic: str):
+        """Ask Core for the snapshot of a topic after a missed change, unless it has already been asked."""
+        if self._upstream is not None and topic not in self._snapshot_requests:
+            self._snapshot_requests[topic] = asyncio.create_task(
+                self._upstream.send(json.dumps({"messageType": f"get-{topic}"})))
+
+    def _handle_upstream_message(self, frame: str):
+        message = json.loads(frame)
+        message_type = message["messageType"]
+        data = message["data"]
+        if message_type in UI.HANDSHAKE_MESSAGES:
+            # A snapshot, which replaces what we have
+            self._set_snapshot(message_type, data, frame)
+        elif message_type == "history-changed":
+            if "history" in self._snapshot_requests:
+                return
+            if data["seq"] != self._history_seq + 1:
+                print(f"Missed history change {self._history_seq + 1}, requesting history")
+                self._request_snapshot("history")
+                return
+            self._history_seq = data["seq"]
+            if data["op"] == "pop":
+                self._history.pop()
+            else:
+                self._history.append(data["node"])
+            self._set_changed("history")
+        elif message_type == "state-changed":
+            if "state" in self._snapshot_requests:
+                return
+            if data["version"] != self._state_version + 1:
+                print(f"Missed state version {self._state_version + 1}, requesting state")
+                self._request_snapshot("state")
+                return
+            self._state_version = data["version"]
+            for change in data["changes"]:
+                self._apply_state_change(change)
+            self._set_changed("state")
+        elif message_type == "nodes-changed":
+            nodes = self._data.get("nodes", {})
+            nodes.update(data["changed"])
+            for node_id in data["removed"]:
+                nodes.pop(node_id, None)
+            self._set_changed("nodes")
+        elif message_type == "logs-added":
+            for log in data:
+                self._logs.add(log)
+            self._set_changed("logs")
+        else:
+            print(f"WARNING: Unknown message type from Core {message_type}")
+            return
+        self._broadcast(message_type, frame)
+
+    def _set_snapshot(self, message_type: str, data: Any, frame: str):
+        self._snapshot_requests.pop(message_type, None)
+        if message_type == "history":
+            self._history_seq = data["seq"]
+            self._history = data["history"]
+        elif message_type == "state":
+            self._state_version = data["version"]
+            self._effects = {effect["entityId"]: effect for effect in data["effects"]}
+            self._components = {component["info"]["componentId"]: component for component in data["components"]}
+        elif message_type == "logs":
+            self._logs.clear()
+            for log in data:
+                self._logs.add(log)
+        elif message_type == "script" and data["hash"] != self._data.get("script", {}).get("hash"):
+            self._script = None
+            if self._script_fetch is not None:
+                self._script_fetch.cancel()
+                self._script_fetch = None
+        self._data[message_type] = data
+        self._frames[message_type] = frame
+
+    def _set_changed(self, topic: str):
+        """Mark that the data of a topic has changed, so its handshake message is serialized again."""
+        self._frames.pop(topic, None)
+
+    def _apply_state_change(self, change: Dict[str, Any]):
+        change_type = change["type"]
+        if change_type == "effect-added":
+            self._effects[change["effect"]["entityId"]] = change["effect"]
+        elif change_type == "effect-patched":
+            if change["entityId"] in self._effects:
+                self._effects[change["entityId"]] = {**self._effects[change["entityId"]], **change["changes"]}
+        elif change_type == "effect-removed":
+            self._effects.pop(change["entityId"], None)
+        elif change_type == "component-added":
+            self._components[change["component"]["info"]["componentId"]] = change["component"]
+        elif change_type == "component-patched":
+            component = self._components.get(change["componentId"])
+            if component is not None:
+                self._components[change["componentId"]] = {
+                    "info": {**component["info"], **change["info"]},
+                    "state": {**component["state"], **change["state"]},
+                }
+        elif change_type == "component-removed":
+            self._components.pop(change["componentId"], None)
+
+    def _get_frame(self, topic: str) -> Optional[str]:
+        """Get the handshake message of a topic, or None if we haven't got it from Core yet."""
+        if topic not in self._data:
+            return None
+        frame = self._frames.get(topic)
+        if frame is None:
+            if topic == "history":
+                self._data[topic] = {"seq": self._history_seq, "history": self._history}
+            elif topic == "state":
+                self._data[topic] = {
+                    "version": self._state_version,
+                    "effects": list(self._effects.values()),
+                    "components": list(self._components.values()),
+                }
+            elif topic == "logs":
+                self._data[topic] = self._logs.latest(UI.NOF_HANDSHAKE_LOGS)
+            frame = json.dumps({"messageType": topic, "data": self._data[topic]})
+            self._frames[topic] = frame
+        return frame
+
+    def _broadcast(self, message_type: str, frame: str):
+        """Forward a message from Core to the viewers subscribed to its topic."""
+        message_class = UI.MESSAGE_CLASSES[message_type]
+        for viewer in self._subscriptions.subscribers(UI.MESSAGE_TOPICS[message_type]):
+            viewer.send(frame, message_class)
+
+    def _send_topic(self, viewer: OutboundQueue, topic: str, message_class: Optional[str] = None):
+        frame = self._get_frame(topic)
+        if frame is not None:
+            viewer.send(frame, message_class or UI.MESSAGE_CLASSES[topic])
+
+    def _subscribe(self, viewer: OutboundQueue, topics: Iterable[str]):
+        """Subscribe a viewer to topics, and send it what we have of each new one."""
+        for topic in self._subscriptions.subscribe(viewer, topics):
+            self._send_topic(viewer, topic)
+
+    async def socket_listener(self, websocket: WebSocketServerProtocol, _path: str):
+        """
+        This function handles an incoming websocket connection from a viewer.
+
+        Parameters
+        ----------
+        websocket
+            The websocket
+        """
+        # Wait for a hello
+        hello = json.loads(await websocket.recv())
+        if hello.get("client") != "ui":
+            print(f"An unsupported client type tried to connect: {hello.get('client')}")
+            return
+        topics = hello.get("topics", UI.TOPICS)
+        unknown_topics = self._subscriptions.unknown(topics)
+        if unknown_topics:
+            print(f"Refusing viewer {websocket.remote_address}, with unknown topics {', '.join(unknown_topics)}")
+            return
+        viewer = OutboundQueue(websocket, f"Viewer {websocket.remote_address}", self._outbound_limits)
+        self._viewers.append(viewer)
+        try:
+            self._subscribe(viewer, topics)
+            await self._handle_viewer_messages(websocket, viewer)
+        except websockets.exceptions.ConnectionClosedError as cce:
+            print(f"Websocket to viewer closed abruptly: {cce}")
+        finally:
+            # Websocket is closed
+            viewer.close()
+            self._viewers.remove(viewer)
+            self._subscriptions.remove(viewer)
+
+    async def _handle_viewer_messages(self, websocket: WebSocketServerProtocol, viewer: OutboundQueue):
+        """Handle messages from a viewer, until it disconnects."""
+        async for message in websocket:
+            try:
+                message_dict = json.loads(message)
+                message_type = message_dict["messageType"]
+                if message_type not in self.VIEWER_MESSAGES:
+                    print(f"Refusing {message_type} from {viewer.name}, since viewers are read-only")
+                elif message_type == "subscribe":
+                    self._subscribe(viewer, message_dict["topics"])
+                elif message_type == "unsubscribe":
+                    self._subscriptions.unsubscribe(viewer, message_dict["topics"])
+                elif message_type == "get-history":
+                    self._send_topic(viewer, "history")
+                elif message_type == "get-state":
+                    # Not dropped like other state, since the viewer waits for it
+                    self._send_topic(viewer, "state", HISTORY)
+                elif message_type == "get-logs":
+                    page = self._logs.page(
+                        since=message_dict.get("since", 0),
+                        before=message_dict.get("before"),
+                        min_level=message_dict.get("minLevel"),
+                        limit=min(message_dict.get("limit", 100), UI.MAX_LOGS_PAGE_SIZE),
+                    )
+                    viewer.send(json.dumps({
+                        "messageType": "logs-page",
+                        "data": page
+                    }), UI.MESSAGE_CLASSES["logs-page"])
+            except Exception as e:
+                print(f"Failed to handle viewer message. Got error {e}")
+                traceback.print_exc()
+
+    async def process_http_request(self, path: str, request_headers: Headers) -> Optional[HTTPResponse]:
+        """
+        Serve HTTP requests for the script, which is fetched from Core the first time.
+
+        This is used as the process_request hook of the websocket server.
+
+        Parameters
+        ----------
+        path
+            The requested path
+        request_headers
+            The headers of the request
+
+        Returns
+        -------
+        The response, or None if the request is for a websocket
+        """
+        if not path.startswith("/script/"):
+            return None
+        script = self._data.get("script")
+        if script is None or path != script["path"]:
+            return HTTPStatus.NOT_FOUND, Headers(), b""
+        data = self._script
+        if data is None:
+            # Viewers asking at the same time share one fetch
+            if self._script_fetch is None:
+                self._script_fetch = asyncio.create_task(self._fetch_script(script["path"]))
+            fetch = self._script_fetch
+            try:
+                data = await asyncio.shield(fetch)
+            except (OSError, asyncio.CancelledError) as e:
+                print(f"Failed to fetch the script from Core: {e!r}")
+                if fetch is self._script_fetch:
+                    self._script_fetch = None
+                return HTTPStatus.BAD_GATEWAY, Headers(), b""
+            # Unless the script changed while fetching it
+            if fetch is self._script_fetch:
+                self._script = data
+        return serve_file_data(request_headers, data, script["hash"], "application/pdf")
+
+    async def _fetch_script(self, path: str) -> bytes:
+        def fetch():
+            with urllib.request.urlopen(f"http://{self._core_address}{path}") as response:
+                return response.read()
+        return await asyncio.to_thread(fetch)
+
+
+if __name__ == "__main__":
+    relay = Relay(
+        os.environ.get("SCREENCRASH_RELAY_CORE", "localhost:8001"),
+        int(os.environ.get("SCREENCRASH_RELAY_PORT", "8002")),
+        OutboundLimits(
+            high_water_mark=int(os.environ.get("SCREENCRASH_OUTBOUND_HIGH_WATER_MARK", "256")),
+            evict_after=float(os.environ.get("SCREENCRASH_OUTBOUND_EVICT_AFTER", "10")),
+        ),
+    )
+    try:
+        asyncio.run(relay.main())
+    except KeyboardInterrupt:
+        print("Exiting")
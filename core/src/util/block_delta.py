@@ -0,0 +1,111 @@
+"""
+Block level deltas between two versions of a file, like rsync.
+
+The receiver splits its old version of the file into blocks, and sends a
+signature of each block: a weak hash (Adler-32) and a strong hash (the first
+8 bytes of MD5). The sender finds the blocks in the new version, at any
+offset, by rolling the weak hash over it one byte at a time and checking the
+strong hash only when the weak one matches. The delta is then a list of
+operations that build the new version: copies of blocks from the old
+version, and new data.
+
+The signatures and block sizes are shared with the components, in
+screencrash_common.block_signature.
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+from screencrash_common.block_signature import strong_hash, weak_hash
+
+# Adler-32 (the weak hash) is computed modulo this
+_ADLER_MOD = 65521
+
+
+@dataclass
+class Copy:
+    """Copy data from the old version of the file"""
+    source_offset: int
+    length: int
+
+
+@dataclass
+class Data:
+    """New data, from the new version of the file"""
+    start: int
+    end: int
+
+
+Operation = Union[Copy, Data]
+
+
+def compute_delta(data: memoryview, block_size: int, weak: List[int], strong: List[bytes],
+                  max_new_data: int) -> Optional[List[Operation]]:
+    """
+    Compute the operations that build a new version of a file from an old one.
+
+    Parameters
+    ----------
+    data
+        The new version of the file
+    block_size
+        The size of the blocks of the old version
+    weak
+        The weak hash of each block of the old version
+    strong
+        The strong hash of each block of the old version
+    max_new_data
+        Give up if more new data than this is needed, since the delta would
+        not save much (and finding it is slow when little matches)
+
+    Returns
+    -------
+    The operations, in order, or None if more new data than max_new_data is needed
+    """
+    blocks_by_weak: Dict[int, List[int]] = {}
+    for index, block_weak_hash in enumerate(weak):
+        blocks_by_weak.setdefault(block_weak_hash, []).append(index)
+
+    operations: List[Operation] = []
+    new_data = 0
+    size = len(data)
+    data_start = 0  # Where the new data not yet in an operation starts
+    position = 0
+    a = b = None
+    while position + block_size <= size:
+        if a is None:
+            checksum = weak_hash(data[position:position + block_size])
+            a = checksum & 0xffff
+            b = checksum >> 16
+        candidates = blocks_by_weak.get((b << 16) | a)
+        if candidates:
+            block_hash = strong_hash(data[position:position + block_size])
+            match = next((index for index in candidates if strong[index] == block_hash), None)
+            if match is not None:
+                if data_start < position:
+                    operations.append(Data(data_start, position))
+                source_offset = match * block_size
+                previous = operations[-1] if operations else None
+                if (isinstance(previous, Copy)
+                        and previous.source_offset + previous.length == source_offset):
+                    previous.length += block_size
+                else:
+                    operations.append(Copy(source_offset, block_size))
+                position += block_size
+                data_start = position
+                a = None
+                continue
+        # Roll the hash one byte forward
+        if position + block_size < size:
+            old_byte = data[position]
+            new_byte = data[position + block_size]
+            a = (a - old_byte + new_byte) % _ADLER_MOD
+            b = (b - block_size * old_byte + a - 1) % _ADLER_MOD
+        position += 1
+        new_data += 1
+        if new_data > max_new_data:
+            return None
+    if data_start < size:
+        if new_data + size - position > max_new_data:
+            return None
+        operations.append(Data(data_start, size))
+    return operations
@@ -0,0 +1,117 @@
+import http
+import re
+from typing import Optional, Tuple, Union
+
+from websockets.datastructures import Headers
+
+# An HTTP response, as returned from a websockets process_request hook
+HTTPResponse = Tuple[http.HTTPStatus, Headers, bytes]
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def file_response(request_headers: Headers, size: int, etag: str, content_type: str,
+                  max_length: Optional[int] = None) -> Tuple[http.HTTPStatus, Headers, Optional[Tuple[int, int]]]:
+    """
+    Decide how to respond to a GET request for immutable data, before reading it.
+
+    The data is expected to be served under a URL containing its hash, so it
+    can be cached forever. Conditional requests (If-None-Match) and single
+    byte ranges (Range) are supported.
+
+    Parameters
+    ----------
+    request_headers
+        The headers of the request
+    size
+        The length of the data
+    etag
+        The entity tag of the data, without quotes (e.g. its hash)
+    content_type
+        The MIME type of the data
+    max_length
+        The most data to send in one response, or None for no limit. Longer
+        ranges are shortened from their start (206, with a Content-Range
+        telling what was sent). Requests for all of longer data, without a
+        range or with an If-Range that doesn't match, are refused with 400
+        Bad Request, since they can't get all of it in one response.
+
+    Returns
+    -------
+    The status, the headers, and the range of the data to send (start and
+    inclusive end), or None if no data should be sent
+    """
+    quoted_etag = f'"{etag}"'
+    headers = Headers()
+    headers["ETag"] = quoted_etag
+    headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    headers["Accept-Ranges"] = "bytes"
+    # The UI is not served from Core
+    headers["Access-Control-Allow-Origin"] = "*"
+    headers["Access-Control-Expose-Headers"] = "ETag, Content-Range, Accept-Ranges, Content-Length"
+
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None and (if_none_match.strip() == "*" or quoted_etag in if_none_match):
+        return http.HTTPStatus.NOT_MODIFIED, headers, None
+
+    headers["Content-Type"] = content_type
+    byte_range = _parse_range(request_headers.get("Range"), size)
+    if_range = request_headers.get("If-Range")
+    if byte_range is None or (if_range is not None and if_range != quoted_etag):
+        if max_length is not None and size > max_length:
+            # Assigning to Headers adds a header, so the data's type is removed first
+            del headers["Content-Type"]
+            headers["Content-Type"] = "text/plain"
+            return http.HTTPStatus.BAD_REQUEST, headers, None
+        return http.HTTPStatus.OK, headers, (0, size - 1)
+    if byte_range == ():
+        headers["Content-Range"] = f"bytes */{size}"
+        return http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers, None
+    start, end = byte_range
+    if max_length is not None:
+        end = min(end, start + max_length - 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return http.HTTPStatus.PARTIAL_CONTENT, headers, (start, end)
+
+
+def serve_file_data(request_headers: Headers, data: Union[bytes, memoryview], etag: str,
+                    content_type: str) -> HTTPResponse:
+    """
+    Respond to a GET request for immutable data, see file_response.
+
+    Returns
+    -------
+    The response
+    """
+    status, headers, byte_range = file_response(request_headers, len(data), etag, content_type)
+    body = bytes(data[byte_range[0]:byte_range[1] + 1]) if byte_range is not None else b""
+    return status, headers, body
+
+
+def _parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, ...]]:
+    """
+    Parse a Range header.
+
+    Returns None if the whole data should be sent (no or unsupported range),
+    an empty tuple if the range can't be satisfied, and (start, end) otherwise,
+    where end is inclusive.
+    """
+    if range_header is None:
+        return None
+    match = RANGE_PATTERN.fullmatch(range_header.strip())
+    if match is None:
+        return None  # E.g. multiple ranges, which we don't support
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+    if start == "":
+        # Suffix range, the last bytes
+        length = int(end)
+        if length == 0:
+            return ()
+        return (max(size - length, 0), size - 1)
+    start = int(start)
+    end = min(int(end), size - 1) if end != "" else size - 1
+    if start >= size or start > end:
+        return ()
+    return (start, end)
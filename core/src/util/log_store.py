@@ -0,0 +1,176 @@
+import asyncio
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import aiofiles
+
+# Log levels, from least to most severe. Unknown levels count as info.
+LOG_LEVELS = ["debug", "info", "warning", "error"]
+
+
+def level_severity(level: str) -> int:
+    return LOG_LEVELS.index(level) if level in LOG_LEVELS else LOG_LEVELS.index("info")
+
+
+class LogStore:
+    """
+    The most recent log messages, with increasing sequence numbers.
+
+    The messages are kept in a fixed size ring buffer, so old messages are
+    dropped when it is full without any cost per message. Optionally, every
+    message is also appended to a file (as JSON lines), which is written in
+    the background.
+
+    Parameters
+    ----------
+    capacity
+        How many messages to keep, at least 1. By default, DEFAULT_CAPACITY.
+    file_path
+        A file to append all messages to, or None
+    """
+
+    DEFAULT_CAPACITY = 10000
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, file_path: Optional[Path] = None):
+        if capacity < 1:
+            raise ValueError(f"Must keep at least 1 log message, got {capacity}")
+        self._buffer: List[Optional[Dict[str, Any]]] = [None] * capacity
+        # Where the oldest message is in the buffer, and how many there are
+        self._start = 0
+        self._size = 0
+        self._next_seq = 1
+        self._file_path = file_path
+        self._file_queue: Optional[asyncio.Queue] = None
+        self._file_task: Optional[asyncio.Task] = None
+
+    def append(self, level: str, timestamp: float, origin: str, message: str) -> Dict[str, Any]:
+        """
+        Add a log message.
+
+        Returns
+        -------
+        The message, as sent to clients
+        """
+        log = {
+            "seq": self._next_seq,
+            "level": level,
+            "timestamp": timestamp,
+            "origin": origin,
+            "message": message,
+        }
+        self.add(log)
+        return log
+
+    def add(self, log: Dict[str, Any]):
+        """
+        Add a message which already has a sequence number, e.g. from Core.
+
+        The sequence numbers must increase, but there may be gaps.
+        """
+        self._next_seq = log["seq"] + 1
+        capacity = len(self._buffer)
+        if self._size < capacity:
+            self._buffer[(self._start + self._size) % capacity] = log
+            self._size += 1
+        else:
+            self._buffer[self._start] = log
+            self._start = (self._start + 1) % capacity
+        if self._file_path is not None:
+            self._write_to_file(log)
+
+    def clear(self):
+        """Remove all messages. Sequence numbers keep increasing, and the file is kept."""
+        self._buffer = [None] * len(self._buffer)
+        self._start = 0
+        self._size = 0
+
+    def _get(self, index: int) -> Dict[str, Any]:
+        """Get a message by its index, from the oldest."""
+        return self._buffer[(self._start + index) % len(self._buffer)]
+
+    def _find(self, seq: int) -> int:
+        """Get the index of the first message with at least this sequence number."""
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._get(middle)["seq"] < seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def latest(self, count: int) -> List[Dict[str, Any]]:
+        """Get the most recent messages, oldest first."""
+        return [self._get(i) for i in range(max(self._size - count, 0), self._size)]
+
+    def page(self, since: int = 0, before: Optional[int] = None, min_level: Optional[str] = None,
+             limit: int = 100) -> Dict[str, Any]:
+        """
+        Get a page of messages.
+
+        Parameters
+        ----------
+        since
+            Only messages after this sequence number
+        before
+            Only messages before this sequence number. If given, the page
+            ends here, otherwise it starts at since.
+        min_level
+            Only messages of at least this level, e.g. warning
+        limit
+            The maximum number of messages
+
+        Returns
+        -------
+        The messages (oldest first), and whether there are more matching
+        messages outside the page
+        """
+        min_severity = level_severity(min_level) if min_level is not None else 0
+        # Sequence numbers in the store are increasing, so the range can be searched for
+        start = self._find(since + 1)
+        end = self._size if before is None else max(self._find(before), start)
+        indices = range(start, end) if before is None else range(end - 1, start - 1, -1)
+
+        logs = []
+        has_more = False
+        for i in indices:
+            log = self._get(i)
+            if level_severity(log["level"]) < min_severity:
+                continue
+            if len(logs) == limit:
+                has_more = True
+                break
+            logs.append(log)
+        if before is not None:
+            logs.reverse()
+        return {"logs": logs, "hasMore": has_more}
+
+    def _write_to_file(self, log: Dict[str, Any]):
+        if self._file_queue is None:
+            self._file_queue = asyncio.Queue()
+            self._file_task = asyncio.get_running_loop().create_task(self._file_writer())
+        self._file_queue.put_nowait(json.dumps(log) + "\n")
+
+    async def _file_writer(self):
+        try:
+            f = await aiofiles.open(self._file_path, mode="a", encoding="utf-8")
+        except OSError as e:
+            print(f"Failed to open log file {self._file_path}, not writing logs to it: {e}")
+            # Stop queueing messages that would never be written
+            self._file_path = None
+            self._file_queue = None
+            return
+        try:
+            while True:
+                lines = [await self._file_queue.get()]
+                # Write everything that has been queued at once
+                while not self._file_queue.empty():
+                    lines.append(self._file_queue.get_nowait())
+                try:
+                    await f.write("".join(lines))
+                    await f.flush()
+                except OSError as e:
+                    print(f"Failed to write to log file {self._file_path}: {e}")
+        finally:
+            await f.close()
@@ -0,0 +1,271 @@
+import asyncio
+from collections import deque
+import contextvars
+from dataclasses import dataclass
+import time
+from typing import Deque, Dict, Iterator, Optional, Tuple, Union
+
+import websockets
+from websockets.server import WebSocketServerProtocol
+
+from screencrash_common.wire_codec import JSON, Frame
+
+# Classes of outbound messages
+COMMAND = "command"  # Commands to components, never dropped
+HISTORY = "history"  # The history and the opus, never dropped
+STATE = "state"  # Effects and components, dropped when the client is behind
+LOGS = "logs"  # Log messages, dropped when the client is behind
+BULK = "bulk"  # Asset data to components, never dropped, sent when nothing else is queued
+
+# The classes, by priority. Queued messages of a class are always sent
+# before those of the classes after it.
+MESSAGE_CLASSES = [COMMAND, HISTORY, STATE, LOGS, BULK]
+
+# Messages which can be dropped when the queue is full. Clients notice the
+# gap in version or sequence numbers and ask for a snapshot.
+DROPPABLE_CLASSES = {STATE, LOGS}
+
+# A message to send, or the fragments of one (see encode_fragments). The
+# fragments are only encoded while the message is being written.
+QueuedFrame = Union[Frame, Iterator[Frame]]
+
+# Close code for clients that are too slow, so they reconnect later
+CLOSE_CODE_TOO_SLOW = 1013
+
+# When the input (e.g. from a UI) that caused the current messages arrived.
+# This follows the input into tasks created while handling it.
+_input_time: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("input_time", default=None)
+
+
+def mark_input():
+    """Mark that an input has arrived, so the latency until messages caused by it are written is measured."""
+    _input_time.set(time.monotonic())
+
+
+@dataclass
+class LatencyStats:
+    """Latencies from an input until a message caused by it was written, in seconds"""
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    last: float = 0.0
+
+    def add(self, latency: float):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.last = latency
+
+    def report(self) -> str:
+        if self.count == 0:
+            return "-"
+        return (f"mean {self.total / self.count * 1000:.1f} ms, max {self.max * 1000:.1f} ms, "
+                f"last {self.last * 1000:.1f} ms ({self.count})")
+
+
+# Input latencies of all connections, by message class
+input_latencies: Dict[str, LatencyStats] = {message_class: LatencyStats() for message_class in MESSAGE_CLASSES}
+
+
+def latency_report() -> str:
+    return ", ".join(f"{message_class}: {stats.report()}" for message_class, stats in input_latencies.items())
+
+
+@dataclass
+class OutboundLimits:
+    """
+    Limits for the outbound queue of every connection.
+
+    Parameters
+    ----------
+    high_water_mark
+        The number of queued messages above which droppable messages are dropped
+    evict_after
+        Seconds a client may stay above the high water mark before it's disconnected
+    """
+    high_water_mark: int = 256
+    evict_after: float = 10.0
+
+
+class OutboundQueue:
+    """
+    The messages waiting to be sent on one websocket.
+
+    Messages are written in the background, one at a time, so a slow client
+    never blocks the sender. There is one lane per message class, and the
+    writer always takes the next message from the lane with the highest
+    priority, so e.g. commands never wait behind state updates. Within a
+    lane, messages are written in order.
+
+    If a message is sent while handling an input (see mark_input), the time
+    from the input until the message is written is added to input_latencies.
+    The time each message waits in the queue is counted per class as well.
+    A sender that needs to know when a message has been written can pass a
+    future, which fails if the message is dropped or can't be written.
+
+    The queue is bounded: above the high water mark, stale state and logs
+    are dropped, while other messages are always kept. A client that stays
+    above the high water mark for too long (or gets four times as many
+    messages queued) is disconnected, so it can reconnect and get a fresh
+    handshake.
+
+    Parameters
+    ----------
+    websocket
+        The websocket to send on
+    name
+        Describes the client, for logging
+    limits
+        The limits of the queue
+    encoding
+        The encoding the client has chosen (see wire_codec), which the
+        queued frames must be encoded with
+    """
+
+    def __init__(self, websocket: WebSocketServerProtocol, name: str, limits: OutboundLimits,
+                 encoding: str = JSON):
+        self.websocket = websocket
+        self.name = name
+        self.encoding = encoding
+        self._limits = limits
+        # (frame, time queued, input time, future to set when written), by class
+        self._lanes: Dict[str, Deque[Tuple[QueuedFrame, float, Optional[float], Optional[asyncio.Future]]]] = {
+            message_class: deque() for message_class in MESSAGE_CLASSES
+        }
+        self._depth = 0
+        # The future of the message being written, if it has one
+        self._in_flight: Optional[asyncio.Future] = None
+        self._ready = asyncio.Event()
+        # When the queue went above the high water mark, if it is above
+        self._over_since: Optional[float] = None
+        self._evicted = False
+        # Metrics
+        self.max_depth = 0
+        self.lag = 0.0  # Seconds the last written message waited
+        self.waits: Dict[str, LatencyStats] = {message_class: LatencyStats() for message_class in MESSAGE_CLASSES}
+        self.sent: Dict[str, int] = {message_class: 0 for message_class in MESSAGE_CLASSES}
+        self.dropped: Dict[str, int] = {message_class: 0 for message_class in MESSAGE_CLASSES}
+        self._writer = asyncio.get_running_loop().create_task(self._write())
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def send(self, frame: QueuedFrame, message_class: str, written: Optional[asyncio.Future] = None):
+        """
+        Queue a message to be sent.
+
+        Parameters
+        ----------
+        frame
+            The serialized message, or an iterator of its fragments
+        message_class
+            The class of the message, e.g. STATE
+        written
+            A future to set when the message has been written. It fails with
+            a RuntimeError if the message is dropped or the client is gone.
+        """
+        if self._evicted:
+            _fail(written, f"{self.name} has been disconnected")
+            return
+        now = time.monotonic()
+        if self._depth >= self._limits.high_water_mark:
+            if self._over_since is None:
+                self._over_since = now
+                print(f"Warning: {self.name} is falling behind ({self._depth} messages queued)")
+            if (now - self._over_since > self._limits.evict_after
+                    or self._depth >= 4 * self._limits.high_water_mark):
+                self.evict()
+                _fail(written, f"{self.name} has been disconnected")
+                return
+            if message_class in DROPPABLE_CLASSES:
+                self.dropped[message_class] += 1
+                _fail(written, f"{self.name} is too far behind")
+                return
+        self._lanes[message_class].append((frame, now, _input_time.get(), written))
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._ready.set()
+
+    def evict(self):
+        """Disconnect the client, since it's too slow."""
+        if self._evicted:
+            return
+        self._evicted = True
+        print(f"Disconnecting {self.name}, since it is too slow. {self.report()}")
+        for message_class, lane in self._lanes.items():
+            self.dropped[message_class] += len(lane)
+        self._clear(f"{self.name} has been disconnected")
+        self._writer.cancel()
+        asyncio.get_running_loop().create_task(
+            self.websocket.close(code=CLOSE_CODE_TOO_SLOW, reason="Too slow"))
+
+    def close(self):
+        """Stop sending, after the websocket has closed."""
+        self._writer.cancel()
+        self._clear(f"{self.name} has disconnected")
+
+    def _clear(self, reason: str):
+        """Remove all queued messages, failing their futures (and that of the one being written) with the reason."""
+        _fail(self._in_flight, reason)
+        self._in_flight = None
+        for lane in self._lanes.values():
+            for *_, written in lane:
+                _fail(written, reason)
+            lane.clear()
+        self._depth = 0
+
+    def _pop_next(self) -> Tuple[str, QueuedFrame, float, Optional[float], Optional[asyncio.Future]]:
+        """Take the next message, from the lane with the highest priority."""
+        for message_class, lane in self._lanes.items():
+            if lane:
+                self._depth -= 1
+                return (message_class, *lane.popleft())
+        raise IndexError("No queued messages")
+
+    async def _write(self):
+        while True:
+            await self._ready.wait()
+            while self._depth > 0:
+                message_class, frame, queued_at, input_time, written = self._pop_next()
+                self._in_flight = written
+                try:
+                    await self.websocket.send(frame)
+                except websockets.exceptions.ConnectionClosed:
+                    self._clear(f"{self.name} has disconnected")
+                    return
+                except Exception as e:
+                    # E.g. the file of a fragmented message could not be read. If the
+                    # connection was failed because of it, the next send notices.
+                    print(f"Failed to send a {message_class} message to {self.name}: {e}")
+                    self._in_flight = None
+                    _fail(written, f"Failed to send to {self.name}: {e}")
+                    continue
+                self._in_flight = None
+                now = time.monotonic()
+                self.sent[message_class] += 1
+                self.lag = now - queued_at
+                self.waits[message_class].add(self.lag)
+                if written is not None and not written.done():
+                    written.set_result(None)
+                if input_time is not None:
+                    input_latencies[message_class].add(now - input_time)
+                if self._over_since is not None and self._depth < self._limits.high_water_mark:
+                    self._over_since = None
+            self._ready.clear()
+
+    def report(self) -> str:
+        sent = ", ".join(f"{message_class} {count}" for message_class, count in self.sent.items() if count)
+        dropped = ", ".join(f"{message_class} {count}" for message_class, count in self.dropped.items() if count)
+        waits = ", ".join(f"{message_class} {stats.report()}" for message_class, stats in self.waits.items()
+                          if stats.count)
+        return (
+            f"{self.name}: {self.depth} queued (max {self.max_depth}), lag {self.lag * 1000:.0f} ms, "
+            f"sent [{sent}], dropped [{dropped}], waits [{waits}]"
+        )
+
+
+def _fail(written: Optional[asyncio.Future], reason: str):
+    """Fail the future of a message that won't be written, if it has one."""
+    if written is not None and not written.done():
+        written.set_exception(RuntimeError(reason))
@@ -0,0 +1,50 @@
+import time
+from typing import Awaitable, Dict, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class StageTimer:
+    """
+    Measures the wall time of stages that may run concurrently.
+
+    Parameters
+    ----------
+    name
+        What the stages are part of, used in the report
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._start = time.perf_counter()
+        self._stages: Dict[str, Tuple[float, float]] = {}
+
+    async def run(self, stage: str, awaitable: Awaitable[T]) -> T:
+        """
+        Await something and record it as a stage.
+
+        Parameters
+        ----------
+        stage
+            The name of the stage
+        awaitable
+            The work of the stage
+
+        Returns
+        -------
+        The result of the awaitable
+        """
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self._stages[stage] = (start, time.perf_counter())
+
+    def report(self) -> str:
+        """Get a one-line report of the total time and the time of each stage."""
+        total = time.perf_counter() - self._start
+        stages = ", ".join(
+            f"{stage} {end - start:.2f}s (from {start - self._start:.2f}s)"
+            for stage, (start, end) in self._stages.items()
+        )
+        return f"{self._name} took {total:.2f}s: {stages}"
@@ -0,0 +1,56 @@
+from typing import Dict, Iterable, List, Set
+
+from util.outbound_queue import OutboundQueue
+
+
+class Subscriptions:
+    """
+    The clients subscribed to each topic.
+
+    Parameters
+    ----------
+    topics
+        The topics, in the order their data should be sent to new subscribers
+    """
+
+    def __init__(self, topics: List[str]):
+        self._topics = topics
+        self._subscribers: Dict[str, Set[OutboundQueue]] = {topic: set() for topic in topics}
+
+    def unknown(self, topics: Iterable[str]) -> List[str]:
+        """Get the topics that don't exist."""
+        return [topic for topic in topics if topic not in self._subscribers]
+
+    def subscribers(self, topic: str) -> Set[OutboundQueue]:
+        return self._subscribers[topic]
+
+    def subscribe(self, client: OutboundQueue, topics: Iterable[str]) -> List[str]:
+        """
+        Subscribe a client to topics.
+
+        Returns
+        -------
+        The topics the client wasn't already subscribed to, in order. The
+        client should be sent the current data of each of them.
+        """
+        topics = list(topics)
+        unknown_topics = self.unknown(topics)
+        if unknown_topics:
+            raise RuntimeError(f"Unknown topics {', '.join(unknown_topics)}")
+        new_topics = [topic for topic in self._topics
+                      if topic in topics and client not in self._subscribers[topic]]
+        for topic in new_topics:
+            self._subscribers[topic].add(client)
+        return new_topics
+
+    def unsubscribe(self, client: OutboundQueue, topics: Iterable[str]):
+        topics = list(topics)
+        unknown_topics = self.unknown(topics)
+        if unknown_topics:
+            raise RuntimeError(f"Unknown topics {', '.join(unknown_topics)}")
+        for topic in topics:
+            self._subscribers[topic].discard(client)
+
+    def remove(self, client: OutboundQueue):
+        """Unsubscribe a client from all topics."""
+        self.unsubscribe(client, self._topics)
@@ -0,0 +1,80 @@
+import io
+import random
+
+from screencrash_common.block_signature import file_signature
+
+from util.block_delta import Copy, Data, compute_delta
+
+BLOCK_SIZE = 16
+
+
+def _delta(old: bytes, new: bytes, max_new_data=None):
+    weak, strong = file_signature(io.BytesIO(old), BLOCK_SIZE)
+    return compute_delta(memoryview(new), BLOCK_SIZE, weak, strong,
+                         len(new) if max_new_data is None else max_new_data)
+
+
+def _apply(old: bytes, new: bytes, operations) -> bytes:
+    parts = []
+    for operation in operations:
+        if isinstance(operation, Copy):
+            parts.append(old[operation.source_offset:operation.source_offset + operation.length])
+        else:
+            parts.append(new[operation.start:operation.end])
+    return b"".join(parts)
+
+
+def _random_bytes(length: int, seed: int) -> bytes:
+    return random.Random(seed).randbytes(length)
+
+
+def test_unchanged_file_is_one_copy():
+    old = _random_bytes(BLOCK_SIZE * 10, 1)
+    assert _delta(old, old) == [Copy(0, BLOCK_SIZE * 10)]
+
+
+def test_partial_last_block_is_data():
+    old = _random_bytes(BLOCK_SIZE * 4 + 5, 2)
+    assert _delta(old, old) == [Copy(0, BLOCK_SIZE * 4), Data(BLOCK_SIZE * 4, len(old))]
+
+
+def test_insertions_and_deletions():
+    old = _random_bytes(BLOCK_SIZE * 20, 3)
+    new = (
+        b"inserted at the start"
+        + old[:BLOCK_SIZE * 5]
+        + b"inserted in the middle"
+        # Block 5 and a bit of block 6 are deleted
+        + old[BLOCK_SIZE * 6 + 3:BLOCK_SIZE * 12]
+        # Blocks 12 to 14 are deleted
+        + old[BLOCK_SIZE * 15:]
+        + b"at the end"
+    )
+    operations = _delta(old, new)
+    assert _apply(old, new, operations) == new
+    copied = sum(operation.length for operation in operations if isinstance(operation, Copy))
+    # Everything but the block with the partial deletion is found
+    assert copied == BLOCK_SIZE * 15
+
+
+def test_moved_and_repeated_blocks():
+    old = _random_bytes(BLOCK_SIZE * 6, 4)
+    blocks = [old[i:i + BLOCK_SIZE] for i in range(0, len(old), BLOCK_SIZE)]
+    new = blocks[3] + blocks[0] + blocks[0] + blocks[5] + blocks[4]
+    operations = _delta(old, new)
+    assert _apply(old, new, operations) == new
+    assert all(isinstance(operation, Copy) for operation in operations)
+
+
+def test_empty_files():
+    assert _delta(b"", b"abc") == [Data(0, 3)]
+    assert _delta(_random_bytes(BLOCK_SIZE * 2, 5), b"") == []
+
+
+def test_gives_up_on_too_much_new_data():
+    old = _random_bytes(BLOCK_SIZE * 10, 6)
+    new = _random_bytes(BLOCK_SIZE * 10, 7)
+    assert _delta(old, new, max_new_data=BLOCK_SIZE * 5) is None
+    # The data after the last block counts too
+    assert _delta(old, old + b"x" * 10, max_new_data=9) is None
+    assert _delta(old, old + b"x" * 10, max_new_data=10) is not None
@@ -0,0 +1,111 @@
+import http
+
+from websockets.datastructures import Headers
+
+from util.http_file import _parse_range, file_response, serve_file_data
+
+DATA = bytes(range(100))
+ETAG = "abc123"
+
+
+def _get(data=DATA, max_length=None, **request_headers):
+    headers = Headers({name.replace("_", "-"): value for name, value in request_headers.items()})
+    return file_response(headers, len(data), ETAG, "application/octet-stream", max_length)
+
+
+def test_parse_range():
+    assert _parse_range(None, 100) is None
+    assert _parse_range("bytes=10-19", 100) == (10, 19)
+    assert _parse_range("bytes=90-", 100) == (90, 99)
+    # The end is limited to the data
+    assert _parse_range("bytes=90-200", 100) == (90, 99)
+
+
+def test_parse_suffix_range():
+    assert _parse_range("bytes=-10", 100) == (90, 99)
+    # Longer than the data, so all of it
+    assert _parse_range("bytes=-200", 100) == (0, 99)
+    assert _parse_range("bytes=-0", 100) == ()
+
+
+def test_parse_unsatisfiable_range():
+    assert _parse_range("bytes=100-", 100) == ()
+    assert _parse_range("bytes=20-10", 100) == ()
+    assert _parse_range("bytes=0-", 0) == ()
+
+
+def test_parse_unsupported_range():
+    assert _parse_range("bytes=-", 100) is None
+    assert _parse_range("bytes=0-1,5-6", 100) is None
+    assert _parse_range("items=0-1", 100) is None
+
+
+def test_whole_file():
+    status, headers, byte_range = _get()
+    assert status == http.HTTPStatus.OK
+    assert byte_range == (0, 99)
+    assert headers["ETag"] == f'"{ETAG}"'
+    assert "Content-Range" not in headers
+
+
+def test_range():
+    status, headers, byte_range = _get(Range="bytes=-10")
+    assert status == http.HTTPStatus.PARTIAL_CONTENT
+    assert byte_range == (90, 99)
+    assert headers["Content-Range"] == "bytes 90-99/100"
+
+
+def test_unsatisfiable_range():
+    status, headers, byte_range = _get(Range="bytes=100-")
+    assert status == http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert byte_range is None
+    assert headers["Content-Range"] == "bytes */100"
+
+
+def test_empty_file():
+    status, _, byte_range = _get(data=b"")
+    assert status == http.HTTPStatus.OK
+    assert serve_file_data(Headers(), b"", ETAG, "text/plain")[2] == b""
+
+
+def test_if_none_match():
+    status, _, byte_range = _get(If_None_Match=f'"other", "{ETAG}"')
+    assert status == http.HTTPStatus.NOT_MODIFIED
+    assert byte_range is None
+    assert _get(If_None_Match="*")[0] == http.HTTPStatus.NOT_MODIFIED
+    assert _get(If_None_Match='"other"')[0] == http.HTTPStatus.OK
+
+
+def test_if_range():
+    status, _, byte_range = _get(Range="bytes=10-19", If_Range=f'"{ETAG}"')
+    assert status == http.HTTPStatus.PARTIAL_CONTENT
+    assert byte_range == (10, 19)
+    # The data changed, so the client gets all of it
+    status, headers, byte_range = _get(Range="bytes=10-19", If_Range='"other"')
+    assert status == http.HTTPStatus.OK
+    assert byte_range == (0, 99)
+    assert "Content-Range" not in headers
+
+
+def test_max_length():
+    status, headers, byte_range = _get(max_length=30, Range="bytes=10-")
+    assert status == http.HTTPStatus.PARTIAL_CONTENT
+    assert byte_range == (10, 39)
+    assert headers["Content-Range"] == "bytes 10-39/100"
+    assert _get(max_length=100)[0] == http.HTTPStatus.OK
+
+
+def test_max_length_refuses_whole_file():
+    status, headers, byte_range = _get(max_length=30)
+    assert status == http.HTTPStatus.BAD_REQUEST
+    assert byte_range is None
+    assert headers["Content-Type"] == "text/plain"
+    assert _get(max_length=30, Range="bytes=0-9", If_Range='"other"')[0] == http.HTTPStatus.BAD_REQUEST
+
+
+def test_serve_file_data():
+    headers = Headers({"Range": "bytes=10-12"})
+    status, _, body = serve_file_data(headers, memoryview(DATA), ETAG, "application/octet-stream")
+    assert status == http.HTTPStatus.PARTIAL_CONTENT
+    assert body == bytes([10, 11, 12])
+    assert serve_file_data(Headers({"If-None-Match": f'"{ETAG}"'}), DATA, ETAG, "text/plain")[2] == b""
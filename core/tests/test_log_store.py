@@ -0,0 +1,79 @@
+import pytest
+
+from util.log_store import LogStore
+
+
+def _log(seq, level="info"):
+    return {"seq": seq, "level": level, "timestamp": 0, "origin": "test", "message": f"message {seq}"}
+
+
+def _seqs(page):
+    return [log["seq"] for log in page["logs"]]
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        LogStore(0)
+
+
+def test_append_numbers_messages():
+    logs = LogStore(10)
+    first = logs.append("info", 0, "test", "first")
+    second = logs.append("info", 0, "test", "second")
+    assert (first["seq"], second["seq"]) == (1, 2)
+
+
+def test_ring_wraparound_keeps_the_latest():
+    logs = LogStore(3)
+    for i in range(7):
+        logs.append("info", 0, "test", f"message {i}")
+    assert [log["seq"] for log in logs.latest(10)] == [5, 6, 7]
+    assert [log["seq"] for log in logs.latest(2)] == [6, 7]
+    assert _seqs(logs.page()) == [5, 6, 7]
+
+
+def test_clear_keeps_numbering():
+    logs = LogStore(3)
+    logs.append("info", 0, "test", "before")
+    logs.clear()
+    assert logs.latest(10) == []
+    assert logs.append("info", 0, "test", "after")["seq"] == 2
+
+
+def test_page_forward_and_backward():
+    logs = LogStore(100)
+    for i in range(10):
+        logs.append("info", 0, "test", f"message {i}")
+    assert _seqs(logs.page(since=3, limit=4)) == [4, 5, 6, 7]
+    assert logs.page(since=3, limit=4)["hasMore"]
+    assert _seqs(logs.page(before=8, limit=3)) == [5, 6, 7]
+    assert logs.page(before=8, limit=3)["hasMore"]
+    assert _seqs(logs.page(since=5, before=8)) == [6, 7]
+    assert not logs.page(since=5, before=8)["hasMore"]
+    assert _seqs(logs.page(since=10)) == []
+
+
+def test_page_by_level():
+    logs = LogStore(100)
+    for level in ["debug", "info", "warning", "error", "unknown"]:
+        logs.append(level, 0, "test", level)
+    assert _seqs(logs.page(min_level="warning")) == [3, 4]
+    # Unknown levels count as info
+    assert _seqs(logs.page(min_level="info")) == [2, 3, 4, 5]
+    assert not logs.page(min_level="warning", limit=2)["hasMore"]
+    assert logs.page(min_level="info", limit=2)["hasMore"]
+
+
+def test_page_with_gaps_in_seqs():
+    logs = LogStore(4)
+    for seq in [2, 5, 6, 10, 11, 20]:
+        logs.add(_log(seq))
+    # Wrapped around, so the ring starts in the middle of the buffer
+    assert _seqs(logs.page()) == [6, 10, 11, 20]
+    assert _seqs(logs.page(since=7)) == [10, 11, 20]
+    assert _seqs(logs.page(since=10)) == [11, 20]
+    assert _seqs(logs.page(before=11)) == [6, 10]
+    assert _seqs(logs.page(before=12, limit=1)) == [11]
+    assert _seqs(logs.page(since=1, before=6)) == []
+    assert _seqs(logs.page(since=20)) == []
+    assert logs.append("info", 0, "test", "next")["seq"] == 21
@@ -0,0 +1,66 @@
+import pytest
+
+from parametrized_action import ParametrizedActionTemplate
+
+
+def _template(parameters):
+    return {
+        "parameters": parameters,
+        "actions": [
+            {"target": "audio", "cmd": "create", "params": {"entityId": "$name_audio", "volume": 0}},
+            {"target": "audio", "cmd": "play", "params": {"entityId": "$name_audio"}},
+        ],
+    }
+
+
+def test_instantiate():
+    template = ParametrizedActionTemplate("sound", _template({
+        "name": [{"path": "$[0].params.entityId"}, {"path": "$[1].params.entityId"}],
+        "volume": [{"path": "$[0].params.volume"}],
+    }))
+    actions = template.instantiate({"name": "rain", "volume": 50})
+    assert actions[0]["params"] == {"entityId": "rain_audio", "volume": 50}
+    assert actions[1]["params"] == {"entityId": "rain_audio"}
+
+
+def test_instances_do_not_share_data():
+    template = ParametrizedActionTemplate("sound", _template({"volume": [{"path": "$[0].params.volume"}]}))
+    first = template.instantiate({"volume": 1})
+    first[1]["params"]["entityId"] = "changed"
+    second = template.instantiate({"volume": 2})
+    assert second[0]["params"]["volume"] == 2
+    assert second[1]["params"]["entityId"] == "$name_audio"
+
+
+def test_wildcard_path():
+    template = ParametrizedActionTemplate("sound", _template({"name": [{"path": "$[*].params.entityId"}]}))
+    actions = template.instantiate({"name": "rain"})
+    assert [action["params"]["entityId"] for action in actions] == ["rain_audio", "rain_audio"]
+
+
+def test_overlapping_paths():
+    # The second parameter is put into what the first one replaces, so the
+    # locations can't be resolved in advance
+    template = ParametrizedActionTemplate("sound", _template({
+        "params": [{"path": "$[0].params"}],
+        "name": [{"path": "$[0].params.entityId"}],
+    }))
+    assert template._locations is None
+    actions = template.instantiate({"params": {"entityId": "$name", "looping": 1}, "name": "rain"})
+    assert actions[0]["params"] == {"entityId": "rain", "looping": 1}
+    assert actions[1]["params"] == {"entityId": "$name_audio"}
+
+
+def test_same_location_twice():
+    # Both changes go to the same place, which can still be resolved in advance
+    template = ParametrizedActionTemplate("sound", _template({
+        "name": [{"path": "$[0].params.entityId"}],
+        "volume": [{"path": "$[0].params.entityId"}],
+    }))
+    assert template._locations is not None
+    assert template.instantiate({"name": "rain", "volume": 50})[0]["params"]["entityId"] == 50
+
+
+def test_invalid_path():
+    with pytest.raises(RuntimeError):
+        ParametrizedActionTemplate("sound", _template({"name": [{"path": "$[5].params.entityId"}]}))
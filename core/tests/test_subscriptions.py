@@ -0,0 +1,39 @@
+import pytest
+
+from util.subscriptions import Subscriptions
+
+
+def test_subscribe_returns_new_topics_in_order():
+    subscriptions = Subscriptions(["history", "state", "logs"])
+    client = object()
+    assert subscriptions.subscribe(client, ["logs", "history"]) == ["history", "logs"]
+    assert subscriptions.subscribe(client, ["state", "logs"]) == ["state"]
+    assert subscriptions.subscribers("logs") == {client}
+
+
+def test_unknown_topics():
+    subscriptions = Subscriptions(["history", "state"])
+    client = object()
+    assert subscriptions.unknown(["state", "nope", "logs"]) == ["nope", "logs"]
+    with pytest.raises(RuntimeError):
+        subscriptions.subscribe(client, ["state", "nope"])
+    # Nothing is subscribed to if any topic is unknown
+    assert subscriptions.subscribers("state") == set()
+    with pytest.raises(RuntimeError):
+        subscriptions.unsubscribe(client, ["nope"])
+
+
+def test_unsubscribe_and_remove():
+    subscriptions = Subscriptions(["history", "state"])
+    first, second = object(), object()
+    subscriptions.subscribe(first, ["history", "state"])
+    subscriptions.subscribe(second, ["history"])
+    subscriptions.unsubscribe(first, ["history"])
+    assert subscriptions.subscribers("history") == {second}
+    # Unsubscribing again is fine
+    subscriptions.unsubscribe(first, ["history"])
+    subscriptions.remove(first)
+    subscriptions.remove(second)
+    assert subscriptions.subscribers("history") == set()
+    assert subscriptions.subscribers("state") == set()
+    assert subscriptions.subscribe(first, ["history"]) == ["history"]
@@ -8,9 +8,11 @@ import {
   INodeCollection,
   IEffect,
   IEffectActionEvent,
+  IComponentInfo,
   IComponentState,
   IConnectionState,
   ILogMessage,
+  ILogPage,
   IUIConfig,
 } from "./types";
 
@@ -20,7 +22,8 @@ const eventNames = {
   script: "script",
   effects: "effects",
   logs: "logs",
-  logAdded: "log-added",
+  logsAdded: "logs-added",
+  logsPage: "logs-page",
   components: "components",
   connection: "connection",
   uiconfig: "uiconfig",
@@ -35,7 +38,20 @@ interface CoreConnectionEventMap {
   components: CustomEvent<IComponentState[]>;
   effects: CustomEvent<IEffect[]>;
   logs: CustomEvent<ILogMessage[]>;
-  "log-added": CustomEvent<ILogMessage>;
+  "logs-added": CustomEvent<ILogMessage[]>;
+  "logs-page": CustomEvent<ILogPage>;
+}
+
+// A change of one effect or component, as sent by Core
+interface IStateChange {
+  type: string;
+  entityId?: string;
+  effect?: IEffect;
+  changes?: Partial<IEffect>;
+  componentId?: string;
+  component?: IComponentState;
+  info?: Partial<IComponentInfo>;
+  state?: { [index: string]: unknown };
 }
 
 /**
@@ -58,6 +74,12 @@ interface ICoreConnection extends EventTarget {
   runPredefinedActions(actions: string[]): void;
   handleEffectAction(event: IEffectActionEvent): void;
   handleClearLogMessages(): void;
+  requestLogs(query: {
+    since?: number;
+    before?: number;
+    minLevel?: string;
+    limit?: number;
+  }): void;
   handleComponentReset(componentId: string): void;
   handleComponentRestart(componentId: string): void;
 
@@ -82,6 +104,22 @@ interface ICoreConnection extends EventTarget {
 class RealCoreConnection extends EventTarget implements ICoreConnection {
   private address: string;
   private socket: WebSocket;
+  private nodes: INodeCollection = {};
+  // The history, kept up to date by changes from Core
+  private historySeq = 0;
+  private history: string[] = [];
+  // Whether the history has been requested after a missed change
+  private historyRequested = false;
+  // Effects and components, kept up to date by deltas from Core
+  private stateVersion = 0;
+  // Whether a snapshot of the state has been requested after a missed batch
+  private stateRequested = false;
+  private effects: { [entityId: string]: IEffect } = {};
+  private components: { [componentId: string]: IComponentState } = {};
+  // The sequence number of the last log message we have, if any
+  private lastLogSeq: number | null = null;
+  // Whether log messages have been requested after some were missed
+  private logsRequested = false;
 
   constructor(address: string) {
     super();
@@ -101,30 +139,205 @@ class RealCoreConnection extends EventTarget implements ICoreConnection {
     );
   }
 
+  private emitEffects() {
+    this.dispatchEvent(
+      new CustomEvent(eventNames.effects, {
+        detail: Object.values(this.effects),
+      })
+    );
+  }
+
+  private emitComponents() {
+    this.dispatchEvent(
+      new CustomEvent(eventNames.components, {
+        detail: Object.values(this.components),
+      })
+    );
+  }
+
+  /**
+   * Apply a batch of changes of effects and components. If a batch has
+   * been missed, a new snapshot of the state is requested instead, and
+   * batches are ignored until it arrives, since it includes them.
+   */
+  private applyStateChanges(version: number, changes: IStateChange[]) {
+    if (this.stateRequested || version <= this.stateVersion) {
+      return;
+    }
+    if (version !== this.stateVersion + 1) {
+      console.log(
+        `Missed state version ${this.stateVersion + 1}, requesting state`
+      );
+      this.stateRequested = true;
+      this.socket.send(JSON.stringify({ messageType: "get-state" }));
+      return;
+    }
+    this.stateVersion = version;
+    // Copy once per batch, so listeners see new objects
+    const effects = { ...this.effects };
+    const components = { ...this.components };
+    let effectsChanged = false;
+    let componentsChanged = false;
+    for (const change of changes) {
+      switch (change.type) {
+        case "effect-added":
+          effects[change.effect!.entityId] = change.effect!;
+          effectsChanged = true;
+          break;
+        case "effect-patched":
+          if (effects[change.entityId!] !== undefined) {
+            effects[change.entityId!] = {
+              ...effects[change.entityId!],
+              ...change.changes,
+            };
+            effectsChanged = true;
+          }
+          break;
+        case "effect-removed":
+          delete effects[change.entityId!];
+          effectsChanged = true;
+          break;
+        case "component-added":
+          components[change.component!.info.componentId] = change.component!;
+          componentsChanged = true;
+          break;
+        case "component-patched": {
+          const component = components[change.componentId!];
+          if (component !== undefined) {
+            components[change.componentId!] = {
+              info: { ...component.info, ...change.info },
+              state: { ...component.state, ...change.state },
+            };
+            componentsChanged = true;
+          }
+          break;
+        }
+        case "component-removed":
+          delete components[change.componentId!];
+          componentsChanged = true;
+          break;
+      }
+    }
+    if (effectsChanged) {
+      this.effects = effects;
+      this.emitEffects();
+    }
+    if (componentsChanged) {
+      this.components = components;
+      this.emitComponents();
+    }
+  }
+
+  /**
+   * Add new log messages. Core drops log messages when we are behind, so
+   * if some have been missed, they are requested from Core instead, and
+   * new messages are ignored until they arrive, since Core still has them.
+   */
+  private addLogs(logs: ILogMessage[]) {
+    if (this.logsRequested || logs.length === 0) {
+      return;
+    }
+    if (this.lastLogSeq !== null && logs[0].seq > this.lastLogSeq + 1) {
+      console.log(
+        `Missed log messages after ${this.lastLogSeq}, requesting them`
+      );
+      this.requestMissedLogs();
+      return;
+    }
+    this.emitLogsAdded(logs);
+  }
+
+  private requestMissedLogs() {
+    this.logsRequested = true;
+    this.socket.send(
+      JSON.stringify({ messageType: "get-logs", since: this.lastLogSeq })
+    );
+  }
+
+  private emitLogsAdded(logs: ILogMessage[]) {
+    const lastLogSeq = this.lastLogSeq;
+    const newLogs =
+      lastLogSeq === null ? logs : logs.filter((log) => log.seq > lastLogSeq);
+    if (newLogs.length === 0) {
+      return;
+    }
+    this.lastLogSeq = newLogs[newLogs.length - 1].seq;
+    this.dispatchEvent(
+      new CustomEvent(eventNames.logsAdded, { detail: newLogs })
+    );
+  }
+
   public handshake(): void {
     this.socket = new WebSocket(`ws://${this.address}`);
     this.socket.addEventListener("open", () => {
       console.log(`Got connection to core`);
       this.emitConnected(true);
+      // The handshake includes snapshots of everything
+      this.stateRequested = false;
+      this.historyRequested = false;
+      this.logsRequested = false;
       this.socket.send(JSON.stringify({ client: "ui" }));
     });
     this.socket.addEventListener("message", (event: MessageEvent) => {
       const { messageType, data } = JSON.parse(event.data);
       switch (messageType) {
         case "history":
+          this.historyRequested = false;
+          this.historySeq = data.seq;
+          this.history = data.history;
           this.dispatchEvent(
             new CustomEvent(eventNames.history, {
-              detail: data,
+              detail: this.history,
+            })
+          );
+          break;
+        case "history-changed":
+          // Changes are ignored while waiting for the history, which includes them
+          if (this.historyRequested || data.seq <= this.historySeq) {
+            break;
+          }
+          if (data.seq !== this.historySeq + 1) {
+            console.log(
+              `Missed history change ${this.historySeq + 1}, requesting history`
+            );
+            this.historyRequested = true;
+            this.socket.send(JSON.stringify({ messageType: "get-history" }));
+            break;
+          }
+          this.historySeq = data.seq;
+          if (data.op === "pop") {
+            this.history = this.history.slice(0, -1);
+          } else {
+            this.history = [...this.history, data.node];
+          }
+          this.dispatchEvent(
+            new CustomEvent(eventNames.history, {
+              detail: this.history,
             })
           );
           break;
         case "nodes":
+          this.nodes = data;
           this.dispatchEvent(
             new CustomEvent(eventNames.nodes, {
               detail: data,
             })
           );
           break;
+        case "nodes-changed": {
+          // Sent when the opus is reloaded. Merge into the nodes we have.
+          const nodes = { ...this.nodes, ...data.changed };
+          for (const nodeId of data.removed) {
+            delete nodes[nodeId];
+          }
+          this.nodes = nodes;
+          this.dispatchEvent(
+            new CustomEvent(eventNames.nodes, {
+              detail: nodes,
+            })
+          );
+          break;
+        }
         case "uiconfig":
           this.dispatchEvent(
             new CustomEvent(eventNames.uiconfig, {
@@ -133,28 +346,55 @@ class RealCoreConnection extends EventTarget implements ICoreConnection {
           );
           break;
         case "script":
+          // The script is served over HTTP under a URL with its hash, so the
+          // browser can cache it between connections.
           this.dispatchEvent(
-            new CustomEvent(eventNames.script, { detail: data })
+            new CustomEvent(eventNames.script, {
+              detail: `http://${this.address}${data.path}`,
+            })
           );
           break;
-        case "components":
-          this.dispatchEvent(
-            new CustomEvent(eventNames.components, { detail: data })
-          );
+        case "state":
+          // A snapshot of all effects and components
+          this.stateRequested = false;
+          this.stateVersion = data.version;
+          this.effects = {};
+          for (const effect of data.effects) {
+            this.effects[effect.entityId] = effect;
+          }
+          this.components = {};
+          for (const component of data.components) {
+            this.components[component.info.componentId] = component;
+          }
+          this.emitEffects();
+          this.emitComponents();
           break;
-        case "effects":
-          this.dispatchEvent(
-            new CustomEvent(eventNames.effects, { detail: data })
-          );
+        case "state-changed":
+          this.applyStateChanges(data.version, data.changes);
           break;
         case "logs":
+          this.lastLogSeq = data.length > 0 ? data[data.length - 1].seq : null;
           this.dispatchEvent(
             new CustomEvent(eventNames.logs, { detail: data })
           );
           break;
-        case "log-added":
+        case "logs-added":
+          this.addLogs(data);
+          break;
+        case "logs-page":
+          if (this.logsRequested) {
+            // The log messages we missed. Core may have dropped the oldest
+            // of them from its store too, so this doesn't check for gaps.
+            this.emitLogsAdded(data.logs);
+            if (data.hasMore) {
+              this.requestMissedLogs();
+            } else {
+              this.logsRequested = false;
+            }
+            break;
+          }
           this.dispatchEvent(
-            new CustomEvent(eventNames.logAdded, { detail: data })
+            new CustomEvent(eventNames.logsPage, { detail: data })
           );
           break;
         default:
@@ -283,6 +523,18 @@ class RealCoreConnection extends EventTarget implements ICoreConnection {
     );
   }
 
+  /**
+   * Ask Core for a page of log messages. The answer is a logs-page event.
+   */
+  public requestLogs(query: {
+    since?: number;
+    before?: number;
+    minLevel?: string;
+    limit?: number;
+  }): void {
+    this.socket.send(JSON.stringify({ messageType: "get-logs", ...query }));
+  }
+
   public handleComponentReset(componentId: string): void {
     const message: ComponentResetMessage = {
       messageType: "component-reset",
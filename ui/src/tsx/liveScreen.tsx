@@ -151,12 +151,11 @@ class LiveScreen extends React.PureComponent<IProps, IState> {
         logMessages: event.detail.slice(-this.props.maxNofLogs),
       });
     });
-    this.props.coreConnection.addEventListener("log-added", (event) => {
+    this.props.coreConnection.addEventListener("logs-added", (event) => {
       this.setState({
-        logMessages: [
-          ...this.state.logMessages.slice(-this.props.maxNofLogs + 1),
-          event.detail,
-        ],
+        logMessages: [...this.state.logMessages, ...event.detail].slice(
+          -this.props.maxNofLogs
+        ),
       });
     });
 
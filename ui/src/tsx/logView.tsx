@@ -29,7 +29,7 @@ class LogView extends React.PureComponent<IProps, IEmpty> {
           .map((msg) => (
             <div
               className={style.logMessage}
-              key={`${msg.origin}_${msg.timestamp}`}
+              key={msg.seq}
             >
               <div className={style.logMessageLeft}>
                 <LogMessageIcon level={msg.level} />
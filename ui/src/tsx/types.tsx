@@ -80,12 +80,19 @@ interface IConnectionState {
 }
 
 interface ILogMessage {
+  seq: number;
   level: string;
   timestamp: number;
   origin: string;
   message: string;
 }
 
+// A page of log messages, fetched from Core
+interface ILogPage {
+  logs: ILogMessage[];
+  hasMore: boolean;
+}
+
 // Empty object, since there is no built-in for it
 type IEmpty = Record<never, never>;
 
@@ -102,6 +109,7 @@ export type {
   IComponentState,
   IConnectionState,
   ILogMessage,
+  ILogPage,
   IEmpty,
 };
 